@@ -0,0 +1,494 @@
+# agent.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Execution agent running as the main process of a sandbox's container.
+
+Listen on the unix socket given as argument and execute the received commands with the same
+semantics as 'docker exec', without its round-trips to the Docker daemon.
+
+Each connection carries a single command, as a JSON line:
+    {"command": "<bash command>", "environ": {"VAR": "value"}, "timeout": <seconds>,
+     "limit": <bytes>, "total": <bytes>, "kill": <bool>}
+answered with a JSON line:
+    {"exit_code": <int>, "stdout": "<base64>", "stderr": "<base64>", "timed_out": <bool>,
+     "exceeded": <bool>, "bytes": {"stdout": <int>, "stderr": <int>},
+     "truncated": {"stdout": <bool>, "stderr": <bool>}}
+
+At most 'limit' bytes of each of stdout and stderr, and 'total' bytes of both, are kept (null or
+missing means no limit). 'bytes' contains the number of bytes written by the command. If 'kill' is
+true, the command is killed as soon as its output exceeds the limits ('exceeded').
+
+or a list of commands sharing a total timeout and a total output limit, executed until one fails:
+    {"commands": [{"command": ..., "environ": ..., "timeout": ..., "limit": ...,
+                   "ignore_failure": <bool>}],
+     "timeout": <seconds>, "total": <bytes>, "kill": <bool>}
+answered with the result of each executed command, with its effective timeout and duration:
+    {"results": [{"exit_code": ..., "stdout": ..., "stderr": ..., "timed_out": ..., ...
+                  "timeout": <seconds>, "time": <seconds>}]}
+
+If the request contains '"resources": true', the response of each command also contains the
+resources it used, measured from the files of the container's cgroup:
+    {"resources": {"cpu_user": <seconds>, "cpu_system": <seconds>, "memory_peak": <bytes>,
+                   "pids_peak": <int>, "io_read": <bytes>, "io_write": <bytes>}}
+or null if the cgroup cannot be read. Peaks are null if they cannot be reset (cgroup mounted
+read-only, which is the default for unprivileged containers), other values are null if they
+cannot be read.
+
+If the request of a single command contains '"stream": true', each chunk of its output is sent as
+soon as it is read, as JSON lines {"stdout": "<base64>"} or {"stderr": "<base64>"}, before the
+response (whose stdout and stderr are then empty).
+
+A list of commands can also be executed through 'docker exec' with
+'python3 agent.py --batch <request as base64 JSON>', the response being written on stdout.
+
+A command exceeding its timeout is killed along with its process group. As the main process of
+the container, the agent also reaps the orphaned processes. It installs no handler for SIGTERM or
+SIGINT: the kernel then discards them when they are sent to the main process of a container, so
+that commands cannot stop the container with 'kill 1' (the sandbox stops containers with SIGKILL).
+This script must stay compatible with python 3.5, images may ship an old interpreter."""
+
+import base64
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+# Time (in seconds) between two checks of whether the command exited while its output is still
+# held open by one of its background processes.
+POLL_INTERVAL = 0.05
+
+# Mount point of the cgroup filesystem, the container's own cgroup being mounted there (cgroup v2),
+# or in one directory per controller (cgroup v1).
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Whether a command is being executed, orphans are not reaped meanwhile so that its exit status
+# is not stolen from it.
+_BUSY = False
+
+
+
+def reap(*_):
+    """Reap every orphaned process which exited, unless a command is being executed."""
+    if _BUSY:
+        return
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except ChildProcessError:
+        pass
+
+
+
+class Capture:
+    """Keep at most <limit> bytes of each stream of a command, and <total> bytes of both (None
+    means no limit), counting every byte written."""
+    
+    
+    def __init__(self, limit: int = None, total: int = None):
+        self.limit = limit
+        self.total = total
+        self.kept = {"stdout": 0, "stderr": 0}
+        self.written = {"stdout": 0, "stderr": 0}
+    
+    
+    def keep(self, name: str, data: bytes) -> bytes:
+        """Return the part of <data>, written on the stream <name>, which must be kept."""
+        self.written[name] += len(data)
+        allowed = len(data)
+        if self.limit is not None:
+            allowed = min(allowed, self.limit - self.kept[name])
+        if self.total is not None:
+            allowed = min(allowed, self.total - sum(self.kept.values()))
+        data = data[:max(allowed, 0)]
+        self.kept[name] += len(data)
+        return data
+    
+    
+    @property
+    def truncated(self) -> dict:
+        return {name: self.written[name] > self.kept[name] for name in self.written}
+    
+    
+    @property
+    def exceeded(self) -> bool:
+        return any(self.truncated.values())
+
+
+
+def cgroup_v2() -> bool:
+    return os.path.isfile(os.path.join(CGROUP_ROOT, "cgroup.controllers"))
+
+
+
+def cgroup_path(controller: str, filename: str) -> str:
+    if cgroup_v2():
+        return os.path.join(CGROUP_ROOT, filename)
+    return os.path.join(CGROUP_ROOT, controller, filename)
+
+
+
+def cgroup_read(controller: str, filename: str):
+    """Return the content of <filename> in the cgroup <controller>, None if it cannot be read."""
+    try:
+        with open(cgroup_path(controller, filename)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+
+def keyed(content) -> dict:
+    """Parse the lines '<key> <value>' of a flat keyed cgroup file."""
+    values = dict()
+    for line in (content or "").splitlines():
+        key, _, value = line.partition(" ")
+        if value.strip().isdigit():
+            values[key] = int(value)
+    return values
+
+
+
+def cpu_times():
+    """Return the CPU time (in seconds) spent in user and system mode by the container."""
+    if cgroup_v2():
+        stat = keyed(cgroup_read("cpu", "cpu.stat"))
+        if "user_usec" not in stat or "system_usec" not in stat:
+            return None
+        return stat["user_usec"] / 1e6, stat["system_usec"] / 1e6
+    
+    stat = keyed(cgroup_read("cpuacct", "cpuacct.stat"))
+    if "user" not in stat or "system" not in stat:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return stat["user"] / ticks, stat["system"] / ticks
+
+
+
+def io_bytes():
+    """Return the number of bytes read from and written to block devices by the container."""
+    read_bytes = written_bytes = 0
+    if cgroup_v2():
+        content = cgroup_read("io", "io.stat")
+        if content is None:
+            return None
+        for line in content.splitlines():
+            fields = dict(f.split("=", 1) for f in line.split()[1:] if "=" in f)
+            read_bytes += int(fields.get("rbytes", 0))
+            written_bytes += int(fields.get("wbytes", 0))
+        return read_bytes, written_bytes
+    
+    content = cgroup_read("blkio", "blkio.throttle.io_service_bytes")
+    if content is None:
+        return None
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == "Read":
+            read_bytes += int(fields[2])
+        elif len(fields) == 3 and fields[1] == "Write":
+            written_bytes += int(fields[2])
+    return read_bytes, written_bytes
+
+
+
+class Peak:
+    """Peak value of a gauge of the cgroup (memory or number of processes) since the creation of
+    this object, None if it cannot be reset."""
+    
+    
+    def __init__(self, controller: str, filename_v1, filename_v2: str):
+        self.fd = None
+        filename, reset = (filename_v2, b"reset\n") if cgroup_v2() else (filename_v1, b"0\n")
+        if filename is None:
+            return
+        try:
+            self.fd = os.open(cgroup_path(controller, filename), os.O_RDWR)
+            os.write(self.fd, reset)
+        except OSError:
+            self.close()
+    
+    
+    def value(self):
+        if self.fd is None:
+            return None
+        try:
+            return int(os.pread(self.fd, 64, 0).strip())
+        except (OSError, ValueError):
+            return None
+    
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+class Meter:
+    """Measure the resources used by the container between the creation of this object and the
+    call to 'stop()'. Same as the one of sandbox/cgroups.py, from inside the container."""
+    
+    
+    def __init__(self):
+        self.memory = Peak("memory", "memory.max_usage_in_bytes", "memory.peak")
+        self.pids = Peak("pids", None, "pids.peak")
+        self.cpu = cpu_times()
+        self.io = io_bytes()
+    
+    
+    def stop(self):
+        """Return the resources used since the creation of this meter, None if the cgroup cannot
+        be read."""
+        cpu, io = cpu_times(), io_bytes()
+        usage = {
+            "cpu_user":    None,
+            "cpu_system":  None,
+            "memory_peak": self.memory.value(),
+            "pids_peak":   self.pids.value(),
+            "io_read":     None,
+            "io_write":    None,
+        }
+        self.memory.close()
+        self.pids.close()
+        if cpu is None or self.cpu is None:
+            return None
+        usage["cpu_user"] = round(max(cpu[0] - self.cpu[0], 0), 6)
+        usage["cpu_system"] = round(max(cpu[1] - self.cpu[1], 0), 6)
+        if io is not None and self.io is not None:
+            usage["io_read"] = max(io[0] - self.io[0], 0)
+            usage["io_write"] = max(io[1] - self.io[1], 0)
+        return usage
+
+
+
+def execute(command: str, environ: dict, timeout: float, on_output=None, capture=None,
+            kill: bool = False, resources: bool = False) -> dict:
+    """Execute <command> with bash, killing its process group after <timeout> seconds.
+    
+    If <on_output> is given, it is called with the name of the stream ('stdout' or 'stderr') and
+    each chunk of output as soon as it is read, instead of returning the whole output.
+    
+    Only the output kept by <capture> (a Capture) is returned or given to <on_output>. If <kill>
+    is True, the command is killed as soon as its output exceeds the limits of <capture>.
+    
+    If <resources> is True, the result also contains the resources used by the command (see
+    Meter)."""
+    global _BUSY
+    
+    if capture is None:
+        capture = Capture()
+    
+    env = dict(os.environ)
+    env.update(environ)
+    deadline = time.monotonic() + timeout
+    meter = Meter() if resources else None
+    
+    _BUSY = True
+    try:
+        process = subprocess.Popen(
+            ["bash", "-c", command], env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, start_new_session=True
+        )
+    except Exception:
+        _BUSY = False
+        raise
+    
+    try:
+        names = {process.stdout: "stdout", process.stderr: "stderr"}
+        output = {"stdout": bytearray(), "stderr": bytearray()}
+        timed_out = exceeded = False
+        with selectors.DefaultSelector() as selector:
+            for pipe in names:
+                selector.register(pipe, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+                events = selector.select(min(remaining, POLL_INTERVAL))
+                if not events and process.poll() is not None:
+                    break  # Output held open by a background process
+                for key, _ in events:
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    name = names[key.fileobj]
+                    data = capture.keep(name, data)
+                    if data and on_output is not None:
+                        on_output(name, data)
+                    elif data:
+                        output[name] += data
+                if kill and capture.exceeded:
+                    exceeded = True
+                    break
+        
+        if exceeded:
+            kill_group(process)
+        elif not timed_out:
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                timed_out = True
+        
+        if timed_out:
+            kill_group(process)
+        # Like 'docker exec', a process killed by a signal exits with 128 + <signal>.
+        exit_code = process.returncode if process.returncode >= 0 else 128 - process.returncode
+        result = {
+            "exit_code": exit_code,
+            "stdout":    base64.b64encode(output["stdout"]).decode(),
+            "stderr":    base64.b64encode(output["stderr"]).decode(),
+            "timed_out": timed_out,
+            "exceeded":  exceeded,
+            "bytes":     capture.written,
+            "truncated": capture.truncated,
+        }
+        if meter is not None:
+            result["resources"] = meter.stop()
+        return result
+    finally:
+        if process.poll() is None:  # Interrupted by an exception
+            kill_group(process)
+        process.stdout.close()
+        process.stderr.close()
+        _BUSY = False
+        reap()
+
+
+
+def kill_group(process: subprocess.Popen):
+    """Kill the process group of <process> and wait for it."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+
+def execute_all(commands: list, timeout: float, total: int = None, kill: bool = False,
+                resources: bool = False) -> list:
+    """Execute each command of <commands> until one fails, within a total of <timeout> seconds,
+    keeping at most <total> bytes of their output.
+    
+    A command fails if it timed out, if it was killed because of its output or if its exit code
+    is not 0, unless its 'ignore_failure' is true. Each command is given the minimum between its
+    own timeout and the remaining time."""
+    results = list()
+    for command in commands:
+        limit = min(command["timeout"], timeout)
+        capture = Capture(command.get("limit"), total)
+        start = time.monotonic()
+        if limit <= 0:
+            result = {
+                "exit_code": None, "stdout": "", "stderr": "", "timed_out": True,
+                "exceeded":  False, "bytes": capture.written, "truncated": capture.truncated,
+            }
+            if resources:
+                result["resources"] = None
+        else:
+            result = execute(
+                command["command"], command.get("environ", {}), limit, capture=capture, kill=kill,
+                resources=resources
+            )
+        elapsed = time.monotonic() - start
+        result["timeout"] = limit
+        result["time"] = min(elapsed, max(limit, 0)) if result["timed_out"] else elapsed
+        results.append(result)
+        
+        failed = result["timed_out"] or result["exceeded"] or result["exit_code"] != 0
+        if failed and not command.get("ignore_failure", False):
+            break
+        timeout -= result["time"]
+        if total is not None:
+            total -= sum(capture.kept.values())
+    return results
+
+
+
+def process(request: dict) -> dict:
+    """Execute the command, or the list of commands, of <request>, returning the response."""
+    if "commands" in request:
+        results = execute_all(
+            request["commands"], request["timeout"], request.get("total"),
+            request.get("kill", False), request.get("resources", False)
+        )
+        return {"results": results}
+    return execute(
+        request["command"], request.get("environ", {}), request["timeout"],
+        capture=Capture(request.get("limit"), request.get("total")),
+        kill=request.get("kill", False), resources=request.get("resources", False)
+    )
+
+
+
+def handle(connection: socket.socket):
+    """Execute the command received through <connection> and send back its result.
+    
+    If the request contains '"stream": true', the output is sent as it is read, see
+    'streamed()'."""
+    with connection, connection.makefile("rwb") as stream:
+        request = json.loads(stream.readline().decode())
+        if request.get("stream"):
+            response = streamed(connection, stream, request)
+        else:
+            response = process(request)
+        stream.write(json.dumps(response).encode() + b"\n")
+        stream.flush()
+
+
+
+def streamed(connection: socket.socket, stream, request: dict) -> dict:
+    """Execute the command of <request>, sending each chunk of its output through <stream> as
+    a JSON line {"<stdout or stderr>": "<base64>"}, returns the final response.
+    
+    Writing is bounded by the command's deadline, so that a client which stops reading cannot
+    prevent the command from being killed: it is killed as soon as a write times out."""
+    deadline = time.monotonic() + request["timeout"]
+    
+    def on_output(name: str, data: bytes):
+        connection.settimeout(max(deadline - time.monotonic(), 0.001))
+        stream.write(json.dumps({name: base64.b64encode(data).decode()}).encode() + b"\n")
+        stream.flush()
+    
+    capture = Capture(request.get("limit"), request.get("total"))
+    response = execute(
+        request["command"], request.get("environ", {}), request["timeout"], on_output, capture,
+        request.get("kill", False), request.get("resources", False)
+    )
+    connection.settimeout(None)
+    return response
+
+
+
+def serve(path: str):
+    """Listen on the unix socket <path> and handle connections one at a time."""
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    
+    signal.signal(signal.SIGCHLD, reap)
+    while True:
+        connection, _ = server.accept()
+        try:
+            handle(connection)
+        except Exception as e:  # The agent must never die, the container would stop
+            print("sandbox agent: %s: %s" % (type(e).__name__, e), file=sys.stderr)
+
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--batch":
+        print(json.dumps(process(json.loads(base64.b64decode(sys.argv[2]).decode()))))
+    else:
+        serve(sys.argv[1])
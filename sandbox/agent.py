@@ -0,0 +1,278 @@
+# agent.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Client of the execution agent running inside the containers (see docker/agent.py).
+
+When DOCKER_AGENT is True, the main process of each container is an agent listening on a unix
+socket, in a directory bind-mounted from [DOCKER_VOLUME_HOST_BASEDIR]/.agents/<container's name>/.
+Commands sent through this socket are executed without the round-trips of 'docker exec' to the
+Docker daemon (create, start, attach and inspect).
+
+The directory of the socket is writable from inside the container, commands could thus replace
+the socket with their own. The identity of the socket (see 'identity()') is recorded when the
+container is acquired, commands being executed through 'docker exec' if it changed, and a
+container whose directory contains anything else than this socket is recreated when released."""
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import stat
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import trash
+
+
+AGENTS_DIRNAME = ".agents"
+
+# Path of the agent's script and of its socket inside the container.
+SCRIPT = os.path.join(settings.BASE_DIR, "docker", "agent.py")
+CONTAINER_SCRIPT = "/utils/agent.py"
+CONTAINER_DIRECTORY = "/run/agent"
+SOCKET_NAME = "agent.sock"
+
+# Time (in seconds) given to the agent to answer in addition to the command's timeout.
+TIMEOUT_MARGIN = 5
+
+# Maximum length of an argument of a command on Linux (MAX_ARG_STRLEN).
+MAX_BATCH_ARGUMENT = 131072 - 1
+
+
+
+def directory(name: str) -> str:
+    """Return the path of the directory holding the socket of the agent of the container
+    <name>."""
+    return os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, AGENTS_DIRNAME, name)
+
+
+
+def socket_path(name: str) -> str:
+    """Return the path of the socket of the agent of the container <name>."""
+    return os.path.join(directory(name), SOCKET_NAME)
+
+
+
+def identity(path: str) -> Optional[Tuple[int, int, int]]:
+    """Return the device, inode and change time of the socket <path>, None if it is not a
+    socket."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode):
+        return None
+    return st.st_dev, st.st_ino, st.st_ctime_ns
+
+
+
+def tampered(name: str, expected: Optional[Tuple[int, int, int]]) -> bool:
+    """Return whether the directory of the agent of the container <name> contains anything else
+    than the socket whose identity is <expected>, or anything at all if <expected> is None."""
+    try:
+        entries = os.listdir(directory(name))
+    except FileNotFoundError:
+        return True
+    if expected is None:
+        return bool(entries)
+    return entries != [SOCKET_NAME] or identity(socket_path(name)) != expected
+
+
+
+def volumes(name: str) -> dict:
+    """Return the volumes to mount in the container <name> for its agent."""
+    return {
+        SCRIPT:          {
+            "bind": CONTAINER_SCRIPT,
+            "mode": "ro",
+        },
+        directory(name): {
+            "bind": CONTAINER_DIRECTORY,
+            "mode": "rw",
+        },
+    }
+
+
+
+def command() -> list:
+    """Return the command of the containers, starting the agent as their main process.
+    
+    Containers whose image does not provide python3 start bash as usual, commands being then
+    executed through 'docker exec'."""
+    path = os.path.join(CONTAINER_DIRECTORY, SOCKET_NAME)
+    return [
+        "sh", "-c",
+        f"command -v python3 >/dev/null && exec python3 {CONTAINER_SCRIPT} {path}; exec bash"
+    ]
+
+
+
+def version() -> str:
+    """Return a hash of the agent's script, containers must be recreated when it changes."""
+    with open(SCRIPT, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+
+def create(name: str):
+    """Create an empty directory for the socket of the agent of the container <name>."""
+    path = directory(name)
+    if os.path.isdir(path):
+        trash.discard(path)
+    os.makedirs(path)
+
+
+
+def discard(name: str):
+    """Remove the directory of the agent of the container <name>."""
+    path = directory(name)
+    if os.path.isdir(path):
+        trash.discard(path)
+
+
+
+def clean(kept: Iterable[str]):
+    """Remove the directories of every agent but the ones of the containers in <kept>."""
+    root = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, AGENTS_DIRNAME)
+    if not os.path.isdir(root):
+        return
+    kept = set(kept)
+    for entry in os.scandir(root):
+        if entry.name not in kept:
+            trash.discard(entry.path)
+
+
+
+def _request(path: str, request: dict, timeout: float) -> Optional[dict]:
+    """Send <request> to the agent listening on the unix socket <path>, returning its response,
+    or None if the agent cannot be reached."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except OSError:
+            return None
+        
+        sock.settimeout(timeout + TIMEOUT_MARGIN)
+        with sock.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode() + b"\n")
+            stream.flush()
+            line = stream.readline()
+        if not line:
+            raise ConnectionError("The agent closed the connection without answering")
+        return json.loads(line)
+    finally:
+        sock.close()
+
+
+
+def decode(result: dict) -> dict:
+    """Return the execution (see executor.Command.result()) described by a result sent by the
+    agent, decoding its output."""
+    executed = dict(result)
+    executed["stdout"] = base64.b64decode(result["stdout"])
+    executed["stderr"] = base64.b64decode(result["stderr"])
+    return executed
+
+
+
+def execute(path: str, command: str, environ: dict, timeout: float, limit: Optional[int] = None,
+            total: Optional[int] = None, kill: bool = False,
+            resources: bool = False) -> Optional[dict]:
+    """Execute <command> through the agent listening on the unix socket <path>.
+    
+    At most <limit> bytes of each of stdout and stderr, and <total> bytes of both, are kept (None
+    means no limit). If <kill> is True, the command is killed as soon as its output exceeds these
+    limits. If <resources> is True, the execution contains the resources used by the command.
+    
+    Returns the execution (see 'decode()'), or None if the agent cannot be reached, in which case
+    the command has not been executed."""
+    request = {
+        "command": command, "environ": environ, "timeout": timeout, "limit": limit,
+        "total":   total, "kill": kill, "resources": resources,
+    }
+    response = _request(path, request, timeout)
+    return None if response is None else decode(response)
+
+
+
+def stream(path: str, command: str, environ: dict, timeout: float, limit: Optional[int] = None,
+           total: Optional[int] = None, kill: bool = False,
+           resources: bool = False) -> Optional[Iterator[Tuple[str, Any]]]:
+    """Execute <command> through the agent listening on the unix socket <path>, streaming its
+    output, <limit>, <total>, <kill> and <resources> being the same as in 'execute()'.
+    
+    Returns None if the agent cannot be reached, in which case the command has not been executed.
+    Otherwise, returns an iterator yielding ('stdout', <bytes>) and ('stderr', <bytes>) as soon
+    as the command writes them, and finally ('exit', <execution>), <execution> being the same as
+    the one returned by 'execute()' without its output."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    
+    def events() -> Iterator[Tuple[str, Any]]:
+        try:
+            sock.settimeout(timeout + TIMEOUT_MARGIN)
+            request = {
+                "command": command, "environ": environ, "timeout": timeout, "limit": limit,
+                "total":   total, "kill": kill, "resources": resources, "stream": True,
+            }
+            with sock.makefile("rwb") as f:
+                f.write(json.dumps(request).encode() + b"\n")
+                f.flush()
+                for line in f:
+                    event = json.loads(line)
+                    if "exit_code" in event:
+                        del event["stdout"], event["stderr"]
+                        yield "exit", event
+                        return
+                    name, data = next(iter(event.items()))
+                    yield name, base64.b64decode(data)
+            raise ConnectionError("The agent closed the connection without answering")
+        finally:
+            sock.close()
+    
+    return events()
+
+
+
+def execute_all(path: str, commands: List[dict], timeout: float, total: Optional[int] = None,
+                kill: bool = False, resources: bool = False) -> Optional[List[dict]]:
+    """Execute <commands> (dicts with the keys 'command', 'environ', 'timeout', 'limit' and
+    'ignore_failure') until one fails, through the agent listening on the unix socket <path>.
+    
+    The commands share <timeout> seconds and at most <total> bytes of output are kept (None means
+    no limit). If <kill> is True, a command is killed as soon as its output exceeds the limits.
+    If <resources> is True, the result of each command contains the resources it used.
+    
+    Returns the result of each executed command (see docker/agent.py), or None if the agent
+    cannot be reached, in which case no command has been executed."""
+    request = {
+        "commands": commands, "timeout": timeout, "total": total, "kill": kill,
+        "resources": resources,
+    }
+    response = _request(path, request, timeout)
+    return None if response is None else response["results"]
+
+
+
+def batch_command(commands: List[dict], timeout: float, total: Optional[int] = None,
+                  kill: bool = False, resources: bool = False) -> Optional[List[str]]:
+    """Return the command executing <commands> through a single 'docker exec' of the agent's
+    script (see 'execute_all()'), or None if they cannot fit in its arguments."""
+    request = {
+        "commands": commands, "timeout": timeout, "total": total, "kill": kill,
+        "resources": resources,
+    }
+    encoded = base64.b64encode(json.dumps(request).encode()).decode()
+    if len(encoded) > MAX_BATCH_ARGUMENT:
+        return None
+    return ["python3", CONTAINER_SCRIPT, "--batch", encoded]
@@ -8,6 +8,7 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from django.apps import AppConfig
 from django.conf import settings
 
+from sandbox.containers import autoscale
 from sandbox.tasks import refresh_external_libs, remove_expired_env
 
 
@@ -21,7 +22,14 @@ class SandboxConfig(AppConfig):
         Download/update external lib at app's startup and configure a scheduled task to update
         them.
         
-        cheduled task to remove expired environment."""
+        cheduled task to remove expired environment.
+        
+        Scheduled task to grow or shrink the pool of containers if DOCKER_AUTOSCALE is True.
+        
+        Nothing is done when running the 'pool' management command."""
+        if settings.POOL_COMMAND:
+            return
+        
         refresh_external_libs()
         
         scheduler = BackgroundScheduler(job_defaults={
@@ -31,4 +39,6 @@ class SandboxConfig(AppConfig):
         })
         scheduler.add_job(refresh_external_libs, trigger=settings.EXTERNAL_LIBRARIES_CRON_TRIGGER)
         scheduler.add_job(remove_expired_env, 'cron', minute=30)
+        if settings.DOCKER_AUTOSCALE:
+            scheduler.add_job(autoscale, 'interval', seconds=settings.DOCKER_AUTOSCALE_INTERVAL)
         scheduler.start()
@@ -0,0 +1,194 @@
+# archives.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Codecs of the archives of the environments.
+
+Environments saved by the executions are written with the codec ENVIRONMENT_CODEC:
+    - 'gzip' - [ENVIRONMENT_ROOT]/<uuid4>.tgz, compressed with zlib.
+    - 'zstd' - [ENVIRONMENT_ROOT]/<uuid4>.tar.zst, compressed with Zstandard (requires the package
+               'zstandard'), several times faster than zlib for a similar ratio.
+    - 'tar'  - [ENVIRONMENT_ROOT]/<uuid4>.tar, not compressed, for fast disks.
+
+Archives are read whatever their codec, detected from their first bytes, so that environments
+uploaded as '.tgz' (or any other codec) and environments saved before ENVIRONMENT_CODEC changed can
+still be used. Nothing is converted in advance: an environment is only converted when a client
+downloads it with another codec (see 'convert()')."""
+
+import abc
+import contextlib
+import gzip
+import shutil
+import tarfile
+import tempfile
+from typing import BinaryIO, Dict, Iterator, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+
+class Codec(abc.ABC):
+    """Compression of an archive, <magic> being the first bytes of the archives it compressed."""
+    
+    
+    def __init__(self, name: str, extension: str, content_type: str, magic: bytes):
+        self.name = name
+        self.extension = extension
+        self.content_type = content_type
+        self.magic = magic
+    
+    
+    def __repr__(self):
+        return f"<Codec '{self.name}'>"
+    
+    
+    @abc.abstractmethod
+    def reader(self, file: BinaryIO) -> BinaryIO:
+        """Return a file decompressing <file>, closing it does not close <file>."""
+    
+    
+    @abc.abstractmethod
+    def writer(self, file: BinaryIO) -> BinaryIO:
+        """Return a file compressing into <file>, closing it does not close <file>."""
+
+
+
+class _Gzip(Codec):
+    
+    def reader(self, file: BinaryIO) -> BinaryIO:
+        return gzip.GzipFile(fileobj=file, mode="rb")
+    
+    
+    def writer(self, file: BinaryIO) -> BinaryIO:
+        level = settings.ENVIRONMENT_CODEC_LEVEL
+        return gzip.GzipFile(fileobj=file, mode="wb", compresslevel=9 if level is None else level)
+
+
+
+class _Zstd(Codec):
+    
+    @staticmethod
+    def _zstandard():
+        try:
+            import zstandard
+        except ImportError:  # pragma: no cover
+            raise ImproperlyConfigured("The package 'zstandard' is needed by the codec 'zstd'")
+        return zstandard
+    
+    
+    def reader(self, file: BinaryIO) -> BinaryIO:
+        decompressor = self._zstandard().ZstdDecompressor()
+        return decompressor.stream_reader(file, read_across_frames=True, closefd=False)
+    
+    
+    def writer(self, file: BinaryIO) -> BinaryIO:
+        level = settings.ENVIRONMENT_CODEC_LEVEL
+        compressor = self._zstandard().ZstdCompressor(level=3 if level is None else level)
+        return compressor.stream_writer(file, closefd=False)
+
+
+
+class _Tar(Codec):
+    
+    def reader(self, file: BinaryIO) -> BinaryIO:
+        return file
+    
+    
+    def writer(self, file: BinaryIO) -> BinaryIO:
+        return file
+
+
+
+CODECS: Dict[str, Codec] = {
+    "gzip": _Gzip("gzip", ".tgz", "application/gzip", b"\x1f\x8b"),
+    "zstd": _Zstd("zstd", ".tar.zst", "application/zstd", b"\x28\xb5\x2f\xfd"),
+    "tar":  _Tar("tar", ".tar", "application/x-tar", b""),
+}
+
+
+
+def get(name: Optional[str] = None) -> Codec:
+    """Return the codec <name>, ENVIRONMENT_CODEC by default."""
+    name = settings.ENVIRONMENT_CODEC if name is None else name
+    if name not in CODECS:
+        raise ImproperlyConfigured(
+            f"Unknown codec {name!r}, must be one of {', '.join(map(repr, CODECS))}"
+        )
+    return CODECS[name]
+
+
+
+def detect(file: BinaryIO) -> Codec:
+    """Return the codec of the archive <file>, which must be seekable, from its first bytes."""
+    position = file.tell()
+    head = file.read(4)
+    file.seek(position)
+    for codec in CODECS.values():
+        if codec.magic and head.startswith(codec.magic):
+            return codec
+    return CODECS["tar"]
+
+
+
+@contextlib.contextmanager
+def open_tar(file: BinaryIO, mode: str, codec: Optional[Codec] = None) -> Iterator[tarfile.TarFile]:
+    """Open the archive <file> as a stream, to read its members if <mode> is 'r' (its codec being
+    detected if <codec> is not given), or to add members if <mode> is 'w' (with ENVIRONMENT_CODEC
+    if <codec> is not given). <file> is not closed."""
+    if mode == "r":
+        stream = (codec or detect(file)).reader(file)
+    else:
+        stream = (codec or get()).writer(file)
+    
+    try:
+        with tarfile.open(fileobj=stream, mode=f"{mode}|") as tar:
+            yield tar
+    finally:
+        if stream is not file:
+            stream.close()
+
+
+
+def is_archive(file: BinaryIO) -> bool:
+    """Return whether <file>, which must be seekable, is a tar archive written with one of the
+    codecs. The whole archive is read, its cursor being then put back where it was."""
+    position = file.tell()
+    try:
+        with open_tar(file, "r") as tar:
+            for _ in tar:
+                pass
+        return True
+    except Exception:  # Each codec raises its own exceptions
+        return False
+    finally:
+        file.seek(position)
+
+
+
+def convert(file: BinaryIO, codec: Codec, dest: Optional[BinaryIO] = None) -> BinaryIO:
+    """Write the archive <file> with <codec> into <dest>, returning <dest>, its cursor set at the
+    start.
+    
+    Only the compression is converted, the tar itself is copied as is. If <dest> is not given, it
+    is a temporary file kept in memory until it exceeds ENVIRONMENT_SPOOL_SIZE bytes."""
+    if dest is None:
+        dest = tempfile.SpooledTemporaryFile(settings.ENVIRONMENT_SPOOL_SIZE)
+    
+    source = detect(file)
+    if source is codec:
+        shutil.copyfileobj(file, dest)
+    else:
+        reader, writer = source.reader(file), codec.writer(dest)
+        try:
+            shutil.copyfileobj(reader, writer)
+        finally:
+            if writer is not dest:
+                writer.close()
+            if reader is not file:
+                reader.close()
+    
+    dest.seek(0)
+    return dest
@@ -0,0 +1,199 @@
+# batch.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Execute many configs of '/execute/' in a single request to '/execute/batch/'.
+
+Each config is parsed as by '/execute/' and can use its own environment, uploaded along with the
+request, or share one with other configs: its field 'upload' is the name of one of the files of
+the request, which are checked as '/uploads/<sha256>/' does (see 'utils.check_upload()') and added
+to the store of environments (see store.py) once every config is valid. Configs are executed
+concurrently, each in its own sandbox, at most 'concurrency' at a time, their results being
+returned in the order of the configs."""
+
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Collection, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.http import HttpRequest
+from django_http_exceptions import HTTPExceptions
+from django_http_exceptions.exceptions import HTTPException
+
+from . import store, utils
+from .containers import Sandbox
+from .executor import Command, Executor
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def _error(status: int, content: str) -> dict:
+    """Return the result of a config whose execution failed with the HTTP <status>."""
+    return {"error": {"status": status, "content": content}}
+
+
+
+class Job:
+    """A config of a batch, parsed as by '/execute/'."""
+    
+    
+    def __init__(self, request: HttpRequest, config: dict, uploads: Collection[str]):
+        if not isinstance(config, dict):
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f'config must be an object, not {type(config)}'
+            )
+        
+        self.config = dict(config)
+        self.limits = utils.parse_limits(config)
+        self.commands = Command.from_config(config, self.limits["cpu_time"])
+        self.cases = Command.cases_from_config(config, self.limits["cpu_time"])
+        self.result_path = utils.parse_result_path(config)
+        self.save = utils.parse_save(config)
+        self.priority = utils.parse_priority(config)
+        self.client = utils.parse_client(request, config)
+        self.max_wait = utils.parse_max_wait(config)
+        
+        # Name of the file of the request used as environment, stored by 'Batch.from_request()'
+        self.upload: Optional[str] = config.get("upload")
+        if "upload" in config:
+            if config["upload"] not in uploads:
+                raise HTTPExceptions.BAD_REQUEST.with_content(
+                    f'upload must be the name of a file of the request, not {config["upload"]!r}'
+                )
+            if "sha256" in config:
+                raise HTTPExceptions.BAD_REQUEST.with_content(
+                    "A config cannot contain both 'upload' and 'sha256'"
+                )
+    
+    
+    def run(self) -> dict:
+        """Acquire a sandbox and execute this config, returning the response of '/execute/', or
+        {"error": {"status": <HTTP status>, "content": <str>}} if it could not be executed."""
+        try:
+            env = utils.store_env(None, self.config)
+        except HTTPException as e:
+            return _error(e.response.status_code, e.response.content.decode())
+        except Exception as e:
+            logger.exception("Could not store the environment of a config of a batch")
+            return _error(500, str(e))
+        
+        try:
+            sandbox = Sandbox.acquire(self.priority, self.client, self.max_wait)
+        except HTTPException as e:
+            env.close()
+            return _error(e.response.status_code, e.response.content.decode())
+        
+        try:
+            executor = Executor(
+                self.commands, sandbox, env, self.result_path, self.save, self.limits, self.cases
+            )
+            return executor.execute()
+        except Exception as e:
+            logger.exception("An error occurred while executing a config of a batch")
+            return _error(500, str(e))
+        finally:
+            sandbox.release()
+
+
+
+class Batch:
+    """Execute the configs of a request to '/execute/batch/' concurrently."""
+    
+    
+    def __init__(self, jobs: List[Job], concurrency: int):
+        self.jobs = jobs
+        self.concurrency = concurrency
+    
+    
+    @classmethod
+    def from_request(cls, request: HttpRequest, config: dict) -> 'Batch':
+        """Parse the config of a request to '/execute/batch/', an object with the fields
+        'configs', the list of configs to execute, and optionally 'concurrency', defaulting to
+        and bounded by settings.BATCH_MAX_CONCURRENCY.
+        
+        Raises HTTPExceptions.BAD_REQUEST if the config or any of its configs is invalid, or the
+        exception of 'utils.check_upload()' if one of the files of the request cannot be stored, in
+        which case no config has been executed and nothing has been stored."""
+        configs = config.get("configs")
+        if not isinstance(configs, list) or not configs:
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f"configs must be a non-empty list, not {configs!r}"
+            )
+        if len(configs) > settings.BATCH_MAX_CONFIGS:
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f"A batch cannot contain more than {settings.BATCH_MAX_CONFIGS} configs, "
+                f"got {len(configs)}"
+            )
+        
+        concurrency = config.get("concurrency", settings.BATCH_MAX_CONCURRENCY)
+        if (
+            not isinstance(concurrency, int) or isinstance(concurrency, bool)
+            or not 0 < concurrency <= settings.BATCH_MAX_CONCURRENCY
+        ):
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f"concurrency must be an integer between 1 and {settings.BATCH_MAX_CONCURRENCY}, "
+                f"not {concurrency!r}"
+            )
+        
+        try:
+            for name, file in request.FILES.items():
+                utils.check_upload(request, name, file)
+            
+            jobs = list()
+            for index, c in enumerate(configs):
+                try:
+                    jobs.append(Job(request, c, request.FILES.keys()))
+                except HTTPException as e:
+                    raise HTTPExceptions.BAD_REQUEST.with_content(
+                        f"configs[{index}]: {e.response.content.decode()}"
+                    )
+            
+            uploads = {name: store.put(file) for name, file in request.FILES.items()}
+        finally:
+            for file in request.FILES.values():
+                file.close()
+        
+        for job in jobs:
+            if job.upload is not None:
+                job.config["sha256"] = uploads[job.upload]
+        
+        return cls(jobs, concurrency)
+    
+    
+    def results(self) -> Iterator[dict]:
+        """Execute the configs, yielding their results (see 'Job.run()') in their order.
+        
+        Configs are executed by at most <self.concurrency> threads, so that a batch cannot hold
+        more sandboxes. If the iteration is stopped, configs which did not start are
+        cancelled."""
+        pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix="batch")
+        futures: List[Future] = [pool.submit(job.run) for job in self.jobs]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+    
+    
+    def execute(self) -> dict:
+        """Execute the configs, returning the result of each one in 'results'."""
+        start = time.time()
+        results = list(self.results())
+        return {"results": results, "total_time": time.time() - start}
+    
+    
+    def stream(self) -> Iterator[Tuple[str, dict]]:
+        """Execute the configs, yielding ('result', {'index', ...}) as soon as the result of a
+        config is available and all of the previous ones have been yielded, and finally
+        ('end', {'total_time'})."""
+        start = time.time()
+        for index, result in enumerate(self.results()):
+            yield "result", {"index": index, **result}
+        yield "end", {"total_time": time.time() - start}
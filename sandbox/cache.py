@@ -0,0 +1,362 @@
+# cache.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Cache of extracted environments.
+
+An environment used by many executions (an environment saved by a previous execution and referred
+to by the field 'environment' of their config, or one of the store, see store.py) is extracted once
+into [DOCKER_VOLUME_HOST_BASEDIR]/.cache/, and then materialised into the working directory of each
+sandbox by cloning its files (copy-on-write, on filesystems supporting it such as btrfs or XFS) or,
+if the filesystem cannot clone them, by copying them without decompressing the archive again. Files
+are never hard linked: the commands run as the owner of the cached files, and could thus make them
+writable again to modify the cached environment in place.
+
+An environment is cached the second time it is used, so that environments used once do not evict
+the other ones. Least recently used environments are evicted once the cache exceeds
+ENVIRONMENT_CACHE_SIZE bytes or ENVIRONMENT_CACHE_COUNT environments, and environments whose archive
+has expired are invalidated by 'remove_expired()'.
+
+Each process has its own cache, whose statistics are returned by 'stats()'. Its directory is locked
+as long as the process is alive, the directories of dead processes being removed when a process
+creates its own (see 'cache_dir()')."""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Optional, Set, Tuple
+
+from django.conf import settings
+
+from . import archives, trash
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIRNAME = ".cache"
+
+# ioctl cloning a file on filesystems supporting copy-on-write (see ioctl_ficlone(2)).
+FICLONE = 0x40049409
+
+# Errors of FICLONE when the files cannot be cloned, in which case they are copied.
+_CLONE_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV}
+
+# Directory of the cache of this process in [DOCKER_VOLUME_HOST_BASEDIR]/.cache/.
+_TOKEN = uuid.uuid4().hex
+# Descriptors locking the directories of the cache of this process, by path.
+_LOCKED: Dict[str, int] = dict()
+_LOCKED_LOCK = threading.Lock()
+
+_LOCK = threading.Lock()
+# Entries by path, device and inode of their archive.
+_ENTRIES: 'OrderedDict[Tuple[str, int, int], _Entry]' = OrderedDict()
+# Archives used once, an archive being cached when used again.
+_SEEN: 'OrderedDict[Tuple[str, int, int], None]' = OrderedDict()
+_STATS = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+
+
+class _Entry:
+    """An environment extracted in <path>, <names> being the names of the members of its
+    archive."""
+    
+    
+    def __init__(self, path: str, names: Set[str], size: int):
+        self.path = path
+        self.names = names
+        self.size = size
+        # Number of sandboxes in which the environment is being materialised.
+        self.users = 0
+
+
+
+def _remove_dead(root: str):
+    """Remove the directories of <root> which are not locked, their process being dead.
+    
+    Directories being created (whose name starts with a dot) are ignored."""
+    for entry in os.scandir(root):
+        if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            fd = os.open(entry.path, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:  # pragma: no cover
+            continue  # Removed concurrently
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            trash.discard(entry.path)
+            logger.info(f"Removed the cache of a dead process: '{entry.path}'")
+        except BlockingIOError:
+            pass  # The process is alive
+        except FileNotFoundError:  # pragma: no cover
+            pass  # Removed concurrently
+        finally:
+            os.close(fd)
+
+
+
+def cache_dir() -> str:
+    """Return the path of the directory of the cache of this process, creating it if needed.
+    
+    The directory is locked (see flock(2)) until the process exits. It is created under a
+    temporary name and renamed once locked, so that it cannot be taken for the directory of a dead
+    process, which are removed beforehand."""
+    root = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, CACHE_DIRNAME)
+    path = os.path.join(root, _TOKEN)
+    with _LOCKED_LOCK:
+        if path in _LOCKED:
+            if os.path.isdir(path):
+                return path
+            os.close(_LOCKED.pop(path))  # Removed, e.g. when the pool is initialised
+        
+        os.makedirs(root, exist_ok=True)
+        _remove_dead(root)
+        temporary = tempfile.mkdtemp(prefix=".", dir=root)
+        fd = os.open(temporary, os.O_RDONLY | os.O_DIRECTORY)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(temporary, path)
+        _LOCKED[path] = fd
+        return path
+
+
+
+def _clone(source: str, dest: str):
+    """Create <dest> as a copy-on-write clone of <source>, copying it if the filesystem does not
+    support it."""
+    with open(source, "rb") as s, open(dest, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        except OSError as e:
+            if e.errno not in _CLONE_UNSUPPORTED:
+                raise
+    shutil.copyfile(source, dest)
+
+
+
+def _copy_file(source: str, dest: str):
+    """Materialise the regular file <source> as <dest>, keeping its metadata as an extraction
+    would."""
+    _clone(source, dest)
+    _copy_stat(source, dest)
+
+
+
+def _copy_stat(source: str, dest: str):
+    """Copy the permissions, times and, if running as root, owner of <source> to <dest>."""
+    st = os.lstat(source)
+    if os.geteuid() == 0:
+        os.chown(dest, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dest, stat.S_IMODE(st.st_mode))
+    os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+
+def _materialise(entry: _Entry, dest: str, skipped: Set[str]):
+    """Materialise the files of <entry> in <dest>, except the ones whose name is in <skipped>."""
+    skipped = {os.path.normpath(name) for name in skipped}
+    directories = list()
+    for root, dirs, files in os.walk(entry.path):
+        relative = os.path.relpath(root, entry.path)
+        for name in dirs:
+            path = os.path.normpath(os.path.join(relative, name))
+            target = os.path.join(dest, path)
+            if os.path.islink(os.path.join(root, name)):
+                files.append(name)  # Symbolic links to directories are not followed
+            elif not os.path.isdir(target):
+                os.mkdir(target)
+                if path not in skipped:
+                    directories.append((os.path.join(root, name), target))
+        
+        for name in files:
+            path = os.path.normpath(os.path.join(relative, name))
+            if path in skipped:
+                continue
+            source, target = os.path.join(root, name), os.path.join(dest, path)
+            if os.path.lexists(target):
+                os.remove(target)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                _copy_stat(source, target)
+            else:
+                _copy_file(source, target)
+    
+    # Permissions of directories are set last, as an extraction would, since they may be
+    # read-only.
+    for source, target in reversed(directories):
+        _copy_stat(source, target)
+
+
+
+def _extract(archive: BinaryIO) -> Optional[_Entry]:
+    """Extract <archive> into a new entry of the cache, returning None if it cannot be cached
+    (too large, containing files other than directories, regular files and links, or if it cannot
+    be extracted), in which case nothing is left in the cache."""
+    path = os.path.join(cache_dir(), uuid.uuid4().hex)
+    names, size, directories = set(), 0, list()
+    try:
+        with archives.open_tar(archive, "r") as tar:
+            for member in tar:
+                if not (member.isdir() or member.isreg() or member.issym() or member.islnk()):
+                    raise ValueError(f"'{member.name}' cannot be cached")
+                size += member.size if member.isreg() else 0
+                if size > settings.ENVIRONMENT_CACHE_SIZE:
+                    raise ValueError("The environment is larger than the cache")
+                names.add(member.name)
+                tar.extract(member, path, set_attrs=not member.isdir())
+                if member.isdir():
+                    directories.append(member)
+            
+            # Attributes of directories are set last, as 'TarFile.extractall()' does, since they
+            # may be read-only.
+            for member in reversed(directories):
+                target = os.path.join(path, member.name)
+                tar.chown(member, target, False)
+                tar.utime(member, target)
+                tar.chmod(member, target)
+    except Exception as e:  # e.g. tarfile.ReadError or OSError, it is then extracted normally
+        logger.debug(f"Environment not cached: {e}")
+        if os.path.exists(path):
+            trash.discard(path)
+        return None
+    
+    return _Entry(path, names, size)
+
+
+
+def _evict():
+    """Evict the least recently used entries until the cache fits its bounds, entries being
+    materialised cannot be evicted."""
+    size = sum(e.size for e in _ENTRIES.values())
+    for key, entry in list(_ENTRIES.items()):
+        count = len(_ENTRIES)
+        if count <= settings.ENVIRONMENT_CACHE_COUNT and size <= settings.ENVIRONMENT_CACHE_SIZE:
+            break
+        if entry.users:
+            continue
+        del _ENTRIES[key]
+        size -= entry.size
+        _STATS["evictions"] += 1
+        trash.discard(entry.path)
+
+
+
+def _key(path: str, st: os.stat_result) -> Tuple[str, int, int]:
+    """Return the key of the archive <path> whose status is <st>, a new archive created at the same
+    path being a different environment."""
+    return path, st.st_dev, st.st_ino
+
+
+
+def _exists(key: Tuple[str, int, int]) -> bool:
+    """Return whether the archive identified by <key> still exists."""
+    try:
+        return _key(key[0], os.stat(key[0])) == key
+    except FileNotFoundError:
+        return False
+
+
+
+def materialise(source: str, archive: BinaryIO, dest: str,
+                skipped: Set[str]) -> Optional[Set[str]]:
+    """Materialise the environment <archive>, opened from <source>, into <dest>, except the
+    members whose name is in <skipped>, returning the names of its members.
+    
+    Returns None if the environment is not cached and has not been consumed, in which case it must
+    be extracted normally."""
+    if not settings.ENVIRONMENT_CACHE_SIZE or not settings.ENVIRONMENT_CACHE_COUNT:
+        return None
+    
+    key = _key(source, os.fstat(archive.fileno()))
+    with _LOCK:
+        entry = _ENTRIES.get(key)
+        if entry is not None:
+            _ENTRIES.move_to_end(key)
+            entry.users += 1
+            _STATS["hits"] += 1
+        else:
+            _STATS["misses"] += 1
+            if key not in _SEEN:
+                _SEEN[key] = None
+                while len(_SEEN) > settings.ENVIRONMENT_CACHE_COUNT:
+                    _SEEN.popitem(last=False)
+                return None
+    
+    if entry is None:
+        entry = _extract(archive)
+        if entry is None:
+            archive.seek(0)
+            return None
+        with _LOCK:
+            if key in _ENTRIES:  # Cached concurrently
+                trash.discard(entry.path)
+                entry = _ENTRIES[key]
+            else:
+                _ENTRIES[key] = entry
+                _SEEN.pop(key, None)
+            _ENTRIES.move_to_end(key)
+            entry.users += 1
+            _evict()
+    
+    try:
+        _materialise(entry, dest, skipped)
+    except FileNotFoundError:
+        # The cache has been removed (e.g. when the pool is initialised by another process).
+        logger.warning(f"Cached environment of '{source}' not found, it has been invalidated")
+        with _LOCK:
+            if _ENTRIES.get(key) is entry:
+                del _ENTRIES[key]
+        archive.seek(0)
+        return None
+    finally:
+        with _LOCK:
+            entry.users -= 1
+    
+    return entry.names
+
+
+
+def remove_expired():
+    """Invalidate the environments whose archive does not exist anymore."""
+    with _LOCK:
+        for key, entry in list(_ENTRIES.items()):
+            if not _exists(key) and not entry.users:
+                del _ENTRIES[key]
+                _STATS["invalidations"] += 1
+                trash.discard(entry.path)
+        for key in [k for k in _SEEN if not _exists(k)]:
+            del _SEEN[key]
+
+
+
+def clear():
+    """Remove every environment of the cache and reset its statistics."""
+    with _LOCK:
+        for entry in _ENTRIES.values():
+            trash.discard(entry.path)
+        _ENTRIES.clear()
+        _SEEN.clear()
+        for name in _STATS:
+            _STATS[name] = 0
+
+
+
+def stats() -> Dict[str, float]:
+    """Return the statistics of the cache of this process."""
+    with _LOCK:
+        lookups = _STATS["hits"] + _STATS["misses"]
+        return {
+            **_STATS,
+            "hit_rate": _STATS["hits"] / lookups if lookups else 0,
+            "count":    len(_ENTRIES),
+            "size":     sum(e.size for e in _ENTRIES.values()),
+        }
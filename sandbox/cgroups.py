@@ -0,0 +1,247 @@
+# cgroups.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Read the cgroup files of the containers directly from the host.
+
+Both cgroup v1 and cgroup v2 hierarchies, with either the 'cgroupfs' or the 'systemd' cgroup driver
+of docker, are supported. Every function returns None if the value cannot be read (e.g. the cgroup
+filesystem is not mounted at CGROUP_ROOT or is not readable), except 'write()'.
+
+This is much cheaper than Docker's stats API, which samples the usage for about a second before
+answering."""
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+
+def is_v2() -> bool:
+    """Return True if the host uses the unified (v2) cgroup hierarchy."""
+    return os.path.isfile(os.path.join(CGROUP_ROOT, "cgroup.controllers"))
+
+
+
+def container_cgroup(container_id: str, controller: str) -> Optional[str]:
+    """Return the path of the cgroup's directory of <controller> for the container
+    <container_id>, None if it cannot be found.
+    
+    <controller> is ignored on cgroup v2."""
+    if is_v2():
+        candidates = [
+            os.path.join(CGROUP_ROOT, "system.slice", f"docker-{container_id}.scope"),
+            os.path.join(CGROUP_ROOT, "docker", container_id),
+        ]
+    else:
+        candidates = [
+            os.path.join(CGROUP_ROOT, controller, "docker", container_id),
+            os.path.join(CGROUP_ROOT, controller, "system.slice", f"docker-{container_id}.scope"),
+        ]
+    
+    return next((p for p in candidates if os.path.isdir(p)), None)
+
+
+
+def read(container_id: str, controller: str, filename: str) -> Optional[str]:
+    """Return the content of <filename> in the cgroup <controller> of the container
+    <container_id>."""
+    path = container_cgroup(container_id, controller)
+    if path is None:
+        return None
+    
+    try:
+        with open(os.path.join(path, filename)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+
+def read_int(container_id: str, controller: str, filename: str) -> Optional[int]:
+    """Return the content of <filename> in the cgroup <controller> of the container
+    <container_id> as an integer."""
+    content = read(container_id, controller, filename)
+    try:
+        return int(content.strip()) if content is not None else None
+    except ValueError:
+        return None
+
+
+
+def pids_current(container_id: str) -> Optional[int]:
+    """Return the number of processes currently in the container <container_id>."""
+    return read_int(container_id, "pids", "pids.current")
+
+
+
+def _keyed(content: Optional[str]) -> Dict[str, int]:
+    """Parse the lines '<key> <value>' of a flat keyed cgroup file."""
+    values = dict()
+    for line in (content or "").splitlines():
+        key, _, value = line.partition(" ")
+        if value.strip().isdigit():
+            values[key] = int(value)
+    return values
+
+
+
+def cpu_times(container_id: str) -> Optional[Tuple[float, float]]:
+    """Return the CPU time (in seconds) spent in user and system mode by the processes of the
+    container <container_id>."""
+    if is_v2():
+        stat = _keyed(read(container_id, "cpu", "cpu.stat"))
+        if "user_usec" not in stat or "system_usec" not in stat:
+            return None
+        return stat["user_usec"] / 1e6, stat["system_usec"] / 1e6
+    
+    stat = _keyed(read(container_id, "cpuacct", "cpuacct.stat"))
+    if "user" not in stat or "system" not in stat:
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return stat["user"] / ticks, stat["system"] / ticks
+
+
+
+def io_bytes(container_id: str) -> Optional[Tuple[int, int]]:
+    """Return the number of bytes read from and written to block devices by the processes of the
+    container <container_id>."""
+    read_bytes = written_bytes = 0
+    if is_v2():
+        content = read(container_id, "io", "io.stat")
+        if content is None:
+            return None
+        for line in content.splitlines():
+            fields = dict(f.split("=", 1) for f in line.split()[1:] if "=" in f)
+            read_bytes += int(fields.get("rbytes", 0))
+            written_bytes += int(fields.get("wbytes", 0))
+        return read_bytes, written_bytes
+    
+    content = read(container_id, "blkio", "blkio.throttle.io_service_bytes")
+    if content is None:
+        return None
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == "Read":
+            read_bytes += int(fields[2])
+        elif len(fields) == 3 and fields[1] == "Write":
+            written_bytes += int(fields[2])
+    return read_bytes, written_bytes
+
+
+
+class Peak:
+    """Peak value of a gauge of the cgroup of a container (memory or number of processes) since
+    the creation of this object.
+    
+    The peak is reset through a file descriptor kept open until 'close()': on cgroup v2, the reset
+    only applies to reads through this descriptor. The peak is None if it cannot be reset (e.g.
+    the file is not writable or the kernel does not support it), as the peak since the creation
+    of the container would be meaningless."""
+    
+    
+    def __init__(self, container_id: str, controller: str, filename_v1: Optional[str],
+                 filename_v2: str):
+        self.fd = None
+        filename, reset = (filename_v2, b"reset\n") if is_v2() else (filename_v1, b"0\n")
+        path = container_cgroup(container_id, controller)
+        if path is None or filename is None:
+            return
+        
+        try:
+            self.fd = os.open(os.path.join(path, filename), os.O_RDWR)
+            os.write(self.fd, reset)
+        except OSError:
+            self.close()
+    
+    
+    def value(self) -> Optional[int]:
+        """Return the peak value, None if it could not be reset."""
+        if self.fd is None:
+            return None
+        try:
+            return int(os.pread(self.fd, 64, 0).strip())
+        except (OSError, ValueError):
+            return None
+    
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+class Meter:
+    """Measure the resources used by the container <container_id> between the creation of this
+    object and the call to 'stop()'."""
+    
+    
+    def __init__(self, container_id: str):
+        self.container_id = container_id
+        self.memory = Peak(container_id, "memory", "memory.max_usage_in_bytes", "memory.peak")
+        self.pids = Peak(container_id, "pids", None, "pids.peak")
+        self.cpu = cpu_times(container_id)
+        self.io = io_bytes(container_id)
+    
+    
+    def stop(self) -> Dict[str, Optional[float]]:
+        """Return the resources used since the creation of this meter:
+            - 'cpu_user' / 'cpu_system': CPU time (in seconds) spent in user / system mode.
+            - 'memory_peak': Peak memory usage (in bytes).
+            - 'pids_peak': Peak number of processes.
+            - 'io_read' / 'io_write': Bytes read from / written to block devices.
+        
+        Values which could not be measured are None."""
+        cpu, io = cpu_times(self.container_id), io_bytes(self.container_id)
+        usage = {
+            "cpu_user":    None,
+            "cpu_system":  None,
+            "memory_peak": self.memory.value(),
+            "pids_peak":   self.pids.value(),
+            "io_read":     None,
+            "io_write":    None,
+        }
+        self.memory.close()
+        self.pids.close()
+        if cpu is not None and self.cpu is not None:
+            usage["cpu_user"] = round(max(cpu[0] - self.cpu[0], 0), 6)
+            usage["cpu_system"] = round(max(cpu[1] - self.cpu[1], 0), 6)
+        if io is not None and self.io is not None:
+            usage["io_read"] = max(io[0] - self.io[0], 0)
+            usage["io_write"] = max(io[1] - self.io[1], 0)
+        return usage
+
+
+
+def meter(container_id: str) -> Optional[Meter]:
+    """Start measuring the resources used by the container <container_id>, returns None if its
+    cgroup cannot be found."""
+    if container_cgroup(container_id, "cpuacct") is None:
+        return None
+    return Meter(container_id)
+
+
+
+def combine(usages: List[Optional[dict]]) -> Optional[dict]:
+    """Return the resources used by successive executions, as returned by 'Meter.stop()': CPU time
+    and I/O are summed, the peaks are the maximum ones.
+    
+    A value is None if it is None for one of the executions, and None is returned if the usage
+    of one execution is None."""
+    if not usages or any(u is None for u in usages):
+        return None
+    combined = dict()
+    for key in usages[0]:
+        values = [u.get(key) for u in usages]
+        if any(v is None for v in values):
+            combined[key] = None
+        elif key.endswith("_peak"):
+            combined[key] = max(values)
+        else:
+            combined[key] = sum(values)
+    return combined
@@ -4,123 +4,928 @@
 #   - Coumes Quentin <coumes.quentin@gmail.com>
 
 
+import functools
+import hashlib
+import json
 import logging
+import math
 import os
 import queue
-import shutil
-import tarfile
+import random
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
 
 import docker
+import psutil
 from django.conf import settings
 from django_http_exceptions import HTTPExceptions
-from docker.errors import DockerException
+from docker.errors import APIError, DockerException
 from docker.models.containers import Container
 
+from . import agent, archives, cgroups, coordinator, trash
+from .placement import CpuPlacement
+from .scheduler import Scheduler
+
 
 logger = logging.getLogger(__name__)
 
+# Containers ready to be acquired.
 CONTAINERS: "queue.Queue['Sandbox']"
+# Limit the number of containers used simultaneously to the size of the pool (initially
+# DOCKER_COUNT), the remaining containers being spares, see scheduler.py.
+LEASES: Scheduler
+# Pool of threads cleaning or recreating released containers.
+RECYCLER: ThreadPoolExecutor
+# Incremented each time the pool is (re)initialised or rolled out, sandboxes of a previous
+# generation are discarded instead of being put back in CONTAINERS.
+GENERATION = 0
+# Fingerprint of the configuration used to create the containers, see 'container_fingerprint()'.
+FINGERPRINT = ""
+# CPUs assigned to each container, None if DOCKER_CPU_PINNING is False.
+PLACEMENT: Optional[CpuPlacement] = None
+
+# Functions that are executed by the coordinator when called from another process, see
+# 'coordinated()'.
+COORDINATED: Dict[str, Callable] = dict()
+
+# Labels identifying the containers created by the sandbox.
+LABEL_INDEX = "sandbox.index"
+LABEL_FINGERPRINT = "sandbox.fingerprint"
+
+# Where the working directory of each container (see 'Sandbox.envpath') is mounted.
+CONTAINER_ENVPATH = "/home/student"
+
+# Where the directory holding the stdin of the commands (see 'stdin_directory()') is mounted,
+# read-only, and the directory of DOCKER_VOLUME_HOST_BASEDIR holding the one of each container.
+CONTAINER_STDIN_DIRECTORY = "/run/stdin"
+STDIN_DIRNAME = ".stdin"
+
+# Directory of DOCKER_VOLUME_HOST_BASEDIR holding the baseline of the writable layer of each
+# container (see 'Sandbox.layer'), so that it can be checked when the container is adopted.
+LAYERS_DIRNAME = ".layers"
+
+_STATUS_LOCK = threading.Lock()
+# First generation of the pool since the last call to 'initialise_containers()', the counters of
+# _STATUS and LEASES still account for sandboxes of this generation and the following ones.
+_FIRST_GENERATION = 0
+_STATUS = {
+    "running":   0,
+    "recycling": 0,
+    "broken":    0,
+}
+# How released containers have been cleaned, see 'Sandbox._contamination()'.
+_RESETS = {
+    "fast":     0,
+    "restart":  0,
+    "recreate": 0,
+}
+# Indexes of the containers belonging to the pool (spares included).
+_INDEXES: Set[int] = set()
+# (time, wait, rejected, priority) of the last calls to 'Sandbox.acquire()'.
+_WAITS: Deque[Tuple[float, float, bool, str]] = deque(maxlen=1000)
+# Time during which the last released containers have been held, see 'estimated_wait()'.
+_HOLDS: Deque[float] = deque(maxlen=200)
+# Last time the pool was grown and last time it was too busy to be shrunk, see 'autoscale()'.
+_LAST_GROWTH = 0.0
+_LAST_BUSY = 0.0
+# Held while a new generation of containers is being rolled out, see 'rollout()'.
+_ROLLOUT_LOCK = threading.Lock()
+
+
+def coordinated(function: Callable) -> Callable:
+    """Decorate a function so that it is executed by the coordinator of the pool when called from
+    another process, see coordinator.py. Arguments and result must be serializable to JSON."""
+    
+    @functools.wraps(function)
+    def wrapper(*args):
+        if coordinator.is_coordinator():
+            return function(*args)
+        return coordinator.call(function.__name__, *args)
+    
+    COORDINATED[function.__name__] = wrapper
+    return wrapper
+
+
+def _update_status(**deltas: int):
+    """Add each value of <deltas> to the corresponding counter of the pool's status."""
+    with _STATUS_LOCK:
+        for k, v in deltas.items():
+            _STATUS[k] += v
+
+
+def _counted(generation: int) -> bool:
+    """Return whether the counters of _STATUS and LEASES still account for sandboxes of
+    <generation>, i.e. whether the pool has not been reinitialised since."""
+    return generation >= _FIRST_GENERATION
+
+
+def _count_reset(kind: str):
+    """Increment the counter of reset <kind> ('fast', 'restart' or 'recreate')."""
+    with _STATUS_LOCK:
+        _RESETS[kind] += 1
+
+
+@coordinated
+def pool_status() -> dict:
+    """Return the number of containers 'ready', 'running', 'recycling' and 'broken', the number
+    of containers that can be acquired simultaneously ('size') and the number of requests waiting
+    for a container ('waiting').
+    
+    Also contains, in 'resets', the number of released containers that were reused in place
+    ('fast'), restarted or recreated, and the ratio of fast resets ('fast_rate').
+    
+    For each priority class, 'priorities' contains the number of requests 'waiting' for a
+    container, and the average and 90th percentile of the time spent waiting ('wait_avg',
+    'wait_p90') during the last acquisitions.
+    
+    'estimated_wait' is the time a new request would wait for a container, see
+    'estimated_wait()'."""
+    with _STATUS_LOCK:
+        status = dict(_STATUS)
+        resets = dict(_RESETS)
+    status["size"] = LEASES.limit
+    status["waiting"] = LEASES.waiting
+    status["ready"] = CONTAINERS.qsize()
+    total = sum(resets.values())
+    resets["fast_rate"] = resets["fast"] / total if total else 0.0
+    status["resets"] = resets
+    status["estimated_wait"] = estimated_wait()
+    
+    waits = list(_WAITS)
+    status["priorities"] = dict()
+    for priority, waiting in LEASES.waiting_by_priority().items():
+        durations = [w for _, w, _, p in waits if p == priority]
+        status["priorities"][priority] = {
+            "waiting":  waiting,
+            "wait_avg": sum(durations) / len(durations) if durations else 0.0,
+            "wait_p90": _percentile(durations, 90),
+        }
+    return status
+
+
+@coordinated
+def pool_configuration() -> dict:
+    """Return the current 'generation' of the pool, its 'parameters' (DOCKER_PARAMETERS) and
+    whether a new generation is 'rolling_out'."""
+    return {
+        "generation":  GENERATION,
+        "rolling_out": rolling_out(),
+        "parameters":  settings.DOCKER_PARAMETERS,
+    }
+
+
+@coordinated
+def cpu_slots() -> Optional[List[str]]:
+    """Return the CPU slots of PLACEMENT, None if DOCKER_CPU_PINNING is False."""
+    return PLACEMENT.slots if PLACEMENT is not None else None
+
 
+@coordinated
+def cpu_assignments() -> Dict[str, str]:
+    """Return the CPUs each container of the pool is restricted to, by container name, an empty
+    dictionary if DOCKER_CPU_PINNING is False."""
+    if PLACEMENT is None:
+        return {}
+    running = docker.from_env().containers.list(filters={
+        "label": f"{LABEL_FINGERPRINT}={FINGERPRINT}"
+    })
+    return {c.name: _cpuset(c) for c in sorted(running, key=lambda c: c.name)}
+
+
+def agent_enabled() -> bool:
+    """Return True if the containers are created with an agent as their main process."""
+    return settings.DOCKER_AGENT and "command" not in settings.DOCKER_PARAMETERS
+
+
+def stdin_directory(name: str) -> str:
+    """Return the path of the directory where the stdin of the commands executed in the container
+    <name> is written, outside of its working directory so that it cannot collide with the files
+    of the environment."""
+    return os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, STDIN_DIRNAME, name)
+
+
+def container_volumes(name: str) -> dict:
+    """Return the volumes mounted in the container <name>."""
+    volumes = {
+        os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, name): {
+            "bind": CONTAINER_ENVPATH,
+            "mode": "rw",
+        },
+        stdin_directory(name):                                   {
+            "bind": CONTAINER_STDIN_DIRECTORY,
+            "mode": "ro",
+        },
+        settings.EXTERNAL_LIBRARIES_ROOT:                        {
+            "bind": "/utils/libs/",
+            "mode": "ro",
+        },
+    }
+    if agent_enabled():
+        volumes.update(agent.volumes(name))
+    return volumes
+
+
+def container_fingerprint() -> str:
+    """Return a hash of every parameter used to create the containers.
+    
+    It contains the ID of the image's digest, the DOCKER_PARAMETERS (limits included), the mounts,
+    the user, the CPU slots of PLACEMENT and the version of the agent. Two containers with the same
+    fingerprint are thus interchangeable, provided that they are assigned the same CPUs."""
+    image = settings.DOCKER_PARAMETERS["image"]
+    try:
+        image = docker.from_env().images.get(image).id
+    except DockerException:  # pragma: no cover
+        logger.warning(f"Could not retrieve the ID of image '{image}'")
+    
+    config = {
+        "image":      image,
+        "parameters": settings.DOCKER_PARAMETERS,
+        "volumes":    container_volumes("{name}"),
+        "user":       os.getuid(),
+        "cpu_slots":  PLACEMENT.slots if PLACEMENT is not None else None,
+        "agent":      agent.version() if agent_enabled() else None,
+    }
+    serialized = json.dumps(config, sort_keys=True, default=repr)
+    return hashlib.sha256(serialized.encode()).hexdigest()
 
-def create_container(name: str) -> Container:
-    """Create a container with the paramaters defined in settings.py."""
+
+def create_container(name: str, index: int) -> Container:
+    """Create a container with the paramaters defined in settings.py.
+    
+    If DOCKER_CPU_PINNING is True, the container is restricted to the CPUs assigned to <index> by
+    PLACEMENT. If DOCKER_AGENT is True, its main process is the agent executing the commands."""
+    parameters = dict(settings.DOCKER_PARAMETERS)
+    if PLACEMENT is not None:
+        parameters["cpuset_cpus"] = PLACEMENT.assign(index)
+    if agent_enabled():
+        parameters["command"] = agent.command()
+    labels = {
+        **parameters.pop("labels", {}),
+        LABEL_INDEX:       str(index),
+        LABEL_FINGERPRINT: FINGERPRINT,
+    }
     return docker.from_env().containers.run(
         name=name,
-        volumes={
-            os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, name): {
-                "bind": "/home/student",
-                "mode": "rw",
-            },
-            settings.EXTERNAL_LIBRARIES_ROOT:                        {
-                "bind": "/utils/libs/",
-                "mode": "ro",
-            },
-        },
+        volumes=container_volumes(name),
         user=os.getuid(),
-        **settings.DOCKER_PARAMETERS
+        labels=labels,
+        **parameters
     )
 
 
+def update_limits(container: Container, **limits: int):
+    """Update the limits of <container>, <limits> being fields of its HostConfig (Memory,
+    MemorySwap or PidsLimit, -1 meaning unlimited for the latter).
+    
+    Memory is updated through 'Container.update()'. docker-py does not support PidsLimit, which
+    is thus sent to the same endpoint of the Engine API, '/containers/<id>/update'.
+    
+    Raises docker.errors.APIError if Docker refuses the update."""
+    if "Memory" in limits or "MemorySwap" in limits:
+        container.update(mem_limit=limits.get("Memory"), memswap_limit=limits.get("MemorySwap"))
+    if "PidsLimit" in limits:
+        api = container.client.api
+        pids = limits["PidsLimit"]
+        response = api.post(
+            f"{api.base_url}/v{api.api_version}/containers/{container.id}/update",
+            json={"PidsLimit": pids if pids > 0 else -1},
+        )
+        if response.status_code >= 400:
+            raise APIError(response.text, response)
+
+
+def _layer_path(name: str) -> str:
+    """Return the path of the file holding the baseline of the writable layer of the container
+    <name>."""
+    return os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, LAYERS_DIRNAME, f"{name}.json")
+
+
+def _discard_layer(name: str):
+    """Delete the baseline of the writable layer of the container <name>, if any."""
+    try:
+        os.remove(_layer_path(name))
+    except FileNotFoundError:
+        pass
+
+
+def _discard_stdin(name: str):
+    """Delete the stdin directory of the container <name>, if any."""
+    path = stdin_directory(name)
+    if os.path.isdir(path):
+        trash.discard(path)
+
+
+def container_name(index: int) -> str:
+    """Return a new unique name for a container of id <index>.
+    
+    Names are unique so that containers of two generations of the pool can coexist."""
+    return f"c{index}-{uuid.uuid4().hex[:8]}"
+
+
+def _remove_container(c: Container):
+    """Remove the container <c>, logging any error."""
+    try:
+        c.remove(force=True)
+        logger.info(f"Container {c.short_id} removed.")
+    except DockerException:
+        logger.exception(f"Could not remove container {c.short_id}.")
+
+
 def purging_containers():
-    """Delete running container created from DOCKER_PARAMETERS["image"]"""
+    """Delete running container created from DOCKER_PARAMETERS["image"], or by a previous
+    generation of the pool.
+    
+    Containers are removed concurrently by up to <settings.DOCKER_STARTUP_WORKERS> threads."""
     to_del = docker.from_env().containers.list(all=True, filters={
         "ancestor": settings.DOCKER_PARAMETERS["image"]
     })
-    for c in to_del:
-        try:
-            c.remove(force=True)
-            logger.info(f"Container {c.short_id} removed.")
-        except DockerException:
-            logger.exception(f"Could not remove container {c.short_id}.")
+    to_del += [
+        c for c in docker.from_env().containers.list(all=True, filters={
+            "label": LABEL_FINGERPRINT
+        })
+        if all(c.id != d.id for d in to_del)
+    ]
+    with ThreadPoolExecutor(settings.DOCKER_STARTUP_WORKERS) as pool:
+        list(pool.map(_remove_container, to_del))
     
     # Purging any existing container environment.
     logger.info("Purging any existing container environment.")
     if os.path.isdir(settings.DOCKER_VOLUME_HOST_BASEDIR):  # pragma: no cover
-        shutil.rmtree(settings.DOCKER_VOLUME_HOST_BASEDIR)
+        for entry in os.scandir(settings.DOCKER_VOLUME_HOST_BASEDIR):
+            if entry.name != trash.TRASH_DIRNAME:
+                trash.discard(entry.path)
+
+
+def _cpuset(c: Container) -> str:
+    """Return the CPUs the container <c> is restricted to."""
+    return c.attrs.get("HostConfig", {}).get("CpusetCpus") or ""
+
+
+def _is_idle(c: Container) -> bool:
+    """Return True if <c> is running and only contains its main process."""
+    try:
+        c.reload()
+        if c.status != "running":
+            return False
+        return len(c.top()["Processes"]) <= 1
+    except DockerException:
+        return False
+
+
+def _reconcile(generation: int, total: int) -> List[int]:
+    """Adopt the existing containers that can be reused in the pool, removing the other ones.
+    
+    A container is adopted if it has been created with the current FINGERPRINT, its index is
+    still part of the pool and it is idle. Adopted containers are then cleaned as if they were
+    restarted by '_recycle()' (see 'Sandbox._adopt()'), and removed if they cannot be cleaned or
+    if their writable layer changed since their creation. The directory of any other container is
+    deleted.
+    
+    Returns the list of indexes of the adopted containers."""
+    existing: Dict[str, Container] = dict()  # A container can match both filters
+    image = settings.DOCKER_PARAMETERS["image"]
+    for filters in ({"ancestor": image}, {"label": LABEL_FINGERPRINT}):
+        for c in docker.from_env().containers.list(all=True, filters=filters):
+            existing[c.id] = c
+    
+    adopted: Dict[int, Container] = dict()
+    stale: Dict[str, Container] = dict()
+    for c in existing.values():
+        labels = c.labels
+        index = labels.get(LABEL_INDEX, "")
+        if (
+            labels.get(LABEL_FINGERPRINT) == FINGERPRINT
+            and index.isdigit() and int(index) < total
+            and int(index) not in adopted
+            and _is_idle(c)
+            and (PLACEMENT is None or PLACEMENT.claim(int(index), _cpuset(c)))
+        ):
+            adopted[int(index)] = c
+        else:
+            stale[c.id] = c
+    
+    with ThreadPoolExecutor(settings.DOCKER_STARTUP_WORKERS) as pool:
+        list(pool.map(_remove_container, stale.values()))
+    
+    if os.path.isdir(settings.DOCKER_VOLUME_HOST_BASEDIR):
+        kept = {c.name for c in adopted.values()}
+        ignored = {trash.TRASH_DIRNAME, agent.AGENTS_DIRNAME, LAYERS_DIRNAME, STDIN_DIRNAME}
+        for entry in os.scandir(settings.DOCKER_VOLUME_HOST_BASEDIR):
+            if entry.name not in kept | ignored:
+                trash.discard(entry.path)
+        agent.clean(kept)
+        layers = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, LAYERS_DIRNAME)
+        if os.path.isdir(layers):
+            for entry in os.scandir(layers):
+                if os.path.splitext(entry.name)[0] not in kept:
+                    os.remove(entry.path)
+        stdin = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, STDIN_DIRNAME)
+        if os.path.isdir(stdin):
+            for entry in os.scandir(stdin):
+                if entry.name not in kept:
+                    trash.discard(entry.path)
+    
+    for index, c in list(adopted.items()):
+        try:
+            sandbox = Sandbox(c.name, index, c)
+        except Exception as e:
+            logger.warning(f"Could not adopt container {c.short_id}, removing it: {e}")
+            del adopted[index]
+            if PLACEMENT is not None:
+                PLACEMENT.release(index)
+            _remove_container(c)
+            path = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, c.name)
+            if os.path.isdir(path):
+                trash.discard(path)
+            agent.discard(c.name)
+            _discard_layer(c.name)
+            _discard_stdin(c.name)
+            continue
+        sandbox.generation = generation
+        sandbox._put_back()
+        logger.info(f"Container {c.short_id} adopted as '{c.name}' of id '{index}'.")
+    
+    return list(adopted)
+
+
+def _spawn(index: int, generation: int) -> bool:
+    """Create the sandbox <index> and put it in CONTAINERS, returning True on success.
+    
+    If the container cannot be created, it is counted as broken and another attempt is
+    scheduled after <settings.DOCKER_RECYCLING_RETRY_DELAY> seconds."""
+    name = container_name(index)
+    try:
+        sandbox = Sandbox(name, index)
+        sandbox.generation = generation
+        sandbox._put_back()
+        return True
+    except Exception:
+        logger.exception(f"Error while creating container '{name}' of id '{index}'")
+        if generation != GENERATION:
+            return False
+        _update_status(broken=1)
+        timer = threading.Timer(
+            settings.DOCKER_RECYCLING_RETRY_DELAY, _respawn, (index, generation)
+        )
+        timer.daemon = True
+        timer.start()
+        return False
+
+
+def _spawn_recycling(index: int, generation: int) -> bool:
+    """Same as '_spawn()', for a sandbox counted as recycling until it is created."""
+    try:
+        return _spawn(index, generation)
+    finally:
+        if _counted(generation):
+            _update_status(recycling=-1)
 
 
-def initialise_containers():
-    """Called by settings.py to initialize containers at server launch."""
-    global CONTAINERS
+def _respawn(index: int, generation: int):
+    """Try to create again a broken container through the recycling pool."""
+    with _STATUS_LOCK:
+        if generation != GENERATION or index not in _INDEXES:  # Outdated or removed from the pool
+            if _counted(generation):
+                _STATUS["broken"] -= 1
+            return
+        _STATUS["broken"] -= 1
+        _STATUS["recycling"] += 1
     
-    purging_containers()
+    RECYCLER.submit(_spawn_recycling, index, generation)
+
+
+def initialise_containers(reconcile: bool = None):
+    """Called by settings.py to initialize containers at server launch.
+    
+    DOCKER_COUNT + DOCKER_SPARE_COUNT containers are created, but only DOCKER_COUNT of them can
+    be acquired at the same time.
+    
+    Containers are created concurrently by up to <settings.DOCKER_STARTUP_WORKERS> threads, each
+    one being available to 'Sandbox.acquire()' as soon as it is created.
+    
+    If <reconcile> is True (defaults to settings.DOCKER_RECONCILE), idle containers left by a
+    previous process are adopted if their configuration still match the current one, only the
+    stale containers are replaced. Otherwise, every existing container is purged."""
+    global CONTAINERS, LEASES, RECYCLER, GENERATION, FINGERPRINT, PLACEMENT, _FIRST_GENERATION
+    
+    if reconcile is None:
+        reconcile = settings.DOCKER_RECONCILE
+    
+    start = time.time()
+    total = settings.DOCKER_COUNT + settings.DOCKER_SPARE_COUNT
+    
+    GENERATION += 1
+    generation = GENERATION
+    _FIRST_GENERATION = generation
+    CONTAINERS = queue.Queue()
+    LEASES = Scheduler(settings.DOCKER_COUNT)
+    if "RECYCLER" in globals():
+        RECYCLER.shutdown(wait=False)
+    RECYCLER = ThreadPoolExecutor(
+        settings.DOCKER_RECYCLING_WORKERS, thread_name_prefix="sandbox-recycler"
+    )
+    with _STATUS_LOCK:
+        _STATUS.update(running=0, recycling=0, broken=0)
+        _RESETS.update(fast=0, restart=0, recreate=0)
+        _INDEXES.clear()
+        _INDEXES.update(range(total))
+    _WAITS.clear()
+    _HOLDS.clear()
+    
+    PLACEMENT = CpuPlacement.from_settings() if settings.DOCKER_CPU_PINNING else None
+    FINGERPRINT = container_fingerprint()
+    trash.start_reaper()
+    if reconcile:
+        adopted = _reconcile(generation, total)
+        purged = time.time()
+        logger.info(
+            f"Adopted {len(adopted)} existing containers, reconciling took {purged - start} "
+            f"seconds."
+        )
+    else:
+        adopted = list()
+        purging_containers()
+        purged = time.time()
+        logger.info(f"Purging containers took {purged - start} seconds.")
     
     # Create containers.
     logger.info("Initializing containers.")
     
-    i = 0
-    CONTAINERS = queue.Queue(settings.DOCKER_COUNT)
-    while not CONTAINERS.full():
-        c = Sandbox(f"c{i}", i)
-        CONTAINERS.put(c)
-        logger.info(
-            f"Container {c.container.short_id} ({i + 1}/{settings.DOCKER_COUNT}) initialized.")
-        i += 1
+    created = len(adopted)
+    with ThreadPoolExecutor(settings.DOCKER_STARTUP_WORKERS) as pool:
+        futures = [
+            pool.submit(_spawn, i, generation) for i in range(total) if i not in adopted
+        ]
+        for future in as_completed(futures):
+            if not future.result():
+                continue
+            created += 1
+            if created == 1:
+                logger.info(f"First container ready after {time.time() - purged} seconds.")
+            logger.info(f"Container ({created}/{total}) initialized.")
+    
+    logger.info(
+        f"Containers initialized in {time.time() - purged} seconds "
+        f"(total startup took {time.time() - start} seconds)."
+    )
+
+
+@coordinated
+def resize_pool(size: int):
+    """Change the number of containers that can be acquired simultaneously to <size>.
+    
+    New containers are created in the background by the RECYCLER. When shrinking, idle containers
+    are removed immediately, while running ones are removed when released."""
+    generation = GENERATION
+    with _STATUS_LOCK:
+        previous = LEASES.limit
+        total = size + settings.DOCKER_SPARE_COUNT
+        added = list()
+        while len(_INDEXES) < total:
+            index = next(i for i in range(total) if i not in _INDEXES)
+            _INDEXES.add(index)
+            added.append(index)
+        _STATUS["recycling"] += len(added)
+    LEASES.resize(size)
+    
+    for index in added:
+        RECYCLER.submit(_spawn_recycling, index, generation)
+    
+    # Retire idle containers in excess.
+    retired = list()
+    while _surplus() > 0:
+        try:
+            sandbox = CONTAINERS.get_nowait()
+        except queue.Empty:
+            break
+        sandbox._put_back()
+        retired.append(sandbox.index)
+    
+    logger.info(
+        f"Pool resized from {previous} to {size} containers (created: {added}, "
+        f"retired: {retired})."
+    )
+
+
+@coordinated
+def rolling_out() -> bool:
+    """Return whether a new generation of containers is being rolled out."""
+    return _ROLLOUT_LOCK.locked()
+
+
+def _outdated() -> List['Sandbox']:
+    """Return the sandboxes of CONTAINERS belonging to a previous generation of the pool."""
+    with CONTAINERS.mutex:
+        return [s for s in CONTAINERS.queue if s.generation != GENERATION]
+
+
+def _retire(sandbox: 'Sandbox'):
+    """Remove <sandbox> from CONTAINERS and remove its container, if it has not been acquired in
+    the meantime."""
+    with CONTAINERS.mutex:
+        try:
+            CONTAINERS.queue.remove(sandbox)
+        except ValueError:  # Acquired in the meantime
+            return
+    sandbox._put_back()
+
+
+def rollout(size: int = None, parameters: dict = None):
+    """Replace every container by a new generation of containers, created with <parameters>
+    (defaults to DOCKER_PARAMETERS), changing the size of the pool to <size> if given.
+    
+    Unlike 'initialise_containers()', the pool is never emptied: the new containers are created
+    concurrently by up to <settings.DOCKER_STARTUP_WORKERS> threads, each one replacing an idle
+    container of the previous generation as soon as it is created. Containers of the previous
+    generation running an execution keep their lease and are removed once released.
+    
+    Idle containers of the previous generation are kept as long as some new containers could not
+    be created."""
+    with _ROLLOUT_LOCK:
+        _rollout(size, parameters)
+
+
+@coordinated
+def rollout_in_background(size: int = None, parameters: dict = None) -> bool:
+    """Run 'rollout()' in a new thread, returns False (without doing anything) if a rollout is
+    already in progress."""
+    if not _ROLLOUT_LOCK.acquire(blocking=False):
+        return False
+    
+    def run():
+        try:
+            _rollout(size, parameters)
+        except Exception:  # pragma: no cover
+            logger.exception("Error while rolling out a new generation of the pool")
+        finally:
+            _ROLLOUT_LOCK.release()
+    
+    threading.Thread(target=run, name="sandbox-rollout", daemon=True).start()
+    return True
+
+
+def _rollout(size: Optional[int], parameters: Optional[dict]):
+    """Body of 'rollout()', _ROLLOUT_LOCK must be held."""
+    global GENERATION, FINGERPRINT, PLACEMENT
+    
+    start = time.time()
+    if parameters is not None:
+        settings.DOCKER_PARAMETERS = parameters
+    size = LEASES.limit if size is None else size
+    total = size + settings.DOCKER_SPARE_COUNT
+    
+    with _STATUS_LOCK:
+        GENERATION += 1
+        generation = GENERATION
+        _INDEXES.clear()
+        _INDEXES.update(range(total))
+        _STATUS["recycling"] += total
+    PLACEMENT = CpuPlacement.from_settings() if settings.DOCKER_CPU_PINNING else None
+    FINGERPRINT = container_fingerprint()
+    LEASES.resize(size)
+    logger.info(f"Rolling out generation {generation} of the pool ({size} containers).")
+    
+    failed = 0
+    with ThreadPoolExecutor(settings.DOCKER_STARTUP_WORKERS) as pool:
+        futures = [pool.submit(_spawn_recycling, i, generation) for i in range(total)]
+        for future in as_completed(futures):
+            if not future.result():
+                failed += 1
+                continue
+            outdated = _outdated()
+            if outdated:
+                _retire(outdated[0])
+    
+    for sandbox in _outdated()[failed:]:
+        _retire(sandbox)
+    
+    logger.info(
+        f"Generation {generation} of the pool rolled out in {time.time() - start} seconds "
+        f"({failed} containers could not be created)."
+    )
+
+
+def _surplus() -> int:
+    """Return the number of containers that should be removed from the pool."""
+    with _STATUS_LOCK:
+        return len(_INDEXES) - (LEASES.limit + settings.DOCKER_SPARE_COUNT)
+
+
+def acquire_waits(since: float) -> List[Tuple[float, bool]]:
+    """Return the (wait, rejected) of every call to 'Sandbox.acquire()' made after <since>."""
+    return [(w, r) for t, w, r, _ in list(_WAITS) if t >= since]
+
+
+def estimated_wait(ahead: int = None) -> float:
+    """Estimate the time (in seconds) a new request would wait for a container.
+    
+    Each lease is assumed to be held for the average duration of the last executions, so that
+    LEASES.limit leases are given back every such duration. A new request must wait for the
+    <ahead> requests (defaults to every waiting request) to be served before it."""
+    ahead = LEASES.waiting if ahead is None else ahead
+    free = LEASES.limit - LEASES.used
+    if ahead < free:
+        return 0.0
+    
+    holds = list(_HOLDS)
+    hold = sum(holds) / len(holds) if holds else settings.EXECUTE_TIMEOUT / 2
+    return (ahead - free + 1) * hold / max(1, LEASES.limit)
+
+
+def _overloaded(wait: float) -> HTTPExceptions.SERVICE_UNAVAILABLE:
+    """Return the exception rejecting a request, asking the client to retry after <wait>
+    seconds.
+    
+    'Retry-After' is spread over [wait, 1.5 * wait] so that rejected clients do not all retry at
+    the same time."""
+    retry = max(1, math.ceil(wait * random.uniform(1, 1.5)))
+    exception = HTTPExceptions.SERVICE_UNAVAILABLE.with_content(
+        f"Sandbox overloaded, retry after {retry} seconds."
+    )
+    exception.response["Retry-After"] = str(retry)
+    return exception
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """Return the <percent>-th percentile of <values>, 0 if <values> is empty."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def autoscale_target(now: float = None) -> int:
+    """Return the size the pool should have according to its recent usage.
+    
+    The pool grows by DOCKER_AUTOSCALE_STEP containers (up to DOCKER_MAX_COUNT) if requests are
+    waiting for a container, were rejected, or if the 90th percentile of acquire waits during the
+    last DOCKER_AUTOSCALE_INTERVAL seconds exceeds DOCKER_AUTOSCALE_WAIT_THRESHOLD. It does not
+    grow if the host's memory or CPU usage exceeds DOCKER_AUTOSCALE_MAX_MEMORY or
+    DOCKER_AUTOSCALE_MAX_CPU percents.
+    
+    The pool shrinks by DOCKER_AUTOSCALE_STEP containers (down to DOCKER_MIN_COUNT) once it has
+    had at least DOCKER_AUTOSCALE_STEP idle containers for DOCKER_AUTOSCALE_COOLDOWN seconds."""
+    global _LAST_BUSY
+    
+    now = time.time() if now is None else now
+    status = pool_status()
+    size = status["size"]
+    step = settings.DOCKER_AUTOSCALE_STEP
+    waits = acquire_waits(now - settings.DOCKER_AUTOSCALE_INTERVAL)
+    
+    pressure = (
+        status["waiting"] > 0
+        or any(rejected for _, rejected in waits)
+        or _percentile([w for w, _ in waits], 90) > settings.DOCKER_AUTOSCALE_WAIT_THRESHOLD
+    )
+    if pressure or status["running"] + step > size:
+        _LAST_BUSY = now
+    
+    if size < settings.DOCKER_MIN_COUNT:
+        return settings.DOCKER_MIN_COUNT
+    if size > settings.DOCKER_MAX_COUNT:
+        return settings.DOCKER_MAX_COUNT
     
-    logger.info("Containers initialized.")
+    if pressure:
+        if psutil.virtual_memory().percent >= settings.DOCKER_AUTOSCALE_MAX_MEMORY:
+            logger.warning("Cannot grow the pool of containers: not enough memory.")
+            return size
+        if psutil.cpu_percent() >= settings.DOCKER_AUTOSCALE_MAX_CPU:
+            logger.warning("Cannot grow the pool of containers: CPU usage too high.")
+            return size
+        return min(settings.DOCKER_MAX_COUNT, size + step)
+    
+    if now - max(_LAST_BUSY, _LAST_GROWTH) >= settings.DOCKER_AUTOSCALE_COOLDOWN:
+        return max(settings.DOCKER_MIN_COUNT, size - step)
+    
+    return size
+
+
+def autoscale():
+    """Grow or shrink the pool according to 'autoscale_target()', ran periodically by the
+    scheduler defined in apps.py if DOCKER_AUTOSCALE is True."""
+    global _LAST_GROWTH
+    
+    if (
+        not coordinator.is_coordinator()
+        or settings.INITIALISING_THREAD.is_alive()
+        or rolling_out()
+    ):
+        return
+    
+    size = LEASES.limit
+    target = autoscale_target()
+    if target > size:
+        _LAST_GROWTH = time.time()
+    if target != size:
+        resize_pool(target)
 
 
 class Sandbox:
     """Wrap a docker's container."""
     
     
-    def __init__(self, name, index):
+    def __init__(self, name, index, container: Container = None):
+        """Create a new container, or adopt <container> if given (see '_adopt()')."""
         path = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, name)
-        if os.path.isdir(path):
-            shutil.rmtree(path, ignore_errors=True)
-        os.makedirs(path)
+        adopted = container is not None
+        if not adopted:
+            if os.path.isdir(path):
+                trash.discard(path)
+            os.makedirs(path)
+            _discard_stdin(name)
+            os.makedirs(stdin_directory(name))
+            if agent_enabled():
+                agent.create(name)
+            container = create_container(name, index)
         
         self.name = name
-        self.container = create_container(name)
+        self.container = container
         self.index = index
+        self.generation = GENERATION
         self.used_since = 0
         self.to_delete = False
         self.envpath = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, self.name)
+        self.cpuset = _cpuset(container)
+        # Identity of the socket of the agent when the container was acquired (see
+        # agent.identity()), None if the agent could not be found.
+        self.agent_socket = None
+        # Limits of the container replaced by 'limit()', restored when it is recycled.
+        self.limits: Optional[dict] = None
+        # Paths changed in the writable layer of the container when it was created, saved on the
+        # host to be checked if it is adopted by another process.
+        if adopted:
+            self.layer = self._adopt()
+        elif settings.DOCKER_FAST_RESET:
+            self.layer = self._layer_changes()
+            os.makedirs(os.path.dirname(_layer_path(name)), exist_ok=True)
+            with open(_layer_path(name), "w") as f:
+                json.dump(sorted(self.layer), f)
+        else:
+            self.layer = set()
     
     
     @staticmethod
     def available() -> int:
         """Return the approximative number of available container."""
-        return CONTAINERS.qsize()
+        return max(0, min(CONTAINERS.qsize(), LEASES.limit - LEASES.used))
     
     
     @staticmethod
-    def acquire() -> 'Sandbox':
-        """Try to acquire a container for <settings.WAIT_FOR_CONTAINER_DURATION> seconds.
+    def acquire(priority: str = None, client: str = "", max_wait: float = None) -> 'Sandbox':
+        """Try to acquire a container for <max_wait> seconds (defaults to
+        settings.WAIT_FOR_CONTAINER_DURATION).
+        
+        If requests are waiting for a container, they are served according to their <priority>
+        class (defaults to SCHEDULER_DEFAULT_PRIORITY) and to the share of their <client>, see
+        scheduler.py.
         
-        Raises HTTPExceptions.SERVICE_UNAVAILABLE if no container were available in time."""
-        global CONTAINERS
+        Raises HTTPExceptions.SERVICE_UNAVAILABLE, with a 'Retry-After' header computed from
+        'estimated_wait()', if no container were available in time. The request is rejected
+        without waiting if MAX_WAITING_REQUESTS requests are already waiting, or if the
+        estimated wait exceeds <max_wait>.
+        
+        The container is leased by the coordinator if the pool is managed by another process."""
+        if priority is None:
+            priority = settings.SCHEDULER_DEFAULT_PRIORITY
+        if max_wait is None:
+            max_wait = settings.WAIT_FOR_CONTAINER_DURATION
+        if not coordinator.is_coordinator():
+            return coordinator.acquire(priority, client, max_wait)
         
         start = time.time()
-        try:
-            cw = CONTAINERS.get(timeout=settings.WAIT_FOR_CONTAINER_DURATION)
-        except queue.Empty:
-            logger.warning(f"Failed to acquire a container after {time.time() - start} seconds)")
-            raise HTTPExceptions.SERVICE_UNAVAILABLE.with_content(
-                "Sandbox overloaded, retry after a few seconds."
+        deadline = start + max_wait
+        
+        leases = LEASES
+        estimate = estimated_wait()
+        full = 0 < settings.MAX_WAITING_REQUESTS <= leases.waiting
+        if full or estimate > max_wait:
+            _WAITS.append((time.time(), 0.0, True, priority))
+            logger.warning(
+                f"Rejected a request ({leases.waiting} requests waiting, estimated wait of "
+                f"{estimate} seconds)"
             )
+            raise _overloaded(estimate)
+        
+        cw = None
+        if leases.acquire(max_wait, priority, client):
+            try:
+                cw = CONTAINERS.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                leases.release()
         
+        _WAITS.append((time.time(), time.time() - start, cw is None, priority))
+        if cw is None:
+            logger.warning(f"Failed to acquire a container after {time.time() - start} seconds)")
+            raise _overloaded(estimated_wait())
+        
+        _update_status(running=1)
+        if cw.agent_socket is None and agent_enabled():
+            cw.agent_socket = agent.identity(agent.socket_path(cw.name))
         cw.available = False
         cw.used_since = time.time()
         logger.info(
@@ -133,55 +938,268 @@ class Sandbox:
     
     def extract_env(self, envid):
         """Retrieve the environment from the container and write it
-        to [settings.ENVIRONMENT_ROOT]/[envid].tgz"""
-        path = os.path.join(settings.ENVIRONMENT_ROOT, f"{envid}.tgz")
+        to [settings.ENVIRONMENT_ROOT]/[envid][extension of ENVIRONMENT_CODEC], see archives.py."""
+        path = os.path.join(settings.ENVIRONMENT_ROOT, f"{envid}{archives.get().extension}")
         if os.path.isfile(path):
             os.remove(path)
         
-        with tarfile.open(path, "w:gz") as tar:
+        with open(path, "wb") as f, archives.open_tar(f, "w") as tar:
             for name in os.listdir(self.envpath):
                 tar.add(os.path.join(self.envpath, name), arcname=name)
     
     
-    def reset(self):
-        """Reset a given container by killing it and overwriting it's instance with
-        a new one."""
-        global CONTAINERS
+    def limit(self, memory: Optional[int] = None, pids: Optional[int] = None):
+        """Limit the memory (in bytes, swap included) and the number of processes of the container
+        until it is released, None meaning that the current limit is kept."""
+        limits = {}
+        if memory is not None:
+            limits["Memory"] = limits["MemorySwap"] = memory
+        if pids is not None:
+            limits["PidsLimit"] = pids
+        if not limits:
+            return
+        
+        host = self.container.attrs["HostConfig"]
+        if self.limits is None:
+            self.limits = {}
+        for key in limits:  # -1 means unlimited (see '_restore_limits()' for Memory)
+            self.limits.setdefault(key, host.get(key) or (0 if key == "Memory" else -1))
+        update_limits(self.container, **limits)
+    
+    
+    def _restore_limits(self) -> bool:
+        """Restore the limits replaced by 'limit()', returns False if they cannot be restored.
+        
+        Docker cannot remove a memory limit, the container must be recreated if it had none."""
+        limits, self.limits = self.limits, None
+        if limits.get("Memory") == 0:
+            return False
+        update_limits(self.container, **limits)
+        return True
+    
+    
+    def _layer_changes(self) -> Set[str]:
+        """Return the paths changed in the writable layer of the container.
+        
+        Modifications (kind 0) of the directories of DOCKER_FAST_RESET_SCRATCH and of their
+        parents are ignored, since they only mean that files were added or removed in them, these
+        files being listed on their own."""
+        ignored = set()
+        for path in settings.DOCKER_FAST_RESET_SCRATCH:
+            while path not in ("/", ""):
+                ignored.add(path)
+                path = os.path.dirname(path)
+        
+        return {
+            c["Path"] for c in (self.container.diff() or ())
+            if c["Kind"] != 0 or c["Path"] not in ignored
+        }
+    
+    
+    def _wipe_scratch(self) -> bool:
+        """Delete the content of the directories of DOCKER_FAST_RESET_SCRATCH, returns False if
+        some files could not be deleted.
         
+        Files written in these directories by the compilers or the runtimes (e.g. in /tmp) thus do
+        not force the container to be recreated, and tmpfs mounts such as /dev/shm, which are
+        cleared by a restart, are emptied."""
+        if not settings.DOCKER_FAST_RESET_SCRATCH:
+            return True
+        
+        script = (
+            'status=0; for d in "$@"; do '
+            'if [ -d "$d" ]; then find "$d" -mindepth 1 -delete || status=1; fi; '
+            'done; exit $status'
+        )
+        result = self.container.exec_run(
+            ["sh", "-c", script, "sh", *settings.DOCKER_FAST_RESET_SCRATCH]
+        )
+        return result.exit_code == 0
+    
+    
+    def _adopt(self) -> Set[str]:
+        """Clean this container, left by a previous process, as '_recycle()' does when it
+        restarts a container: its working directory, its stdin directory and the content of
+        DOCKER_FAST_RESET_SCRATCH are deleted and it is restarted. Returns the baseline of its
+        writable layer, saved when it was created.
+        
+        Raises RuntimeError if it cannot be cleaned, if its baseline is missing, or if its
+        writable layer changed since its creation, in which case it must be recreated."""
+        trash.empty(self.envpath)
+        trash.empty(stdin_directory(self.name))
+        if agent_enabled():
+            trash.empty(agent.directory(self.name))
+        # The agent does not handle SIGTERM, it is killed right away.
+        self.container.restart(timeout=0)
+        if not self._wipe_scratch():
+            raise RuntimeError("the content of DOCKER_FAST_RESET_SCRATCH could not be deleted")
+        
+        if not settings.DOCKER_FAST_RESET:
+            return set()
         try:
+            with open(_layer_path(self.name)) as f:
+                layer = set(json.load(f))
+        except (OSError, ValueError):
+            raise RuntimeError("the baseline of its writable layer could not be read")
+        if self._layer_changes() - layer:
+            raise RuntimeError("its writable layer changed since its creation")
+        return layer
+    
+    
+    def _processes(self) -> int:
+        """Return the number of processes running in the container.
+        
+        The pids cgroup is used when readable, 'docker top' otherwise."""
+        pids = cgroups.pids_current(self.container.id)
+        if pids is None:
+            pids = len(self.container.top()["Processes"])
+        return pids
+    
+    
+    def _contamination(self) -> Optional[str]:
+        """Check whether anything from the last execution outlived it.
+        
+        Leftover processes are killed first, returns:
+            - None if the container can be reused as is.
+            - 'recreate' if the directory of the agent's socket has been tampered with (see
+              'agent.tampered()').
+            - 'restart' if some processes could not be killed.
+            - 'recreate' if the writable layer of the container has been modified (files
+              written outside of the working directory and of DOCKER_FAST_RESET_SCRATCH), or if
+              the content of DOCKER_FAST_RESET_SCRATCH could not be deleted."""
+        if agent_enabled() and agent.tampered(self.name, self.agent_socket):
+            return "recreate"
+        
+        if self._processes() > 1:
+            # Kill every process but the container's init and kill itself.
+            self.container.exec_run(["kill", "-9", "-1"])
+            deadline = time.time() + settings.DOCKER_FAST_RESET_KILL_DELAY
+            while self._processes() > 1:
+                if time.time() > deadline:
+                    return "restart"
+                time.sleep(0.01)
+        
+        if not self._wipe_scratch() or self._layer_changes() - self.layer:
+            return "recreate"
+        
+        return None
+    
+    
+    def _put_back(self):
+        """Put this sandbox back in CONTAINERS, or remove its container if it belongs to a
+        previous generation of the pool or if the pool has been shrunk."""
+        with _STATUS_LOCK:
+            retire = self.generation == GENERATION and self.index not in _INDEXES
+            if not retire and len(_INDEXES) > LEASES.limit + settings.DOCKER_SPARE_COUNT:
+                _INDEXES.discard(self.index)
+                retire = True
+        
+        if self.generation != GENERATION or retire:
+            if retire and PLACEMENT is not None:
+                PLACEMENT.release(self.index)
             try:
                 self.container.remove(force=True)
             except DockerException:
-                logger.info(f"Could not remove container '{self.name}' of id '{self.index}'")
-            
-            self = Sandbox(f"c{self.index}", self.index)
-            logger.info(f"Successfully restarted container '{self.name}' of id '{self.index}'")
-            CONTAINERS.put(self, False)
+                logger.info(f"Could not remove outdated container '{self.name}'")
+            if os.path.isdir(self.envpath):
+                trash.discard(self.envpath)
+            agent.discard(self.name)
+            _discard_layer(self.name)
+            _discard_stdin(self.name)
+            return
+        
+        CONTAINERS.put(self, False)
+    
+    
+    def reset(self):
+        """Reset a given container by killing it and overwriting it's instance with
+        a new one.
+        
+        The container is not replaced if it belongs to a previous generation of the pool."""
+        try:
+            self.container.remove(force=True)
         except DockerException:
-            logger.exception(f"Error while restarting container '{self.name}' of id '{self.index}'")
+            logger.info(f"Could not remove container '{self.name}' of id '{self.index}'")
+        if os.path.isdir(self.envpath):
+            trash.discard(self.envpath)
+        agent.discard(self.name)
+        _discard_layer(self.name)
+        _discard_stdin(self.name)
+        
+        if self.generation == GENERATION and _spawn(self.index, self.generation):
+            logger.info(f"Successfully restarted container '{self.name}' of id '{self.index}'")
     
     
     @classmethod
     def reset_all(cls):
         """Reset every containers of CONTAINERS."""
-        initialise_containers()
+        initialise_containers(reconcile=False)
     
     
-    def release(self):
-        """Release this container."""
-        global CONTAINERS
+    def _recycle(self):
+        """Clean this container and put it back in CONTAINERS, recreating it if it could not be
+        cleaned.
         
-        try:
-            shutil.rmtree(self.envpath)
-            os.makedirs(self.envpath)
-            self.container.restart()
-            CONTAINERS.put(self, False)
-            logger.info(f"Released container '{self.name}' of id '{self.index}'")
+        If settings.DOCKER_FAST_RESET is True, the container is only restarted or recreated if
+        it has been contaminated by the last execution (see '_contamination()'), otherwise it is
+        always restarted. The limits replaced by 'limit()' are restored beforehand.
         
-        except DockerException:
-            logger.info(f"Could not release container '{self.name}' of id '{self.index}'")
-            self.reset()
+        Containers of a previous generation of the pool are removed instead."""
+        try:
+            if self.generation != GENERATION:
+                self._put_back()
+                return
+            
+            try:
+                if self.limits is not None and not self._restore_limits():
+                    _count_reset("recreate")
+                    self.reset()
+                    return
+                
+                contamination = "restart"
+                if settings.DOCKER_FAST_RESET:
+                    contamination = self._contamination()
+                
+                if contamination == "recreate":
+                    _count_reset("recreate")
+                    self.reset()
+                    return
+                
+                if contamination == "restart":
+                    trash.discard(self.envpath)
+                    os.makedirs(self.envpath)
+                    if agent_enabled():
+                        trash.empty(agent.directory(self.name))
+                        self.agent_socket = None  # The agent creates a new socket
+                    # The agent does not handle SIGTERM, it is killed right away.
+                    self.container.restart(timeout=0)
+                    _count_reset("restart")
+                else:
+                    trash.empty(self.envpath)
+                    _count_reset("fast")
+                
+                self._put_back()
+                logger.info(f"Released container '{self.name}' of id '{self.index}'")
+            
+            except DockerException:
+                logger.info(f"Could not release container '{self.name}' of id '{self.index}'")
+                self.reset()
+            
+            except Exception:
+                logger.exception(f"Could not release container '{self.name}' of id '{self.index}'")
+                self.reset()
+        finally:
+            if _counted(self.generation):
+                _update_status(recycling=-1)
+    
+    
+    def release(self):
+        """Release this container.
         
-        except Exception:
-            logger.exception(f"Could not release container '{self.name}' of id '{self.index}'")
-            self.reset()
+        The lease is given back immediately so that a spare container can be acquired, the
+        cleaning of this container is done in the background by the RECYCLER."""
+        if _counted(self.generation):
+            _update_status(running=-1, recycling=1)
+            LEASES.release()
+            _HOLDS.append(time.time() - self.used_since)
+        RECYCLER.submit(self._recycle)
@@ -0,0 +1,297 @@
+# coordinator.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Share the pool of containers between several processes (e.g. mod_wsgi or gunicorn workers).
+
+The first process to lock [DOCKER_POOL_SOCKET].lock becomes the coordinator: it is the only one to
+create, recycle and remove containers, and leases them to the other processes through the unix
+socket DOCKER_POOL_SOCKET. A lease lasts as long as the connection used to acquire it, so that the
+container of a process that died is released automatically. If the coordinator dies, the next
+process failing to reach it takes over, adopting the idle containers (see DOCKER_RECONCILE).
+
+The protocol consists of one JSON object per line:
+    - {"op": "acquire", "priority": <str>, "client": <str>, "max_wait": <float>} is answered
+      with {"lease": {...}} describing the container, the lease being released by sending
+      {"op": "release"} or by closing the connection. While the lease lasts,
+      {"op": "limit", "memory": <int>, "pids": <int>} limits the container (see
+      'containers.Sandbox.limit()') and is answered with {"result": null}.
+    - {"op": "call", "function": <name>, "args": [...]} calls one of the functions of
+      containers.py decorated with 'coordinated()' (see containers.COORDINATED) and is answered
+      with {"result": ...}.
+Errors are answered with {"error": {"status": <HTTP status>, "content": <str>, "headers": {...}}}.
+
+If DOCKER_POOL_COORDINATOR is False, every process manages its own containers."""
+
+import fcntl
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Optional
+
+import docker
+from django.conf import settings
+from django_http_exceptions import HTTPExceptions
+from django_http_exceptions.exceptions import HTTPException
+
+from . import containers
+
+
+logger = logging.getLogger(__name__)
+
+_ELECTION_LOCK = threading.Lock()
+# File descriptor of the locked file, None if this process is not the coordinator.
+_LOCK_FD: Optional[int] = None
+_SERVER: Optional[socketserver.BaseServer] = None
+# Docker client shared by the leases of this process, see '_docker()'.
+_DOCKER: Optional[docker.DockerClient] = None
+
+
+def _docker() -> docker.DockerClient:
+    """Return the Docker client of this process, created on first use."""
+    global _DOCKER
+    if _DOCKER is None:
+        _DOCKER = docker.from_env()
+    return _DOCKER
+
+
+def is_coordinator() -> bool:
+    """Return True if this process manages the containers."""
+    return not settings.DOCKER_POOL_COORDINATOR or _LOCK_FD is not None
+
+
+def elect() -> bool:
+    """Try to become the coordinator, returns True if this process has just been elected."""
+    global _LOCK_FD
+    
+    with _ELECTION_LOCK:
+        if _LOCK_FD is not None:
+            return False
+        
+        fd = os.open(settings.DOCKER_POOL_SOCKET + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        
+        _LOCK_FD = fd
+        logger.info(f"Process {os.getpid()} is now the coordinator of the pool of containers.")
+        return True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Handle the requests of a process to the coordinator."""
+    
+    
+    def reply(self, **response):
+        """Send <response> as a JSON line."""
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+        self.wfile.flush()
+    
+    
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request.get("op") == "acquire":
+                    self.lease(
+                        request.get("priority"), request.get("client", ""),
+                        request.get("max_wait")
+                    )
+                    return
+                function = containers.COORDINATED.get(request.get("function"))
+                if request.get("op") != "call" or function is None:
+                    raise HTTPExceptions.BAD_REQUEST.with_content(f"Invalid request {request}")
+                self.reply(result=function(*request.get("args", ())))
+            except HTTPException as e:
+                self.reply(error={
+                    "status":  e.response.status_code,
+                    "content": e.response.content.decode(),
+                    "headers": {k: v for k, v in e.response.items() if k != "Content-Type"},
+                })
+            except Exception as e:
+                logger.exception("Error while handling a request to the coordinator")
+                self.reply(error={"status": 500, "content": str(e)})
+    
+    
+    def lease(self, priority: Optional[str], client: str, max_wait: Optional[float]):
+        """Acquire a sandbox and lease it until the connection is closed or a 'release' is
+        received, applying the 'limit' received in the meantime."""
+        sandbox = containers.Sandbox.acquire(priority, client, max_wait)
+        try:
+            self.reply(lease={
+                "id":         sandbox.container.id,
+                "name":       sandbox.name,
+                "index":      sandbox.index,
+                "generation": sandbox.generation,
+                "envpath":    sandbox.envpath,
+                "cpuset":     sandbox.cpuset,
+                "agent":      sandbox.agent_socket,
+            })
+            for line in self.rfile:
+                request = json.loads(line)
+                if request.get("op") != "limit":
+                    break
+                try:
+                    sandbox.limit(request.get("memory"), request.get("pids"))
+                    self.reply(result=None)
+                except Exception as e:
+                    logger.exception("Could not limit a leased container")
+                    self.reply(error={"status": 500, "content": str(e)})
+        finally:
+            sandbox.release()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve():
+    """Serve the pool of this process to the other ones, in a background thread."""
+    global _SERVER
+    
+    if os.path.exists(settings.DOCKER_POOL_SOCKET):
+        os.remove(settings.DOCKER_POOL_SOCKET)  # Left by a previous coordinator
+    _SERVER = _Server(settings.DOCKER_POOL_SOCKET, _Handler)
+    os.chmod(settings.DOCKER_POOL_SOCKET, 0o600)
+    threading.Thread(
+        target=_SERVER.serve_forever, name="sandbox-coordinator", daemon=True
+    ).start()
+    logger.info(f"Serving the pool of containers on '{settings.DOCKER_POOL_SOCKET}'.")
+
+
+def start():
+    """Called by settings.py to initialise the pool of containers.
+    
+    The containers are only initialised if this process is elected as the coordinator (or if
+    DOCKER_POOL_COORDINATOR is False)."""
+    if not settings.DOCKER_POOL_COORDINATOR:
+        containers.initialise_containers()
+    elif elect():
+        _take_over()
+    else:
+        logger.info("Using the pool of containers of another process.")
+
+
+def _take_over():
+    """Initialise the pool of containers and serve it to the other processes."""
+    try:
+        containers.initialise_containers()
+    finally:
+        serve()
+
+
+def _connect(timeout: float) -> socket.socket:
+    """Connect to the coordinator.
+    
+    If it cannot be reached, this process tries to take over. Raises
+    HTTPExceptions.SERVICE_UNAVAILABLE in both cases."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(settings.DOCKER_POOL_SOCKET)
+        return sock
+    except OSError:
+        sock.close()
+        if elect():
+            threading.Thread(target=_take_over, name="sandbox-takeover", daemon=True).start()
+        logger.warning("Could not reach the coordinator of the pool of containers.")
+        raise HTTPExceptions.SERVICE_UNAVAILABLE.with_content(
+            "Sandbox is starting, retry after a few seconds."
+        )
+
+
+def _request(sock: socket.socket, **request) -> dict:
+    """Send <request> to the coordinator through <sock> and return its response, raising the
+    corresponding HTTPException if it contains an error."""
+    try:
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            response = json.loads(f.readline() or b"null")
+    except (OSError, ValueError):
+        response = None
+    
+    if response is None:
+        raise HTTPExceptions.SERVICE_UNAVAILABLE.with_content(
+            "Lost connection to the coordinator of the sandbox."
+        )
+    if "error" in response:
+        exception = HTTPExceptions.from_status(response["error"]["status"]).with_content(
+            response["error"]["content"]
+        )
+        for header, value in response["error"].get("headers", {}).items():
+            exception.response[header] = value
+        raise exception
+    return response
+
+
+def call(function: str, *args):
+    """Call the coordinated <function> of containers.py in the coordinator and return its
+    result."""
+    with _connect(settings.DOCKER_POOL_TIMEOUT) as sock:
+        return _request(sock, op="call", function=function, args=args)["result"]
+
+
+def acquire(priority: str = None, client: str = "", max_wait: float = None) -> 'LeasedSandbox':
+    """Acquire a sandbox from the coordinator, see 'containers.Sandbox.acquire()'."""
+    if max_wait is None:
+        max_wait = settings.WAIT_FOR_CONTAINER_DURATION
+    sock = _connect(max_wait + settings.DOCKER_POOL_TIMEOUT)
+    try:
+        lease = _request(
+            sock, op="acquire", priority=priority, client=client, max_wait=max_wait
+        )["lease"]
+        sock.settimeout(None)
+        return LeasedSandbox(sock, lease)
+    except BaseException:
+        sock.close()
+        raise
+
+
+class LeasedSandbox:
+    """Sandbox leased by the coordinator to this process, provides the same interface as
+    'containers.Sandbox' to the executor."""
+    
+    
+    def __init__(self, sock: socket.socket, lease: dict):
+        self.sock = sock
+        self.name = lease["name"]
+        # The lease describes the container, it does not need to be inspected.
+        self.container = _docker().containers.prepare_model({
+            "Id": lease["id"], "Name": lease["name"]
+        })
+        self.index = lease["index"]
+        self.generation = lease["generation"]
+        self.used_since = time.time()
+        self.to_delete = False
+        self.envpath = lease["envpath"]
+        self.cpuset = lease["cpuset"]
+        self.agent_socket = tuple(lease["agent"]) if lease["agent"] is not None else None
+        self.layer = set()
+    
+    
+    def extract_env(self, envid):
+        """See 'containers.Sandbox.extract_env()'."""
+        containers.Sandbox.extract_env(self, envid)
+    
+    
+    def limit(self, memory: Optional[int] = None, pids: Optional[int] = None):
+        """Ask the coordinator to limit the container, see 'containers.Sandbox.limit()'."""
+        _request(self.sock, op="limit", memory=memory, pids=pids)
+    
+    
+    def release(self):
+        """Give the lease back to the coordinator, which recycles the container."""
+        try:
+            self.sock.sendall(json.dumps({"op": "release"}).encode() + b"\n")
+        except OSError:  # pragma: no cover
+            pass  # Closing the connection releases the lease as well
+        finally:
+            self.sock.close()
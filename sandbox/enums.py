@@ -13,3 +13,5 @@ class SandboxErrCode(IntEnum):
     TIMEOUT = -2
     RESULT_NOT_FOUND = -3
     RESULT_NOT_UTF8 = -4
+    OUTPUT_LIMIT = -5
+    CPU_TIME_LIMIT = -6
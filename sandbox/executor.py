@@ -4,25 +4,82 @@
 #   - Coumes Quentin <coumes.quentin@gmail.com>
 
 
+import codecs
+import json
 import logging
 import os
-import tarfile
+import shlex
+import signal
 import time
 from datetime import timedelta
-from typing import List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from django.conf import settings
 from django.utils import timezone
 from django_http_exceptions import HTTPExceptions
 from docker.models.containers import Container
-from wrapt_timeout_decorator import timeout
-from sandbox import utils
-from .containers import Sandbox
+from sandbox import agent, cgroups, utils
+from .containers import CONTAINER_STDIN_DIRECTORY, Sandbox, agent_enabled, stdin_directory
 from .enums import SandboxErrCode
 
 
 logger = logging.getLogger(__name__)
 
+# Exit codes of 'timeout -s KILL' when the command timed out: 124, or 128 + 9 if 'timeout' was
+# killed along with the process group of the command.
+TIMEOUT_EXIT_CODES = (124, 128 + 9)
+
+# Exit code of a command killed for exceeding its CPU time (SIGXCPU).
+CPU_TIME_EXIT_CODE = 128 + signal.SIGXCPU
+
+# Exit codes of 'docker exec' when the executable could not be started (126, 127), or of python3
+# when its script does not exist (2).
+NOT_EXECUTED_EXIT_CODES = (2, 126, 127)
+
+UNKNOWN_ERROR = "An unknown error occurred on the sandbox\n"
+
+# File of the stdin directory of the container (see 'containers.stdin_directory()') from which a
+# case reads its stdin.
+STDIN_FILENAME = "stdin"
+
+
+
+class Capture:
+    """Keep at most <limit> bytes of each of stdout and stderr, and <total> bytes of both (None
+    means no limit), counting every byte written.
+    
+    Same as the one of docker/agent.py, used when commands are executed through 'docker exec'."""
+    
+    
+    def __init__(self, limit: Optional[int] = None, total: Optional[int] = None):
+        self.limit = limit
+        self.total = total
+        self.kept = {"stdout": 0, "stderr": 0}
+        self.written = {"stdout": 0, "stderr": 0}
+    
+    
+    def keep(self, name: str, data: bytes) -> bytes:
+        """Return the part of <data>, written on the stream <name>, which must be kept."""
+        self.written[name] += len(data)
+        allowed = len(data)
+        if self.limit is not None:
+            allowed = min(allowed, self.limit - self.kept[name])
+        if self.total is not None:
+            allowed = min(allowed, self.total - sum(self.kept.values()))
+        data = data[:max(allowed, 0)]
+        self.kept[name] += len(data)
+        return data
+    
+    
+    @property
+    def truncated(self) -> Dict[str, bool]:
+        return {name: self.written[name] > self.kept[name] for name in self.written}
+    
+    
+    @property
+    def exceeded(self) -> bool:
+        return any(self.truncated.values())
+
 
 
 class Command:
@@ -40,6 +97,17 @@ class Command:
             self.ignore_failure = False
         self.environ = environ if environ is not None else {}
         self.timeout = timeout
+        # Bytes of output kept for each stream, and for both streams (None means no limit), the
+        # latter being set by the Executor to what remains of the request's limit.
+        self.output_limit = settings.EXECUTE_OUTPUT_LIMIT or None
+        self.output_total = settings.EXECUTE_TOTAL_OUTPUT_LIMIT or None
+        # Bytes of output kept during the last execution.
+        self.output_kept = 0
+        # CPU time (in seconds) of each process of the command, None means no limit.
+        self.cpu_time: Optional[int] = None
+        # Content given on the stdin of the command through STDIN_FILENAME (written by the
+        # Executor), None means that stdin is empty.
+        self.stdin: Optional[str] = None
     
     
     def __repr__(self):
@@ -63,61 +131,236 @@ class Command:
     
     
     @classmethod
-    def from_config(cls, config: dict) -> List['Command']:
-        """Extract commands from the config dictionary, returning a list of Commands."""
-        if 'commands' not in config:
+    def from_config(cls, config: dict, cpu_time: Optional[int] = None) -> List['Command']:
+        """Extract commands from the config dictionary, returning a list of Commands.
+        
+        Commands are read from 'commands', or from the optional 'setup' if the config contains
+        'cases' (see 'cases_from_config()').
+        
+        If <cpu_time> is given, the CPU time of each process of the commands is limited to
+        <cpu_time> seconds, and their timeout defaults to settings.EXECUTE_SAFETY_TIMEOUT."""
+        field = "setup" if "cases" in config else "commands"
+        if field == "setup" and "commands" in config:
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                "A config containing 'cases' must use 'setup' instead of 'commands'"
+            )
+        if field == "commands" and field not in config:
             raise HTTPExceptions.BAD_REQUEST.with_content("Missing field 'commands' in config")
         
-        if not isinstance(config["commands"], list):
+        if not isinstance(config.get(field, []), list):
             raise HTTPExceptions.BAD_REQUEST.with_content(
-                f'commands must be a list, not {type(config["commands"])}'
+                f'{field} must be a list, not {type(config[field])}'
             )
         
         environ = utils.parse_environ(config)
-        if not config["commands"]:
+        if field == "commands" and not config["commands"]:
             raise HTTPExceptions.BAD_REQUEST.with_content(f"Command list cannot be empty")
         
+        timeout = settings.EXECUTE_TIMEOUT if cpu_time is None else settings.EXECUTE_SAFETY_TIMEOUT
         commands = list()
-        for c in config["commands"]:
+        for c in config.get(field, []):
             if isinstance(c, dict) and cls._check(c):
-                commands.append(Command(environ=environ, **c))
+                commands.append(Command(environ=environ, **{"timeout": timeout, **c}))
             elif isinstance(c, str):
-                commands.append(Command(c, environ=environ))
+                commands.append(Command(c, timeout, environ))
             else:
                 raise HTTPExceptions.BAD_REQUEST.with_content(f"Command badly formatted : '{c}'")
         
+        for command in commands:
+            command.cpu_time = cpu_time
         return commands
     
     
-    def execute(self, container: Container) -> Tuple[bool, dict]:
-        """Execute the command on the given container."""
-        start = time.time()
+    @classmethod
+    def cases_from_config(cls, config: dict,
+                          cpu_time: Optional[int] = None) -> Optional[List['Command']]:
+        """Extract the cases of a parameterized execution from the config dictionary, returning a
+        Command for each of them, or None if the config does not contain 'cases'.
+        
+        The command 'run' of the config is executed for each case, with its own 'stdin',
+        arguments ('args'), environment variables ('environ', merged into the ones of the config)
+        and 'timeout'. <cpu_time> is the same as in 'from_config()'."""
+        if "cases" not in config:
+            return None
+        
+        run, cases = config.get("run"), config["cases"]
+        if not isinstance(run, str):
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f"run must be a string, not {type(run)}"
+            )
+        if not isinstance(cases, list) or not 0 < len(cases) <= settings.EXECUTE_MAX_CASES:
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f"cases must be a list of 1 to {settings.EXECUTE_MAX_CASES} cases"
+            )
+        
+        environ = utils.parse_environ(config)
+        timeout = settings.EXECUTE_TIMEOUT if cpu_time is None else settings.EXECUTE_SAFETY_TIMEOUT
+        commands = list()
+        for c in cases:
+            if not isinstance(c, dict) or not all((
+                    "stdin" not in c or isinstance(c["stdin"], str),
+                    "args" not in c or isinstance(c["args"], list)
+                    and all(isinstance(a, str) for a in c["args"]),
+                    "timeout" not in c or isinstance(c["timeout"], (int, float)),
+            )):
+                raise HTTPExceptions.BAD_REQUEST.with_content(f"Case badly formatted : '{c}'")
+            
+            command = " ".join((run, *map(shlex.quote, c.get("args", []))))
+            command = Command(
+                command, c.get("timeout", timeout), {**environ, **utils.parse_environ(c)}
+            )
+            command.cpu_time = cpu_time
+            command.stdin = c.get("stdin")
+            commands.append(command)
+        return commands
+    
+    
+    def _script(self) -> str:
+        """Return the script executed by bash, redirecting its stdin from STDIN_FILENAME and
+        limiting the CPU time of the command if needed.
+        
+        Only the soft limit is set to <cpu_time> so that the command is killed by SIGXCPU,
+        distinguishing it from a timeout, the hard limit killing it a second later if it
+        ignores the signal."""
+        script = self.command
+        if self.stdin is not None:
+            script = f"exec < {os.path.join(CONTAINER_STDIN_DIRECTORY, STDIN_FILENAME)}\n{script}"
+        if self.cpu_time is not None:
+            script = f"ulimit -t {self.cpu_time + 1}; ulimit -S -t {self.cpu_time}\n{script}"
+        return script
+    
+    
+    @staticmethod
+    def _decode(data: bytes, truncated: bool) -> str:
+        """Decode <data>, a character cut by the truncation of the output being dropped."""
+        if truncated:
+            return codecs.getincrementaldecoder("utf-8")().decode(data)
+        return data.decode()
+    
+    
+    def _timed_out(self) -> dict:
+        """Return the execution of a command which had no time left."""
+        return {
+            "exit_code": SandboxErrCode.TIMEOUT.value,
+            "stdout":    b"",
+            "stderr":    b"",
+            "timed_out": True,
+            "exceeded":  False,
+            "bytes":     {"stdout": 0, "stderr": 0},
+            "truncated": {"stdout": False, "stderr": False},
+        }
+    
+    
+    def _kill_exec(self, api, exec_id: str):
+        """Kill the process group of the exec <exec_id>.
+        
+        This is done on a best effort basis: the server must be allowed to signal the processes
+        of the containers, otherwise the command keeps running until its timeout, its output
+        being discarded."""
         try:
-            exec_run = timeout(
-                self.timeout, use_signals=False
-            )(container.exec_run)
-            exit_code, output = exec_run(
-                ["bash", "-c", self.command], environment=self.environ, demux=True)
-            stdout, stderr = ("" if out is None else out.decode().strip() for out in output)
-        except TimeoutError:
+            os.killpg(api.exec_inspect(exec_id)["Pid"], signal.SIGKILL)
+        except OSError:
+            logger.warning(f"Could not kill the command '{self.command}'")
+    
+    
+    def _exec_stream(self, container: Container) -> Iterator[Tuple[str, Any]]:
+        """Execute the command through Docker's streaming exec, yielding ('stdout', <bytes>) and
+        ('stderr', <bytes>) as soon as they are received, and finally ('exit', <execution>),
+        <execution> being the same as the one returned by 'agent.execute()' without its output.
+        
+        The timeout is enforced inside the container by coreutils' 'timeout', which kills the
+        whole process group of the command with SIGKILL. Output beyond the limits of the command
+        is discarded as it is received."""
+        api = container.client.api
+        capture = Capture(self.output_limit, self.output_total)
+        meter = cgroups.meter(container.id) if settings.EXECUTE_RESOURCES else None
+        start = time.time()
+        exec_id = api.exec_create(
+            container.id,
+            ["timeout", "-s", "KILL", f"{max(self.timeout, 0.001):.3f}",
+             "bash", "-c", self._script()],
+            environment=self.environ
+        )["Id"]
+        exceeded = False
+        for stdout, stderr in api.exec_start(exec_id, stream=True, demux=True):
+            if exceeded:
+                continue  # Waiting for the command to be killed
+            for name, data in (("stdout", stdout), ("stderr", stderr)):
+                data = capture.keep(name, data) if data else b""
+                if data:
+                    yield name, data
+            if settings.EXECUTE_OUTPUT_KILL and capture.exceeded:
+                exceeded = True
+                self._kill_exec(api, exec_id)
+        exit_code = api.exec_inspect(exec_id)["ExitCode"]
+        timed_out = exit_code in TIMEOUT_EXIT_CODES and time.time() - start >= self.timeout
+        yield "exit", {
+            "exit_code": exit_code,
+            "timed_out": timed_out and not exceeded,
+            "exceeded":  exceeded,
+            "bytes":     capture.written,
+            "truncated": capture.truncated,
+            "resources": meter.stop() if meter is not None else None,
+        }
+    
+    
+    def _exec_run(self, container: Container) -> dict:
+        """Execute the command through 'docker exec', returns its execution (see
+        'agent.execute()')."""
+        output = {"stdout": bytearray(), "stderr": bytearray()}
+        for name, data in self._exec_stream(container):
+            if name == "exit":
+                return {**data, "stdout": bytes(output["stdout"]),
+                        "stderr": bytes(output["stderr"])}
+            output[name] += data
+    
+    
+    def result(self, executed: Optional[dict], elapsed: float) -> Tuple[bool, dict]:
+        """Return whether the execution of the command succeeded and its result, from its
+        execution (see 'agent.execute()') which took <elapsed> seconds.
+        
+        <executed> is None if an unknown error occurred."""
+        exit_code, stdout, stderr = SandboxErrCode.UNKNOWN.value, "", UNKNOWN_ERROR
+        written = {"stdout": 0, "stderr": 0}
+        truncated = {"stdout": False, "stderr": False}
+        if executed is not None:
+            written, truncated = executed["bytes"], executed["truncated"]
+        
+        if executed is not None and executed["timed_out"]:
             exit_code = SandboxErrCode.TIMEOUT.value
-            stdout = ""
             stderr = f"Command timed out after {self.timeout} seconds\n"
-        except Exception:  # pragma: no cover
-            logger.exception(f"An error occurred while executing the command '{self.command}'")
-            exit_code = SandboxErrCode.UNKNOWN.value
-            stdout = ""
-            stderr = "An unknown error occurred on the sandbox\n"
+            # The command used all of its time, the remaining is the overhead of its execution.
+            elapsed = min(elapsed, max(self.timeout, 0))
+        elif executed is not None:
+            try:
+                exit_code = executed["exit_code"]
+                if executed["exceeded"]:
+                    exit_code = SandboxErrCode.OUTPUT_LIMIT.value
+                elif self.cpu_time is not None and exit_code == CPU_TIME_EXIT_CODE:
+                    exit_code = SandboxErrCode.CPU_TIME_LIMIT.value
+                stdout = self._decode(executed["stdout"], truncated["stdout"]).strip()
+                stderr = self._decode(executed["stderr"], truncated["stderr"]).strip()
+            except UnicodeDecodeError:
+                logger.exception(f"Could not decode the output of the command '{self.command}'")
+                exit_code, stdout, stderr = SandboxErrCode.UNKNOWN.value, "", UNKNOWN_ERROR
         
         result = {
             "command":   self.command,
             "exit_code": exit_code,
             "stdout":    stdout,
             "stderr":    stderr,
-            "time":      time.time() - start,
+            "time":      elapsed,
+            "bytes":     written,
+            "truncated": truncated,
         }
+        if settings.EXECUTE_RESOURCES:
+            result["resources"] = executed.get("resources") if executed is not None else None
         
-        if exit_code < 0 and exit_code != SandboxErrCode.TIMEOUT.value:  # pragma: no cover
+        failures = (
+            SandboxErrCode.TIMEOUT.value, SandboxErrCode.OUTPUT_LIMIT.value,
+            SandboxErrCode.CPU_TIME_LIMIT.value,
+        )
+        if exit_code < 0 and exit_code not in failures:  # pragma: no cover
             status = False
         elif self.ignore_failure:
             status = True
@@ -125,6 +368,104 @@ class Command:
             status = (exit_code == 0)
         
         return status, result
+    
+    
+    def execute(self, container: Container, use_agent: bool = True) -> Tuple[bool, dict]:
+        """Execute the command on the given container.
+        
+        The command is sent to the agent of the container if <use_agent> is True and it can be
+        reached, it is executed through 'docker exec' otherwise. In both cases, the whole process
+        group of the command is killed if it timed out. Processes escaping this group (e.g.
+        through 'setsid') are killed when the container is reset.
+        
+        Output beyond settings.EXECUTE_OUTPUT_LIMIT and the remaining of
+        settings.EXECUTE_TOTAL_OUTPUT_LIMIT is discarded while it is read, the command being
+        killed if settings.EXECUTE_OUTPUT_KILL is True.
+        
+        If the CPU time of the command is limited, a process exceeding it is killed, the exit code
+        of the command being then SandboxErrCode.CPU_TIME_LIMIT.
+        
+        If settings.EXECUTE_RESOURCES is True, the resources used by the command are read from
+        the cgroup of the container, by its agent or from the host (see sandbox/cgroups.py)."""
+        start = time.time()
+        executed = None
+        self.output_kept = 0
+        try:
+            if self.timeout <= 0:
+                executed = self._timed_out()
+            else:
+                if use_agent:
+                    executed = agent.execute(
+                        agent.socket_path(container.name), self._script(), self.environ,
+                        self.timeout, self.output_limit, self.output_total,
+                        settings.EXECUTE_OUTPUT_KILL, settings.EXECUTE_RESOURCES
+                    )
+                if executed is None:
+                    executed = self._exec_run(container)
+            self.output_kept = len(executed["stdout"]) + len(executed["stderr"])
+        except Exception:  # pragma: no cover
+            logger.exception(f"An error occurred while executing the command '{self.command}'")
+        
+        return self.result(executed, time.time() - start)
+    
+    
+    def stream(self, container: Container, use_agent: bool = True) -> Iterator[Tuple[str, Any]]:
+        """Execute the command on the given container, yielding its output as it is written.
+        
+        Yields ('stdout', <str>) and ('stderr', <str>) for each chunk of output, and finally
+        ('exit', (<status>, <result>)) as returned by 'execute()', without 'stdout' and 'stderr'.
+        Only one chunk of output is held in memory at a time."""
+        start = time.time()
+        executed = None
+        self.output_kept = 0
+        decoders = {
+            name: codecs.getincrementaldecoder("utf-8")(errors="replace")
+            for name in ("stdout", "stderr")
+        }
+        try:
+            if self.timeout <= 0:
+                executed = self._timed_out()
+            else:
+                events = None
+                if use_agent:
+                    events = agent.stream(
+                        agent.socket_path(container.name), self._script(), self.environ,
+                        self.timeout, self.output_limit, self.output_total,
+                        settings.EXECUTE_OUTPUT_KILL, settings.EXECUTE_RESOURCES
+                    )
+                if events is None:
+                    events = self._exec_stream(container)
+                for name, data in events:
+                    if name == "exit":
+                        executed = {**data, "stdout": b"", "stderr": b""}
+                        continue
+                    self.output_kept += len(data)
+                    text = decoders[name].decode(data)
+                    if text:
+                        yield name, text
+                for name, decoder in decoders.items():
+                    # A character cut by the truncation of the output is dropped
+                    if executed is None or not executed["truncated"][name]:
+                        text = decoder.decode(b"", final=True)
+                        if text:
+                            yield name, text
+        except Exception:  # pragma: no cover
+            logger.exception(f"An error occurred while executing the command '{self.command}'")
+        
+        status, result = self.result(executed, time.time() - start)
+        del result["stdout"], result["stderr"]
+        yield "exit", (status, result)
+    
+    
+    def as_dict(self) -> dict:
+        """Return the representation of this command sent to the agent."""
+        return {
+            "command":        self._script(),
+            "environ":        self.environ,
+            "timeout":        self.timeout,
+            "limit":          self.output_limit,
+            "ignore_failure": self.ignore_failure,
+        }
 
 
 
@@ -132,26 +473,52 @@ class Executor:
     """This class provide methods to execute bash commands."""
     
     
-    def __init__(self, commands: List[Command], sandbox: Sandbox, env_uuid: str,
-                 result: str = None, save: bool = False):
+    def __init__(self, commands: List[Command], sandbox: Sandbox, env: utils.ExecutedEnv,
+                 result: str = None, save: bool = False, limits: Dict[str, Optional[int]] = None,
+                 cases: Optional[List[Command]] = None):
         self.commands = commands
+        # Cases executed after the commands (see 'Command.cases_from_config()'), if any.
+        self.cases = cases
         self.sandbox = sandbox
-        self.env_uuid = env_uuid
-        self.env_path = os.path.join(settings.ENVIRONMENT_ROOT, f"{env_uuid}.tgz")
+        self.env = env
+        self.env_uuid = env.uuid
         self.result_path = result
         self.save = save
+        # Limits declared by the request (see 'utils.parse_limits()').
+        self.limits = limits if limits is not None else {}
+        # Wall-clock time shared by the commands, only a safety net if their CPU time is limited.
+        self.timeout = settings.EXECUTE_TIMEOUT
+        if self.limits.get("cpu_time") is not None:
+            self.timeout = settings.EXECUTE_SAFETY_TIMEOUT
     
     
     def _move_env_to_container(self):
-        """Send the tar to the Docker and untar it inside the Docker"""
+        """Extract the environment into the directory of the container."""
         start = time.time()
         
-        with tarfile.open(self.env_path, "r:gz") as tar:
-            tar.extractall(self.sandbox.envpath)
+        self.env.extract(self.sandbox.envpath)
         
         logger.debug(f"Moving environment to container took : {time.time() - start} seconds")
     
     
+    def _apply_limits(self):
+        """Limit the memory and the number of processes of the container as declared by the
+        request, until the sandbox is released."""
+        memory, pids = self.limits.get("memory"), self.limits.get("pids")
+        if memory is not None or pids is not None:
+            self.sandbox.limit(memory, pids)
+    
+    
+    def _use_agent(self) -> bool:
+        """Return whether the commands can be sent to the agent of the container.
+        
+        Its socket must be the one found when the container was acquired, commands could
+        otherwise have replaced it with their own (see agent.py)."""
+        expected = self.sandbox.agent_socket
+        path = agent.socket_path(self.sandbox.container.name)
+        return expected is not None and agent.identity(path) == expected
+    
+    
     def _get_result(self) -> Optional[str]:
         """Return the content of /home/student/<path> if found, an empty string otherwise."""
         start = time.time()
@@ -161,25 +528,210 @@ class Executor:
         return content
     
     
+    def _execute_batch(self) -> Optional[List[Tuple[bool, dict]]]:
+        """Execute every command at once, through the agent of the container or a single
+        'docker exec' of its script.
+        
+        Like the agent, the 'docker exec' is bounded by the commands' timeout plus
+        agent.TIMEOUT_MARGIN seconds, being killed afterward.
+        
+        Returns whether each executed command succeeded and its result, or None if the commands
+        could not be executed at once (in which case none of them has been executed), e.g. if the
+        script of the agent is not mounted in the container. Raises ValueError if the
+        'docker exec' did not output the results (e.g. if it was killed)."""
+        if not agent_enabled():
+            return None
+        
+        container = self.sandbox.container
+        commands = [c.as_dict() for c in self.commands]
+        total = settings.EXECUTE_TOTAL_OUTPUT_LIMIT or None
+        kill, resources = settings.EXECUTE_OUTPUT_KILL, settings.EXECUTE_RESOURCES
+        
+        results = None
+        if self._use_agent():
+            results = agent.execute_all(
+                agent.socket_path(container.name), commands, self.timeout, total, kill, resources
+            )
+        if results is None:
+            batch = agent.batch_command(commands, self.timeout, total, kill, resources)
+            if batch is None:
+                return None
+            bound = f"{self.timeout + agent.TIMEOUT_MARGIN:.3f}"
+            exit_code, (stdout, stderr) = container.exec_run(
+                ["timeout", "-s", "KILL", bound, *batch], demux=True
+            )
+            if not stdout and exit_code in NOT_EXECUTED_EXIT_CODES:
+                # The agent's script (or python3) is not available in this container
+                return None
+            try:
+                results = json.loads(stdout)["results"]
+            except (TypeError, ValueError, KeyError):
+                raise ValueError(
+                    f"The commands executed at once exited with {exit_code} without results"
+                    + (f": {stderr.decode(errors='replace').strip()}" if stderr else "")
+                )
+        
+        executed = list()
+        for command, result in zip(self.commands, results):
+            command.timeout = result["timeout"]
+            result = agent.decode(result)
+            command.output_kept = len(result["stdout"]) + len(result["stderr"])
+            executed.append(command.result(result, result["time"]))
+        return executed
+    
+    
+    def _execute_commands(self) -> Iterator[Tuple[bool, dict]]:
+        """Execute each command until one fails, yielding whether it succeeded and its result.
+        
+        Commands share a total of <self.timeout> seconds and of
+        settings.EXECUTE_TOTAL_OUTPUT_LIMIT bytes of output. If settings.EXECUTE_BATCH is True,
+        they are executed at once (see '_execute_batch()'), otherwise one by one.
+        
+        Raises HTTPExceptions.INTERNAL_SERVER_ERROR if the commands executed at once failed, since
+        which of them was executing is unknown."""
+        if settings.EXECUTE_BATCH:
+            try:
+                executed = self._execute_batch()
+            except Exception as e:
+                logger.exception("An error occurred while executing the commands at once")
+                raise HTTPExceptions.INTERNAL_SERVER_ERROR.with_content(
+                    f"Could not execute the commands: {e}"
+                )
+            if executed is not None:
+                yield from executed
+                return
+        
+        timeout = self.timeout
+        total = settings.EXECUTE_TOTAL_OUTPUT_LIMIT or None
+        for command in self.commands:
+            command.timeout = min(command.timeout, timeout)
+            command.output_total = total
+            status, exec_result = command.execute(self.sandbox.container, self._use_agent())
+            yield status, exec_result
+            timeout -= max(exec_result["time"], 0)
+            if total is not None:
+                total -= command.output_kept
+    
+    
+    def _execute_cases(self, total: Optional[int], timeout: float) -> Iterator[dict]:
+        """Execute every case, yielding its result (see 'Command.result()') along with its
+        'status': 0 if it succeeded, its exit code otherwise.
+        
+        Each case is bounded by its own timeout, cases sharing at most <timeout> seconds and
+        <total> bytes of output (None means no limit). Once <timeout> is spent, the remaining
+        cases are not executed and time out right away. The stdin of each case is written to
+        STDIN_FILENAME, in the stdin directory of the container (see
+        'containers.stdin_directory()'), before executing it, the file being removed afterward."""
+        path = os.path.join(stdin_directory(self.sandbox.container.name), STDIN_FILENAME)
+        try:
+            for command in self.cases:
+                command.timeout = max(min(command.timeout, timeout), 0)
+                command.output_total = total
+                if command.stdin is not None and command.timeout > 0:
+                    with open(path, "w", encoding="UTF-8") as f:
+                        f.write(command.stdin)
+                status, exec_result = command.execute(self.sandbox.container, self._use_agent())
+                yield {"status": 0 if status else exec_result["exit_code"], **exec_result}
+                timeout -= max(exec_result["time"], 0)
+                if total is not None:
+                    total = max(total - command.output_kept, 0)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    
     def execute(self) -> dict:
-        """Execute each commands in the container."""
+        """Execute each commands in the container, and then each case if the commands
+        succeeded."""
         start = time.time()
         
         self._move_env_to_container()
+        self._apply_limits()
         
         execution = list()
-        timeout = settings.EXECUTE_TIMEOUT
-        for command in self.commands:
+        status = 0
+        if self.commands:
+            for command_status, exec_result in self._execute_commands():
+                execution.append(exec_result)
+                if not command_status:
+                    status = exec_result["exit_code"]
+                    break
+        
+        cases = None
+        if self.cases is not None:
+            cases = list()
+            if status == 0:
+                total = settings.EXECUTE_TOTAL_OUTPUT_LIMIT or None
+                if total is not None:
+                    total -= sum(c.output_kept for c, _ in zip(self.commands, execution))
+                timeout = self.timeout - sum(max(r["time"], 0) for r in execution)
+                total = max(total, 0) if total is not None else None
+                cases = list(self._execute_cases(total, timeout))
+        
+        return self._response(status, execution, start, cases)
+    
+    
+    def stream(self) -> Iterator[Tuple[str, dict]]:
+        """Execute each commands in the container, yielding events as they happen.
+        
+        Events are tuples (<name>, <data>):
+            - ('start', {'index', 'command'}) when a command starts.
+            - ('stdout', {'index', 'data'}) and ('stderr', {'index', 'data'}) for each chunk of
+              output of a command.
+            - ('exit', {'index', 'command', 'exit_code', 'time', 'bytes', 'truncated'}) when a
+              command exits.
+            - ('case', {'index', 'status', ...}) when a case exits, with its whole result (see
+              '_execute_cases()').
+            - ('result', <response>) once every command has been executed, <response> being the
+              same as the one of 'execute()', without the 'stdout' and 'stderr' of each command
+              and case."""
+        start = time.time()
+        
+        self._move_env_to_container()
+        self._apply_limits()
+        
+        execution = list()
+        status = 0
+        timeout = self.timeout
+        total = settings.EXECUTE_TOTAL_OUTPUT_LIMIT or None
+        for index, command in enumerate(self.commands):
             command.timeout = min(command.timeout, timeout)
-            status, exec_result = command.execute(self.sandbox.container)
+            command.output_total = total
+            yield "start", {"index": index, "command": command.command}
+            for name, data in command.stream(self.sandbox.container, self._use_agent()):
+                if name == "exit":
+                    command_status, exec_result = data
+                else:
+                    yield name, {"index": index, "data": data}
+            yield "exit", {"index": index, **exec_result}
+            
             execution.append(exec_result)
-            if not status:
+            if not command_status:
                 status = exec_result["exit_code"]
                 break
             timeout -= max(exec_result["time"], 0)
-        else:
-            status = 0
+            if total is not None:
+                total -= command.output_kept
+        
+        cases = None
+        if self.cases is not None:
+            cases = list()
+            if status == 0:
+                total = max(total, 0) if total is not None else None
+                for index, case_result in enumerate(self._execute_cases(total, timeout)):
+                    yield "case", {"index": index, **case_result}
+                    cases.append(case_result)
+                    del case_result["stdout"], case_result["stderr"]
+        
+        yield "result", self._response(status, execution, start, cases)
+    
+    
+    def _response(self, status: int, execution: List[dict], start: float,
+                  cases: Optional[List[dict]] = None) -> dict:
+        """Build the response of the execution, started at <start>, whose status is <status> and
+        whose commands' results are <execution>, and cases' results are <cases> (if any).
         
+        Result is retrieved from <self.result_path> and the environment is saved if needed."""
         result = None
         if self.result_path is not None:
             try:
@@ -194,17 +746,18 @@ class Executor:
             "execution":  execution,
             "total_time": time.time() - start,
         }
+        if cases is not None:
+            response["cases"] = cases
+        if settings.EXECUTE_RESOURCES:
+            response["resources"] = cgroups.combine(
+                [r["resources"] for r in execution + (cases or [])]
+            )
         
         if self.save:
             expire = timezone.now() + timedelta(seconds=settings.ENVIRONMENT_EXPIRATION)
             response["environment"] = self.env_uuid
             response["expire"] = expire.isoformat()
-            # Remove the one used by the container as it will cause an error in extract_env if the
-            # destination already exists.
-            os.remove(self.env_path)
             self.sandbox.extract_env(self.env_uuid)
-        else:
-            os.remove(self.env_path)
         
         if result is not None:
             response["result"] = result
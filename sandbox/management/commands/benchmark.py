@@ -0,0 +1,85 @@
+# benchmark.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import json
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django_http_exceptions import HTTPExceptions
+
+from sandbox.containers import Sandbox
+from sandbox.executor import Command as SandboxCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the overhead of executing a command in a container of the pool: the command is "
+        "executed --count times and statistics about its duration (in milliseconds) are displayed."
+    )
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count", type=int, default=100,
+            help="Number of executions (default: 100)."
+        )
+        parser.add_argument(
+            "--command", default="true",
+            help="Executed command (default: 'true')."
+        )
+        parser.add_argument(
+            "--timeout", type=float, default=settings.EXECUTE_TIMEOUT,
+            help="Timeout of the command (default: settings.EXECUTE_TIMEOUT)."
+        )
+        parser.add_argument(
+            "--no-agent", action="store_true",
+            help="Execute the command through 'docker exec' even if the container has an agent."
+        )
+    
+    
+    @staticmethod
+    def acquire(timeout: float) -> Sandbox:
+        """Acquire a sandbox, waiting for at most <timeout> seconds for the pool to be
+        initialised."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return Sandbox.acquire(max_wait=settings.WAIT_FOR_CONTAINER_DURATION)
+            except HTTPExceptions.SERVICE_UNAVAILABLE:
+                if time.time() > deadline:
+                    raise CommandError("Could not acquire a container")
+                time.sleep(1)
+    
+    
+    def handle(self, *args, **options):
+        if options["count"] < 1:
+            raise CommandError("--count must be a positive integer")
+        
+        use_agent = not options["no_agent"]
+        command = SandboxCommand(options["command"], timeout=options["timeout"])
+        sandbox = self.acquire(60)
+        try:
+            durations = list()
+            for _ in range(options["count"]):
+                start = time.perf_counter()
+                command.execute(sandbox.container, use_agent)
+                durations.append((time.perf_counter() - start) * 1000)
+        finally:
+            sandbox.release()
+        
+        durations.sort()
+        self.stdout.write(json.dumps({
+            "command": options["command"],
+            "agent":   use_agent,
+            "count":   len(durations),
+            "mean":    statistics.mean(durations),
+            "median":  statistics.median(durations),
+            "p90":     durations[int(0.9 * (len(durations) - 1))],
+            "min":     durations[0],
+            "max":     durations[-1],
+        }, indent=4))
@@ -0,0 +1,131 @@
+# benchmark_codec.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import tarfile
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from sandbox import archives
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the throughput of each codec of the environments (see archives.py): an "
+        "environment made of --files files of --size bytes (source code like text if --random is "
+        "not given) is written and extracted --count times with each codec, and the throughput of "
+        "both (in MB of tar per second) and the size of the archive are displayed."
+    )
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count", type=int, default=5,
+            help="Number of compressions and extractions with each codec (default: 5)."
+        )
+        parser.add_argument(
+            "--files", type=int, default=100,
+            help="Number of files of the environment (default: 100)."
+        )
+        parser.add_argument(
+            "--size", type=int, default=256 * 1024,
+            help="Size of each file in bytes (default: 262144)."
+        )
+        parser.add_argument(
+            "--random", action="store_true",
+            help="Fill the files with random bytes, which cannot be compressed."
+        )
+        parser.add_argument(
+            "--level", type=int, default=None,
+            help="Compression level (default: ENVIRONMENT_CODEC_LEVEL)."
+        )
+    
+    
+    @staticmethod
+    def content(size: int, randomised: bool) -> bytes:
+        """Return <size> bytes, random or looking like source code."""
+        if randomised:
+            return os.urandom(size)
+        words = [
+            "def", "return", "self", "import", "class", "for", "in", "if", "else", "None", "=",
+            "(", ")", ":", "path", "name", "value", "result", "#", "\n", "    ", "\n    ",
+        ] + [f"var{random.randrange(1000)}" for _ in range(200)]
+        content = " ".join(random.choice(words) for _ in range(size // 3)).encode()
+        return (content * (size // max(len(content), 1) + 1))[:size]
+    
+    
+    def create_tar(self, files: int, size: int, randomised: bool) -> bytes:
+        """Return an uncompressed tar containing <files> files of <size> bytes."""
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for i in range(files):
+                info = tarfile.TarInfo(f"dir{i % 10}/file{i}")
+                info.size = size
+                tar.addfile(info, io.BytesIO(self.content(size, randomised)))
+        return buffer.getvalue()
+    
+    
+    @staticmethod
+    def measure(codec: archives.Codec, tar: bytes, root: str, count: int) -> dict:
+        """Compress <tar> with <codec> and extract it into <root> <count> times, returning the
+        throughputs and the size of the archive."""
+        compressions, extractions, archive = list(), list(), b""
+        mb = len(tar) / 1024 / 1024
+        for _ in range(count):
+            dest = io.BytesIO()
+            start = time.perf_counter()
+            archives.convert(io.BytesIO(tar), codec, dest)
+            compressions.append(mb / (time.perf_counter() - start))
+            archive = dest.getvalue()
+            
+            path = tempfile.mkdtemp(dir=root)
+            start = time.perf_counter()
+            with archives.open_tar(io.BytesIO(archive), "r") as t:
+                t.extractall(path)
+            extractions.append(mb / (time.perf_counter() - start))
+            shutil.rmtree(path)
+        
+        return {
+            "compression": statistics.median(compressions),
+            "extraction":  statistics.median(extractions),
+            "size":        len(archive),
+            "ratio":       len(tar) / len(archive),
+        }
+    
+    
+    def handle(self, *args, **options):
+        if options["count"] < 1 or options["files"] < 1 or options["size"] < 0:
+            raise CommandError("--count and --files must be positive, --size cannot be negative")
+        
+        tar = self.create_tar(options["files"], options["size"], options["random"])
+        results = dict()
+        root = tempfile.mkdtemp()
+        try:
+            with override_settings(ENVIRONMENT_CODEC_LEVEL=options["level"]):
+                for name, codec in archives.CODECS.items():
+                    try:
+                        results[name] = self.measure(codec, tar, root, options["count"])
+                    except Exception as e:  # e.g. 'zstandard' is not installed
+                        results[name] = {"error": str(e)}
+        finally:
+            shutil.rmtree(root)
+        
+        self.stdout.write(json.dumps({
+            "count":   options["count"],
+            "files":   options["files"],
+            "size":    options["size"],
+            "random":  options["random"],
+            "tar":     len(tar),
+            "results": results,
+        }, indent=4))
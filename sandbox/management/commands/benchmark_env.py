@@ -0,0 +1,163 @@
+# benchmark_env.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import io
+import json
+import os
+import shutil
+import statistics
+import tarfile
+import tempfile
+import time
+import uuid
+from typing import Callable, List
+
+import psutil
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from sandbox import cache, utils
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the I/O needed to set up the environment of an execution: environments made of "
+        "--files random files of --size bytes are extracted --count times, either through an "
+        "intermediate '<uuid4>.tgz' (as it used to be), directly, or from the cache of extracted "
+        "environments, and the time (in milliseconds) and the bytes read and written per request "
+        "are displayed."
+    )
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count", type=int, default=20,
+            help="Number of extractions of each environment (default: 20)."
+        )
+        parser.add_argument(
+            "--files", type=int, default=100,
+            help="Number of files of each environment (default: 100)."
+        )
+        parser.add_argument(
+            "--size", type=int, default=64 * 1024,
+            help="Size of each file in bytes (default: 65536)."
+        )
+    
+    
+    @staticmethod
+    def create_env(path: str, prefix: str, files: int, size: int):
+        """Create an environment at <path> containing <files> random files of <size> bytes, half
+        of them being named after <prefix>, the other half being common to every environment."""
+        with tarfile.open(path, "w:gz") as tar:
+            for i in range(files):
+                name = f"{prefix}{i}" if i % 2 else f"common{i}"
+                info = tarfile.TarInfo(name)
+                info.size = size
+                tar.addfile(info, io.BytesIO(os.urandom(size)))
+    
+    
+    @staticmethod
+    def staged(root: str, paths: List[str], envpath: str, stored: bool):
+        """Extract <paths> into <envpath> through an intermediate archive, as it used to be,
+        <stored> telling whether a single environment would have been linked from the store
+        instead of being copied."""
+        path = os.path.join(root, f"{uuid.uuid4()}.tgz")
+        if len(paths) == 2:
+            names = set()
+            with tarfile.open(path, "w:gz") as merged:
+                for source in paths:  # A file of the first archive prevails
+                    with tarfile.open(source, "r|gz") as tar:
+                        for member in tar:
+                            if member.name not in names:
+                                names.add(member.name)
+                                content = tar.extractfile(member) if member.isreg() else None
+                                merged.addfile(member, content)
+        elif paths and stored:
+            os.link(paths[0], path)
+        elif paths:
+            shutil.copyfile(paths[0], path)
+        else:
+            tarfile.open(path, "x:gz").close()
+        
+        with tarfile.open(path, "r:gz") as tar:
+            tar.extractall(envpath)
+        os.remove(path)
+    
+    
+    @staticmethod
+    def direct(_: str, paths: List[str], envpath: str, __: bool):
+        """Extract <paths> into <envpath> as done before an execution."""
+        utils.ExecutedEnv(paths).extract(envpath)
+    
+    
+    @staticmethod
+    def measure(function: Callable, root: str, paths: List[str], stored: bool, count: int) -> dict:
+        """Call <function> <count> times, returning the time and the mean I/O of a call."""
+        process = psutil.Process()
+        durations, read, written = list(), 0, 0
+        for _ in range(count):
+            envpath = tempfile.mkdtemp(dir=root)
+            before = process.io_counters()
+            start = time.perf_counter()
+            function(root, paths, envpath, stored)
+            durations.append((time.perf_counter() - start) * 1000)
+            after = process.io_counters()
+            read += after.read_chars - before.read_chars
+            written += after.write_chars - before.write_chars
+            shutil.rmtree(envpath)
+        
+        return {
+            "mean":    statistics.mean(durations),
+            "median":  statistics.median(durations),
+            "read":    read // count,
+            "written": written // count,
+        }
+    
+    
+    def handle(self, *args, **options):
+        if options["count"] < 1 or options["files"] < 1 or options["size"] < 0:
+            raise CommandError("--count and --files must be positive, --size cannot be negative")
+        
+        root = tempfile.mkdtemp()
+        try:
+            upload = os.path.join(root, "upload.tgz")
+            saved = os.path.join(root, "saved.tgz")
+            self.create_env(upload, "upload", options["files"], options["size"])
+            self.create_env(saved, "saved", options["files"], options["size"])
+            sizes = {"upload": os.path.getsize(upload), "saved": os.path.getsize(saved)}
+            
+            results = dict()
+            scenarios = {
+                "empty":  ([], False),
+                "upload": ([upload], True),
+                "saved":  ([saved], False),
+                "merged": ([upload, saved], False),
+            }
+            for scenario, (paths, stored) in scenarios.items():
+                with override_settings(ENVIRONMENT_CACHE_SIZE=0):
+                    staged = self.measure(self.staged, root, paths, stored, options["count"])
+                    direct = self.measure(self.direct, root, paths, stored, options["count"])
+                with override_settings(DOCKER_VOLUME_HOST_BASEDIR=root):
+                    self.measure(self.direct, root, paths, stored, 2)  # Fill the cache
+                    cached = self.measure(self.direct, root, paths, stored, options["count"])
+                    cache.clear()
+                results[scenario] = {
+                    "staged":        staged,
+                    "direct":        direct,
+                    "cached":        cached,
+                    "read_saved":    staged["read"] - direct["read"],
+                    "written_saved": staged["written"] - direct["written"],
+                }
+        finally:
+            shutil.rmtree(root)
+        
+        self.stdout.write(json.dumps({
+            "count":    options["count"],
+            "files":    options["files"],
+            "size":     options["size"],
+            "archives": sizes,
+            "results":  results,
+        }, indent=4))
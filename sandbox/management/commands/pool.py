@@ -0,0 +1,87 @@
+# pool.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import json
+import time
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Display or change the pool of containers of a running sandbox: its size, the image or "
+        "the parameters of the containers. Containers running an execution are not interrupted."
+    )
+    
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url", default="http://127.0.0.1:8000",
+            help="URL of the running sandbox (default: http://127.0.0.1:8000)."
+        )
+        parser.add_argument(
+            "--token", default=settings.ADMIN_TOKEN,
+            help="Token used to authenticate to the sandbox (default: settings.ADMIN_TOKEN)."
+        )
+        parser.add_argument(
+            "--size", type=int,
+            help="Number of containers that can be used simultaneously."
+        )
+        parser.add_argument(
+            "--image",
+            help="Image used to create the containers."
+        )
+        parser.add_argument(
+            "--parameters",
+            help="JSON object merged into DOCKER_PARAMETERS, e.g. '{\"mem_limit\": \"200m\"}'."
+        )
+        parser.add_argument(
+            "--wait", action="store_true",
+            help="Wait for the new generation of containers to be rolled out."
+        )
+    
+    
+    def request(self, method, url, token, **kwargs) -> dict:
+        """Send a request to the '/pool/' endpoint, returning the decoded response."""
+        try:
+            response = requests.request(
+                method, url, headers={"Authorization": f"Token {token}"}, **kwargs
+            )
+        except requests.RequestException as e:
+            raise CommandError(f"Could not reach the sandbox at '{url}' - {e}")
+        if not response.ok:
+            raise CommandError(f"{response.status_code}: {response.text}")
+        return response.json()
+    
+    
+    def handle(self, *args, **options):
+        if options["token"] is None:
+            raise CommandError("No token given and settings.ADMIN_TOKEN is not set")
+        url = options["url"].rstrip("/") + "/pool/"
+        
+        config = dict()
+        if options["size"] is not None:
+            config["size"] = options["size"]
+        if options["image"] is not None:
+            config["image"] = options["image"]
+        if options["parameters"] is not None:
+            try:
+                config["parameters"] = json.loads(options["parameters"])
+            except json.JSONDecodeError as e:
+                raise CommandError(f"--parameters is not a valid JSON - {e}")
+        
+        if config:
+            pool = self.request("POST", url, options["token"], json=config)
+        else:
+            pool = self.request("GET", url, options["token"])
+        
+        while options["wait"] and pool["rolling_out"]:
+            time.sleep(1)
+            pool = self.request("GET", url, options["token"])
+        
+        self.stdout.write(json.dumps(pool, indent=4))
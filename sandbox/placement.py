@@ -0,0 +1,186 @@
+# placement.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Assign a distinct set of CPUs ('cpuset_cpus') to each container.
+
+The CPUs of DOCKER_PARAMETERS["cpuset_cpus"] are split into slots of DOCKER_CPUS_PER_CONTAINER
+CPUs, according to the topology of the host read from '/sys/devices/system/':
+
+    - When a slot contains a single CPU, the first hardware thread of every physical core is used
+      before their SMT siblings, so that containers do not share a core until needed.
+    - When a slot contains several CPUs, SMT siblings are grouped together and, if DOCKER_CPU_NUMA
+      is True, a slot never spans several NUMA nodes.
+    - If DOCKER_CPU_SMT is False, only the first hardware thread of each core is used.
+
+Each container is then assigned the least loaded slot, wrapping around when there are more
+containers than slots."""
+
+import os
+import threading
+from itertools import groupby
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+
+
+SYSFS_CPU_ROOT = "/sys/devices/system/cpu"
+SYSFS_NODE_ROOT = "/sys/devices/system/node"
+
+
+
+def parse_cpuset(cpuset: str) -> List[int]:
+    """Return the sorted list of CPUs of <cpuset> (e.g. '0-3,8' -> [0, 1, 2, 3, 8])."""
+    cpus = set()
+    for part in filter(None, (p.strip() for p in cpuset.split(","))):
+        if "-" in part:
+            lower, upper = part.split("-")
+            cpus.update(range(int(lower), int(upper) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+
+def format_cpuset(cpus: List[int]) -> str:
+    """Return the cpuset string corresponding to <cpus> (e.g. [0, 1, 2, 3, 8] -> '0-3,8')."""
+    ranges = list()
+    for _, group in groupby(enumerate(sorted(cpus)), lambda t: t[1] - t[0]):
+        group = [cpu for _, cpu in group]
+        ranges.append(str(group[0]) if len(group) == 1 else f"{group[0]}-{group[-1]}")
+    return ",".join(ranges)
+
+
+
+def _read(path: str, default: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+
+def cpu_topology(cpu: int) -> Tuple[int, int, int]:
+    """Return the NUMA node, the physical package and the core of <cpu>.
+    
+    Each CPU is considered to be its own core, on node 0, if the topology cannot be read."""
+    node = 0
+    if os.path.isdir(SYSFS_NODE_ROOT):
+        for entry in os.scandir(SYSFS_NODE_ROOT):
+            if entry.name.startswith("node") and entry.name[4:].isdigit():
+                cpulist = _read(os.path.join(entry.path, "cpulist"), "")
+                if cpu in parse_cpuset(cpulist):
+                    node = int(entry.name[4:])
+                    break
+    
+    topology = os.path.join(SYSFS_CPU_ROOT, f"cpu{cpu}", "topology")
+    package = int(_read(os.path.join(topology, "physical_package_id"), "0"))
+    core = int(_read(os.path.join(topology, "core_id"), str(-cpu - 1)))
+    return node, package, core
+
+
+
+def compute_slots(cpuset: str, per_container: int, smt: bool = True,
+                  numa: bool = True) -> List[List[int]]:
+    """Split the CPUs of <cpuset> into slots of <per_container> CPUs, see the module's
+    documentation."""
+    cpus = parse_cpuset(cpuset)
+    topology = {cpu: cpu_topology(cpu) for cpu in cpus}
+    
+    # Group hardware threads by physical core, sorted by node and core.
+    cores: Dict[Tuple[int, int, int], List[int]] = dict()
+    for cpu in cpus:
+        cores.setdefault(topology[cpu], list()).append(cpu)
+    cores = dict(sorted(cores.items()))
+    if not smt:
+        cores = {k: v[:1] for k, v in cores.items()}
+    
+    if per_container <= 1:
+        # Every first thread, then every second thread, etc...
+        depth = max(len(threads) for threads in cores.values())
+        return [
+            [threads[i]] for i in range(depth) for threads in cores.values() if i < len(threads)
+        ]
+    
+    slots = list()
+    nodes = groupby(cores.items(), (lambda t: t[0][0]) if numa else (lambda t: 0))
+    for _, node_cores in nodes:
+        node_cpus = [cpu for _, threads in node_cores for cpu in threads]
+        slots += [
+            node_cpus[i:i + per_container]
+            for i in range(0, len(node_cpus) - per_container + 1, per_container)
+        ]
+    
+    # Not enough CPUs to fill a single slot, every container uses every CPU.
+    return slots or [[cpu for threads in cores.values() for cpu in threads]]
+
+
+
+class CpuPlacement:
+    """Keep track of the slot assigned to each container."""
+    
+    
+    def __init__(self, slots: List[List[int]]):
+        self.slots = [format_cpuset(s) for s in slots]
+        self.loads = [0] * len(self.slots)
+        self.assigned: Dict[int, int] = dict()
+        self.lock = threading.Lock()
+    
+    
+    @classmethod
+    def from_settings(cls) -> 'CpuPlacement':
+        """Create a placement from DOCKER_PARAMETERS["cpuset_cpus"],
+        DOCKER_CPUS_PER_CONTAINER, DOCKER_CPU_SMT and DOCKER_CPU_NUMA."""
+        return cls(compute_slots(
+            settings.DOCKER_PARAMETERS["cpuset_cpus"], settings.DOCKER_CPUS_PER_CONTAINER,
+            settings.DOCKER_CPU_SMT, settings.DOCKER_CPU_NUMA
+        ))
+    
+    
+    def _release(self, index: int):
+        slot = self.assigned.pop(index, None)
+        if slot is not None:
+            self.loads[slot] -= 1
+    
+    
+    def assign(self, index: int) -> str:
+        """Assign the least loaded slot to the container <index>, returning its cpuset.
+        
+        Any slot previously assigned to this container is released first, so that recreated
+        containers are rebalanced."""
+        with self.lock:
+            self._release(index)
+            slot = min(range(len(self.slots)), key=lambda i: self.loads[i])
+            self.assigned[index] = slot
+            self.loads[slot] += 1
+            return self.slots[slot]
+    
+    
+    def claim(self, index: int, cpuset: str) -> bool:
+        """Assign the slot corresponding to <cpuset> to the container <index>. Returns False if
+        <cpuset> does not correspond to any slot."""
+        try:
+            slot = self.slots.index(format_cpuset(parse_cpuset(cpuset)))
+        except ValueError:
+            return False
+        
+        with self.lock:
+            self._release(index)
+            self.assigned[index] = slot
+            self.loads[slot] += 1
+        return True
+    
+    
+    def release(self, index: int):
+        """Release the slot assigned to the container <index>."""
+        with self.lock:
+            self._release(index)
+    
+    
+    def assignments(self) -> Dict[int, str]:
+        """Return the cpuset assigned to each container."""
+        with self.lock:
+            return {i: self.slots[s] for i, s in sorted(self.assigned.items())}
@@ -0,0 +1,123 @@
+# scheduler.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Decide which waiting request is granted the next container.
+
+Requests belong to a priority class (SCHEDULER_PRIORITIES, e.g. 'interactive' before 'batch') and
+to a client. A lease is granted to the waiting request with the lowest priority; a request gains
+one level of priority every SCHEDULER_AGING seconds spent waiting so that lower classes are never
+starved. Between requests of the same priority, leases are shared between clients according to
+their weight (SCHEDULER_WEIGHTS) using start-time fair queuing: each client has a virtual time
+growing by 1 / weight for each lease granted, the client with the lowest one being served first."""
+
+import threading
+import time
+from typing import Dict, List
+
+from django.conf import settings
+
+
+class _Ticket:
+    """A request waiting for a lease."""
+    
+    __slots__ = ("priority", "client", "arrival")
+    
+    
+    def __init__(self, priority: str, client: str):
+        self.priority = priority
+        self.client = client
+        self.arrival = time.time()
+
+
+class Scheduler:
+    """Count the acquired containers, limiting them to <limit>, and order the requests waiting
+    for one."""
+    
+    
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+        self.tickets: List[_Ticket] = list()
+        # Virtual time of the last lease granted, and of each client.
+        self.virtual = 0.0
+        self.clients: Dict[str, float] = dict()
+    
+    
+    @property
+    def waiting(self) -> int:
+        """Number of requests waiting for a lease."""
+        return len(self.tickets)
+    
+    
+    def waiting_by_priority(self) -> Dict[str, int]:
+        """Return the number of requests waiting for a lease in each priority class."""
+        with self.condition:
+            waiting = {priority: 0 for priority in settings.SCHEDULER_PRIORITIES}
+            for ticket in self.tickets:
+                waiting[ticket.priority] = waiting.get(ticket.priority, 0) + 1
+            return waiting
+    
+    
+    def _key(self, ticket: _Ticket, now: float) -> tuple:
+        """Return the key ordering <ticket> among the waiting ones, the lowest is served first."""
+        priority = settings.SCHEDULER_PRIORITIES.get(ticket.priority, 0)
+        if settings.SCHEDULER_AGING:
+            priority -= (now - ticket.arrival) / settings.SCHEDULER_AGING
+        start = max(self.virtual, self.clients.get(ticket.client, 0.0))
+        return priority, start, ticket.arrival
+    
+    
+    def _next(self) -> _Ticket:
+        """Return the ticket that must be served next."""
+        now = time.time()
+        return min(self.tickets, key=lambda t: self._key(t, now))
+    
+    
+    def _charge(self, client: str):
+        """Advance the virtual time of <client> after it has been granted a lease."""
+        start = max(self.virtual, self.clients.get(client, 0.0))
+        self.virtual = start
+        self.clients[client] = start + 1 / settings.SCHEDULER_WEIGHTS.get(client, 1)
+        # Clients behind the virtual time are equivalent to new ones.
+        if len(self.clients) > 1000:
+            self.clients = {c: v for c, v in self.clients.items() if v > self.virtual}
+    
+    
+    def acquire(self, timeout: float, priority: str = None, client: str = "") -> bool:
+        """Wait for at most <timeout> seconds for a lease, returns False if none could be
+        acquired."""
+        if priority is None:
+            priority = settings.SCHEDULER_DEFAULT_PRIORITY
+        
+        with self.condition:
+            ticket = _Ticket(priority, client)
+            self.tickets.append(ticket)
+            try:
+                acquired = self.condition.wait_for(
+                    lambda: self.used < self.limit and self._next() is ticket, timeout
+                )
+                if acquired:
+                    self.used += 1
+                    self._charge(client)
+                return acquired
+            finally:
+                self.tickets.remove(ticket)
+                self.condition.notify_all()
+    
+    
+    def release(self):
+        """Give a lease back."""
+        with self.condition:
+            self.used -= 1
+            self.condition.notify_all()
+    
+    
+    def resize(self, limit: int):
+        """Change the maximum number of leases."""
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
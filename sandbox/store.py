@@ -0,0 +1,120 @@
+# store.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Content-addressed store of the uploaded environments.
+
+Environments uploaded by the clients are stored once, whatever the number of requests uploading
+them, in [ENVIRONMENT_ROOT]/.sha256/<sha256 of the archive>.blob, from which they are extracted
+directly into the sandboxes. They are kept as uploaded, whatever their codec (see archives.py): the
+SHA-256 is the one of the uploaded bytes, and the codec is detected from the first bytes of the
+archive when it is read, hence the neutral extension.
+A stored environment is removed once it has not been used for ENVIRONMENT_EXPIRATION seconds, the
+executions using it having opened it beforehand.
+
+Clients can check whether an environment is already stored through a HEAD on
+'/uploads/<sha256>/' and refer to it with the field 'sha256' of their config instead of uploading
+it again."""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import BinaryIO, Optional
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+STORE_DIRNAME = ".sha256"
+
+# Extension of the stored environments, which can be archives of any codec.
+BLOB_EXTENSION = ".blob"
+
+# Prefix of the files being written to the store.
+TEMPORARY_PREFIX = ".upload-"
+
+# Size of the chunks read when hashing an environment.
+CHUNK_SIZE = 1024 * 1024
+
+_SHA256 = re.compile(r"[0-9a-f]{64}")
+
+
+
+def store_dir() -> str:
+    """Return the path of the directory of the store, creating it if needed."""
+    path = os.path.join(settings.ENVIRONMENT_ROOT, STORE_DIRNAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+
+def is_sha256(sha256: str) -> bool:
+    """Return True if <sha256> is the hexadecimal digest of a SHA-256."""
+    return isinstance(sha256, str) and _SHA256.fullmatch(sha256) is not None
+
+
+
+def path(sha256: str) -> str:
+    """Return the path of the environment <sha256> in the store."""
+    return os.path.join(store_dir(), f"{sha256}{BLOB_EXTENSION}")
+
+
+
+def get(sha256: str) -> Optional[str]:
+    """Return the path of the environment <sha256>, None if it is not stored.
+    
+    Its time of last use is updated, so that it is kept for another ENVIRONMENT_EXPIRATION
+    seconds."""
+    if not is_sha256(sha256):
+        return None
+    
+    stored = path(sha256)
+    try:
+        os.utime(stored)
+    except FileNotFoundError:
+        return None
+    return stored
+
+
+
+def put(file: BinaryIO) -> str:
+    """Store the content of <file>, returning its SHA-256.
+    
+    The content is written to a temporary file while being hashed, and then atomically renamed,
+    so that concurrent uploads of the same environment are safe. The temporary file is discarded
+    if the environment is already stored."""
+    digest = hashlib.sha256()
+    fd, temporary = tempfile.mkstemp(prefix=TEMPORARY_PREFIX, dir=store_dir())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        
+        sha256 = digest.hexdigest()
+        if get(sha256) is None:
+            os.rename(temporary, path(sha256))
+        return sha256
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+
+def remove_expired():
+    """Remove the environments that have not been used for ENVIRONMENT_EXPIRATION seconds, as well
+    as the files of interrupted uploads."""
+    now = time.time()
+    for entry in os.scandir(store_dir()):
+        try:
+            if now - entry.stat().st_mtime >= settings.ENVIRONMENT_EXPIRATION:
+                os.remove(entry.path)
+                logger.info(f"Stored environment {entry.name} has expired and has been deleted.")
+        except FileNotFoundError:  # pragma: no cover
+            pass  # Removed concurrently
@@ -11,6 +11,7 @@ import time
 
 from django.conf import settings
 
+from sandbox import cache, store
 from sandbox.git import clone, pull
 
 
@@ -30,13 +31,20 @@ def refresh_external_libs():
 
 
 def remove_expired_env():
-    """Remove every file of MEDIA_ROOT that are expired according to ENVIRONMENT_EXPIRATION."""
+    """Remove every file of MEDIA_ROOT that are expired according to ENVIRONMENT_EXPIRATION, and
+    the environments of the store (see store.py) which are not used anymore, invalidating their
+    extracted copy in the cache (see cache.py)."""
     current_time = time.time()
     
     for f in os.listdir(settings.ENVIRONMENT_ROOT):
+        if f == store.STORE_DIRNAME:
+            continue
         path = os.path.join(settings.ENVIRONMENT_ROOT, f)
         creation_time = os.path.getctime(path)
         
         if (current_time - creation_time) >= settings.ENVIRONMENT_EXPIRATION:
             os.remove(path) if os.path.isfile(path) else shutil.rmtree(path)
             logger.info(f"environment {f} has expired and has been deleted.")
+    
+    store.remove_expired()
+    cache.remove_expired()
@@ -0,0 +1,383 @@
+# test_agent.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import base64
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from django.test import SimpleTestCase, override_settings
+from django_http_exceptions.exceptions import HTTPException
+
+from .. import agent
+from ..enums import SandboxErrCode
+from ..executor import Command, Executor
+from ..utils import ExecutedEnv
+
+
+BASEDIR = tempfile.mkdtemp()
+
+
+
+@override_settings(DOCKER_VOLUME_HOST_BASEDIR=BASEDIR)
+class AgentTestCase(SimpleTestCase):
+    """Run the agent as a process of the host."""
+    
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        agent.create("c0")
+        cls.path = agent.socket_path("c0")
+        cls.process = subprocess.Popen([sys.executable, agent.SCRIPT, cls.path], cwd=BASEDIR)
+        while not os.path.exists(cls.path):
+            time.sleep(0.01)
+    
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.wait()
+        shutil.rmtree(BASEDIR, ignore_errors=True)
+        super().tearDownClass()
+    
+    
+    def test_execute(self):
+        executed = agent.execute(self.path, "echo out; echo err >&2; exit 3", {}, 1)
+        self.assertEqual(3, executed["exit_code"])
+        self.assertEqual(b"out\n", executed["stdout"])
+        self.assertEqual(b"err\n", executed["stderr"])
+        self.assertFalse(executed["timed_out"])
+    
+    
+    def test_execute_environ(self):
+        executed = agent.execute(self.path, "echo $VAR", {"VAR": "My var"}, 1)
+        self.assertEqual(b"My var\n", executed["stdout"])
+    
+    
+    def test_execute_timeout(self):
+        marker = os.path.join(BASEDIR, "marker")
+        start = time.time()
+        executed = agent.execute(self.path, f"(sleep 0.5; touch {marker}) & sleep 5", {}, 0.2)
+        self.assertTrue(executed["timed_out"])
+        self.assertLess(time.time() - start, 1)
+        time.sleep(0.5)
+        self.assertFalse(os.path.exists(marker))
+    
+    
+    def test_execute_background(self):
+        start = time.time()
+        executed = agent.execute(self.path, "sleep 5 &", {}, 1)
+        self.assertEqual(0, executed["exit_code"])
+        self.assertFalse(executed["timed_out"])
+        self.assertLess(time.time() - start, 1)
+    
+    
+    def test_execute_limit(self):
+        executed = agent.execute(self.path, "head -c 1000 /dev/zero; echo err >&2", {}, 1, 10)
+        self.assertEqual(0, executed["exit_code"])
+        self.assertEqual(b"\0" * 10, executed["stdout"])
+        self.assertEqual(b"err\n", executed["stderr"])
+        self.assertEqual({"stdout": 1000, "stderr": 4}, executed["bytes"])
+        self.assertEqual({"stdout": True, "stderr": False}, executed["truncated"])
+        self.assertFalse(executed["exceeded"])
+        
+        executed = agent.execute(self.path, "echo 1234; echo 5678 >&2", {}, 1, None, 7)
+        self.assertEqual(7, len(executed["stdout"] + executed["stderr"]))
+    
+    
+    def test_execute_limit_kill(self):
+        start = time.time()
+        executed = agent.execute(self.path, "yes", {}, 2, 1000, None, True)
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(executed["exceeded"])
+        self.assertFalse(executed["timed_out"])
+        self.assertEqual(1000, len(executed["stdout"]))
+        self.assertTrue(executed["truncated"]["stdout"])
+    
+    
+    def test_execute_unreachable(self):
+        self.assertIsNone(agent.execute(agent.socket_path("c1"), "true", {}, 1))
+    
+    
+    def test_command(self):
+        container = types.SimpleNamespace(name="c0")
+        status, result = Command("echo $((1+1))", timeout=1).execute(container)
+        self.assertTrue(status)
+        self.assertEqual(0, result["exit_code"])
+        self.assertEqual("2", result["stdout"])
+        
+        status, result = Command("sleep 1", timeout=0.2).execute(container)
+        self.assertFalse(status)
+        self.assertEqual(SandboxErrCode.TIMEOUT, result["exit_code"])
+        self.assertEqual("Command timed out after 0.2 seconds\n", result["stderr"])
+    
+    
+    def test_execute_all(self):
+        commands = [
+            Command("echo 1").as_dict(),
+            Command("-false").as_dict(),
+            Command("echo $VAR", environ={"VAR": "My var"}).as_dict(),
+            Command("false").as_dict(),
+            Command("true").as_dict(),
+        ]
+        results = agent.execute_all(self.path, commands, 1)
+        self.assertEqual([0, 1, 0, 1], [r["exit_code"] for r in results])
+        self.assertEqual(b"My var\n", agent.decode(results[2])["stdout"])
+        self.assertTrue(all(r["time"] >= 0 for r in results))
+    
+    
+    def test_execute_all_total(self):
+        commands = [
+            Command("printf 12345").as_dict(),
+            Command("printf 67890").as_dict(),
+            Command("printf abc").as_dict(),
+        ]
+        results = agent.execute_all(self.path, commands, 1, 8)
+        self.assertEqual(
+            [b"12345", b"678", b""], [agent.decode(r)["stdout"] for r in results]
+        )
+        self.assertEqual([False, True, True], [r["truncated"]["stdout"] for r in results])
+        
+        results = agent.execute_all(self.path, commands, 1, 8, True)
+        self.assertEqual(2, len(results))
+        self.assertTrue(results[1]["exceeded"])
+    
+    
+    def test_execute_all_timeout(self):
+        commands = [
+            Command("sleep 0.3", timeout=1).as_dict(),
+            Command("-sleep 1", timeout=1).as_dict(),
+            Command("true").as_dict(),
+        ]
+        results = agent.execute_all(self.path, commands, 0.5)
+        self.assertEqual(3, len(results))
+        self.assertFalse(results[0]["timed_out"])
+        self.assertTrue(results[1]["timed_out"])
+        self.assertLess(results[1]["timeout"], 0.25)
+        self.assertTrue(results[2]["timed_out"])
+        self.assertLessEqual(results[2]["timeout"], 0)
+    
+    
+    def test_batch_command(self):
+        command = agent.batch_command([Command("echo 1").as_dict()], 1)
+        self.assertEqual(["python3", agent.CONTAINER_SCRIPT, "--batch"], command[:3])
+        
+        output = subprocess.check_output([sys.executable, agent.SCRIPT, *command[2:]])
+        results = json.loads(output)["results"]
+        self.assertEqual(1, len(results))
+        self.assertEqual(b"1\n", base64.b64decode(results[0]["stdout"]))
+        
+        self.assertIsNone(agent.batch_command([Command("a" * 200000).as_dict()], 1))
+    
+    
+    def sandbox(self, **kwargs) -> types.SimpleNamespace:
+        kwargs.setdefault("container", types.SimpleNamespace(name="c0"))
+        return types.SimpleNamespace(agent_socket=agent.identity(self.path), **kwargs)
+    
+    
+    def test_identity(self):
+        identity = agent.identity(self.path)
+        self.assertIsNotNone(identity)
+        self.assertEqual(identity, agent.identity(self.path))
+        self.assertIsNone(agent.identity(agent.SCRIPT))
+        self.assertIsNone(agent.identity(agent.socket_path("c1")))
+    
+    
+    def test_tampered(self):
+        identity = agent.identity(self.path)
+        self.assertFalse(agent.tampered("c0", identity))
+        self.assertTrue(agent.tampered("c0", None))
+        self.assertTrue(agent.tampered("c0", (0, 0, 0)))
+        self.assertTrue(agent.tampered("c1", None))
+        
+        leftover = os.path.join(agent.directory("c0"), "leftover")
+        with open(leftover, "w") as f:
+            f.write("secret")
+        try:
+            self.assertTrue(agent.tampered("c0", identity))
+        finally:
+            os.remove(leftover)
+    
+    
+    def test_executor_replaced_socket(self):
+        sandbox = self.sandbox()
+        sandbox.agent_socket = (0, 0, 0)  # The socket is not the one found when acquired
+        executor = Executor([Command("true")], sandbox, ExecutedEnv([]))
+        self.assertFalse(executor._use_agent())
+        
+        executor.sandbox = self.sandbox()
+        self.assertTrue(executor._use_agent())
+    
+    
+    def test_executor_batch(self):
+        sandbox = self.sandbox()
+        commands = [Command("echo $((1+1))"), Command("-false"), Command("sleep 1", timeout=0.2)]
+        executed = Executor(commands, sandbox, ExecutedEnv([]))._execute_batch()
+        
+        self.assertEqual([True, True, False], [status for status, _ in executed])
+        self.assertEqual("2", executed[0][1]["stdout"])
+        self.assertEqual(1, executed[1][1]["exit_code"])
+        self.assertEqual(SandboxErrCode.TIMEOUT, executed[2][1]["exit_code"])
+        self.assertEqual("Command timed out after 0.2 seconds\n", executed[2][1]["stderr"])
+        self.assertEqual([2, 0, 0], [c.output_kept for c in commands])
+    
+    
+    def test_executor_batch_exec_bounded(self):
+        calls = list()
+        
+        def exec_run(cmd, **_):
+            calls.append(cmd)
+            return 137, (None, b"Killed")
+        
+        sandbox = self.sandbox(container=types.SimpleNamespace(name="c1", exec_run=exec_run))
+        executor = Executor([Command("sleep 100")], sandbox, ExecutedEnv([]))
+        with self.assertRaisesRegex(ValueError, "exited with 137 without results: Killed"):
+            executor._execute_batch()
+        self.assertEqual(
+            ["timeout", "-s", "KILL", f"{executor.timeout + agent.TIMEOUT_MARGIN:.3f}"],
+            calls[0][:4]
+        )
+        
+        with override_settings(EXECUTE_BATCH=True):
+            with self.assertRaises(HTTPException) as cm:
+                list(executor._execute_commands())
+        self.assertEqual(500, cm.exception.response.status_code)
+    
+    
+    @override_settings(DOCKER_AGENT=False)
+    def test_executor_batch_no_agent(self):
+        def exec_run(*_, **__):
+            raise AssertionError("The script of the agent is not mounted")
+        
+        sandbox = self.sandbox(container=types.SimpleNamespace(name="c1", exec_run=exec_run))
+        self.assertIsNone(Executor([Command("true")], sandbox, ExecutedEnv([]))._execute_batch())
+    
+    
+    def test_executor_cases(self):
+        sandbox = self.sandbox(envpath=BASEDIR)
+        config = {"environ": {"VAR": "1"}, "run": "echo $VAR", "cases": [
+            {"args": ["a b"]}, {"args": ["$HOME"], "environ": {"VAR": "2"}}, {"args": ["; false"]}
+        ]}
+        executor = Executor([], sandbox, ExecutedEnv([]), cases=Command.cases_from_config(config))
+        cases = list(executor._execute_cases(None, executor.timeout))
+        self.assertEqual(["1 a b", "2 $HOME", "1 ; false"], [c["stdout"] for c in cases])
+        self.assertEqual([0, 0, 0], [c["status"] for c in cases])
+    
+    
+    def test_executor_cases_timeout(self):
+        sandbox = self.sandbox(envpath=BASEDIR)
+        config = {"run": "sleep", "cases": [{"args": ["0.4"]}] * 3}
+        executor = Executor([], sandbox, ExecutedEnv([]), cases=Command.cases_from_config(config))
+        start = time.time()
+        cases = list(executor._execute_cases(None, 0.6))
+        self.assertLess(time.time() - start, 1.5)
+        
+        self.assertEqual(
+            [0, SandboxErrCode.TIMEOUT, SandboxErrCode.TIMEOUT], [c["status"] for c in cases]
+        )
+        self.assertEqual(0, cases[2]["time"])
+    
+    
+    def test_stream(self):
+        events = list(agent.stream(self.path, "echo out; sleep 0.1; echo err >&2", {}, 1))
+        self.assertEqual([("stdout", b"out\n"), ("stderr", b"err\n")], events[:-1])
+        self.assertEqual("exit", events[-1][0])
+        self.assertEqual(0, events[-1][1]["exit_code"])
+        self.assertFalse(events[-1][1]["timed_out"])
+        
+        events = list(agent.stream(self.path, "echo 123456", {}, 1, 3))
+        self.assertEqual([("stdout", b"123")], events[:-1])
+        self.assertEqual({"stdout": 7, "stderr": 0}, events[-1][1]["bytes"])
+    
+    
+    def test_stream_unreachable(self):
+        self.assertIsNone(agent.stream(agent.socket_path("c1"), "true", {}, 1))
+    
+    
+    def test_command_stream(self):
+        container = types.SimpleNamespace(name="c0")
+        events = list(Command("printf 'é'; sleep 0.1; echo 2 >&2", timeout=1).stream(container))
+        self.assertEqual([("stdout", "é"), ("stderr", "2\n")], events[:-1])
+        
+        name, (status, result) = events[-1]
+        self.assertEqual("exit", name)
+        self.assertTrue(status)
+        self.assertEqual(0, result["exit_code"])
+        self.assertNotIn("stdout", result)
+        
+        events = list(Command("echo 1; sleep 1", timeout=0.2).stream(container))
+        self.assertEqual(("stdout", "1\n"), events[0])
+        name, (status, result) = events[-1]
+        self.assertFalse(status)
+        self.assertEqual(SandboxErrCode.TIMEOUT, result["exit_code"])
+    
+    
+    @override_settings(EXECUTE_OUTPUT_LIMIT=4, EXECUTE_OUTPUT_KILL=True)
+    def test_command_limit(self):
+        container = types.SimpleNamespace(name="c0")
+        status, result = Command("printf 'aaaé'; sleep 5", timeout=1).execute(container)
+        self.assertFalse(status)
+        self.assertEqual(SandboxErrCode.OUTPUT_LIMIT, result["exit_code"])
+        self.assertEqual("aaa", result["stdout"])
+        self.assertTrue(result["truncated"]["stdout"])
+        self.assertLess(result["time"], 1)
+        
+        status, result = Command("-yes", timeout=1).execute(container)
+        self.assertTrue(status)
+        self.assertEqual("y\ny", result["stdout"])
+    
+    
+    def test_command_cpu_time(self):
+        container = types.SimpleNamespace(name="c0")
+        command = Command("ulimit -S -t", timeout=1)
+        command.cpu_time = 1
+        self.assertEqual("1", command.execute(container)[1]["stdout"])
+        
+        command = Command("while true; do :; done", timeout=10)
+        command.cpu_time = 1
+        status, result = command.execute(container)
+        self.assertFalse(status)
+        self.assertEqual(SandboxErrCode.CPU_TIME_LIMIT, result["exit_code"])
+        self.assertLess(result["time"], 5)
+    
+    
+    def test_meter(self):
+        spec = importlib.util.spec_from_file_location("container_agent", agent.SCRIPT)
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+        script.CGROUP_ROOT = tempfile.mkdtemp(dir=BASEDIR)
+        
+        def write(path, content):
+            path = os.path.join(script.CGROUP_ROOT, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+        
+        ticks = os.sysconf("SC_CLK_TCK")
+        write("cpuacct/cpuacct.stat", f"user {ticks}\nsystem 0\n")
+        write("blkio/blkio.throttle.io_service_bytes", "8:0 Read 0\n8:0 Write 0\n")
+        write("memory/memory.max_usage_in_bytes", "")
+        meter = script.Meter()
+        write("cpuacct/cpuacct.stat", f"user {ticks * 3}\nsystem {ticks}\n")
+        write("blkio/blkio.throttle.io_service_bytes", "8:0 Read 10\n8:0 Write 20\n")
+        
+        self.assertEqual({
+            "cpu_user":    2,
+            "cpu_system":  1,
+            "memory_peak": 0,  # Reset by the meter
+            "pids_peak":   None,
+            "io_read":     10,
+            "io_write":    20,
+        }, meter.stop())
+        
+        script.CGROUP_ROOT = os.path.join(BASEDIR, "missing")
+        self.assertIsNone(script.Meter().stop())
@@ -0,0 +1,112 @@
+# test_archives.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import importlib.util
+import io
+import os
+import tarfile
+import tempfile
+
+from django.test import override_settings
+
+from .utils import ENV1, EnvTestCase, TEST_ENVIRONMENT_ROOT
+from .. import archives, utils
+
+
+ZSTANDARD = importlib.util.find_spec("zstandard") is not None
+
+
+class ArchivesTestCase(EnvTestCase):
+    
+    def env1(self) -> bytes:
+        with open(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz"), "rb") as f:
+            return f.read()
+    
+    
+    @staticmethod
+    def members(file: io.BytesIO) -> dict:
+        """Return the content of the regular files of the archive <file>, by name."""
+        with archives.open_tar(file, "r") as tar:
+            return {m.name: tar.extractfile(m).read() for m in tar if m.isreg()}
+    
+    
+    def codecs(self):
+        return [c for c in archives.CODECS.values() if c.name != "zstd" or ZSTANDARD]
+    
+    
+    def test_get(self):
+        self.assertIs(archives.CODECS["gzip"], archives.get())
+        with override_settings(ENVIRONMENT_CODEC="tar"):
+            self.assertIs(archives.CODECS["tar"], archives.get())
+        with self.assertRaises(Exception):
+            archives.get("rar")
+    
+    
+    def test_codec_abstract(self):
+        with self.assertRaises(TypeError):
+            archives.Codec("rar", ".rar", "application/vnd.rar", b"Rar!")
+        
+        class Incomplete(archives.Codec):
+            def reader(self, file):
+                return file
+        
+        with self.assertRaises(TypeError):
+            Incomplete("rar", ".rar", "application/vnd.rar", b"Rar!")
+    
+    
+    def test_convert(self):
+        expected = self.members(io.BytesIO(self.env1()))
+        self.assertEqual(b"env1\n", expected["file1.txt"])
+        
+        for codec in self.codecs():
+            converted = archives.convert(io.BytesIO(self.env1()), codec)
+            self.assertIs(codec, archives.detect(converted))
+            self.assertEqual(expected, self.members(converted))
+            
+            converted.seek(0)
+            back = archives.convert(converted, archives.CODECS["gzip"])
+            self.assertEqual(expected, self.members(back))
+    
+    
+    def test_open_tar_write(self):
+        for codec in self.codecs():
+            file = io.BytesIO()
+            with archives.open_tar(file, "w", codec) as tar:
+                info = tarfile.TarInfo("file.txt")
+                info.size = 7
+                tar.addfile(info, io.BytesIO(b"content"))
+            self.assertFalse(file.closed)
+            
+            file.seek(0)
+            self.assertIs(codec, archives.detect(file))
+            self.assertEqual({"file.txt": b"content"}, self.members(file))
+    
+    
+    def test_is_archive(self):
+        for codec in self.codecs():
+            file = archives.convert(io.BytesIO(self.env1()), codec)
+            self.assertTrue(archives.is_archive(file))
+            self.assertEqual(0, file.tell())
+        
+        truncated = io.BytesIO(self.env1()[:-64])
+        for file in (io.BytesIO(b""), io.BytesIO(b"not an archive"), truncated):
+            self.assertFalse(archives.is_archive(file))
+    
+    
+    def test_get_env_extract(self):
+        for codec in self.codecs():
+            env = f"{codec.name}-env"
+            path = os.path.join(TEST_ENVIRONMENT_ROOT, f"{env}{codec.extension}")
+            with open(path, "wb") as f:
+                archives.convert(io.BytesIO(self.env1()), codec, f)
+            
+            self.assertEqual(path, utils.get_env(env))
+            self.assertEqual(b"env1\n", utils.extract(env, "file1.txt").read())
+            
+            dest = tempfile.mkdtemp(dir=TEST_ENVIRONMENT_ROOT)
+            utils.ExecutedEnv([path]).extract(dest)
+            with open(os.path.join(dest, "dir", "file3.txt"), "rb") as f:
+                self.assertEqual(b"both1\n", f.read())
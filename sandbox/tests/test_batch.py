@@ -0,0 +1,114 @@
+# test_batch.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import hashlib
+import os
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, override_settings
+from django_http_exceptions import HTTPExceptions
+
+from .utils import ENV1, EnvTestCase, TEST_ENVIRONMENT_ROOT
+from .. import store
+from ..batch import Batch
+
+
+@override_settings(BATCH_MAX_CONFIGS=3, BATCH_MAX_CONCURRENCY=2)
+class BatchTestCase(EnvTestCase):
+    
+    @staticmethod
+    def env1() -> bytes:
+        with open(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz"), "rb") as f:
+            return f.read()
+    
+    
+    def test_from_request(self):
+        content = self.env1()
+        request = RequestFactory().post("/", {"shared": SimpleUploadedFile("env.tgz", content)})
+        batch = Batch.from_request(request, {
+            "configs":     [
+                {"commands": ["true"]},
+                {"commands": ["true"], "upload": "shared", "limits": {"cpu_time": 1}},
+            ],
+            "concurrency": 1,
+        })
+        self.assertEqual(1, batch.concurrency)
+        self.assertEqual(2, len(batch.jobs))
+        self.assertNotIn("sha256", batch.jobs[0].config)
+        self.assertEqual(hashlib.sha256(content).hexdigest(), batch.jobs[1].config["sha256"])
+        self.assertEqual(1, batch.jobs[1].commands[0].cpu_time)
+    
+    
+    def test_from_request_default_concurrency(self):
+        request = RequestFactory().post("/")
+        batch = Batch.from_request(request, {"configs": [{"commands": ["true"]}]})
+        self.assertEqual(2, batch.concurrency)
+    
+    
+    def test_from_request_invalid(self):
+        for config in (
+                {},
+                {"configs": []},
+                {"configs": [{"commands": ["true"]}] * 4},
+                {"configs": [{"commands": ["true"]}], "concurrency": 3},
+                {"configs": [{"commands": ["true"]}], "concurrency": 0},
+                {"configs": ["true"]},
+                {"configs": [{"commands": ["true"], "upload": "missing"}]},
+                {"configs": [{"commands": ["true"], "upload": "shared", "sha256": "0" * 64}]},
+        ):
+            shared = SimpleUploadedFile("env.tgz", self.env1())
+            request = RequestFactory().post("/", {"shared": shared})
+            with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+                Batch.from_request(request, config)
+        self.assertEqual([], os.listdir(store.store_dir()))
+    
+    
+    def test_from_request_invalid_upload(self):
+        config = {"configs": [{"commands": ["true"], "upload": "shared"}]}
+        request = RequestFactory().post("/", {"shared": SimpleUploadedFile("env.tgz", b"env")})
+        with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+            Batch.from_request(request, config)
+        
+        with override_settings(UPLOAD_MAX_SIZE=16):
+            shared = SimpleUploadedFile("env.tgz", self.env1())
+            request = RequestFactory().post("/", {"shared": shared})
+            with self.assertRaises(HTTPExceptions.REQUEST_ENTITY_TOO_LARGE):
+                Batch.from_request(request, config)
+        self.assertEqual([], os.listdir(store.store_dir()))
+    
+    
+    @override_settings(UPLOAD_TOKEN="secret")
+    def test_from_request_upload_token(self):
+        config = {"configs": [{"commands": ["true"], "upload": "shared"}]}
+        for headers in ({}, {"HTTP_AUTHORIZATION": "Token wrong"}):
+            shared = SimpleUploadedFile("env.tgz", self.env1())
+            request = RequestFactory().post("/", {"shared": shared}, **headers)
+            with self.assertRaises(HTTPExceptions.FORBIDDEN):
+                Batch.from_request(request, config)
+        self.assertEqual([], os.listdir(store.store_dir()))
+        
+        shared = SimpleUploadedFile("env.tgz", self.env1())
+        request = RequestFactory().post("/", {"shared": shared}, HTTP_AUTHORIZATION="Token secret")
+        batch = Batch.from_request(request, config)
+        self.assertIsNotNone(store.get(batch.jobs[0].config["sha256"]))
+    
+    
+    def test_results_order(self):
+        class Job:
+            def __init__(self, delay):
+                self.delay = delay
+            
+            def run(self):
+                time.sleep(self.delay)
+                return {"delay": self.delay}
+        
+        batch = Batch([Job(0.2), Job(0), Job(0.1)], 2)
+        self.assertEqual([0.2, 0, 0.1], [r["delay"] for r in batch.results()])
+        
+        events = list(batch.stream())
+        self.assertEqual([("result", {"index": 0, "delay": 0.2})], events[:1])
+        self.assertEqual("end", events[-1][0])
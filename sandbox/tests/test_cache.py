@@ -0,0 +1,188 @@
+# test_cache.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import fcntl
+import os
+import shutil
+import tempfile
+
+from django.test import override_settings
+
+from .utils import ENV1, ENV2, EnvTestCase, TEST_ENVIRONMENT_ROOT
+from .. import cache
+from ..utils import ExecutedEnv
+
+
+BASEDIR = tempfile.mkdtemp()
+
+
+
+@override_settings(DOCKER_VOLUME_HOST_BASEDIR=BASEDIR)
+class CacheTestCase(EnvTestCase):
+    
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(BASEDIR)
+        super().tearDownClass()
+    
+    
+    def setUp(self):
+        super().setUp()
+        self.basedir = tempfile.mkdtemp(dir=BASEDIR)
+        cache.clear()
+    
+    
+    def tearDown(self):
+        cache.clear()
+        shutil.rmtree(self.basedir)
+        super().tearDown()
+    
+    
+    def extract(self, *envs: str) -> str:
+        """Extract <envs> into a new directory, returning its path."""
+        dest = tempfile.mkdtemp(dir=self.basedir)
+        paths = [os.path.join(TEST_ENVIRONMENT_ROOT, f"{env}.tgz") for env in envs]
+        ExecutedEnv(paths).extract(dest)
+        return dest
+    
+    
+    @staticmethod
+    def read(path: str) -> dict:
+        """Return the content of the files in <path>, by path."""
+        files = dict()
+        for root, _, names in os.walk(path):
+            for name in names:
+                with open(os.path.join(root, name), "rb") as f:
+                    files[os.path.relpath(os.path.join(root, name), path)] = f.read()
+        return files
+    
+    
+    def test_materialise(self):
+        extracted = self.read(self.extract(ENV1))
+        self.assertEqual(0, cache.stats()["count"])  # Cached when used again
+        
+        self.assertEqual(extracted, self.read(self.extract(ENV1)))
+        self.assertEqual(extracted, self.read(self.extract(ENV1)))
+        stats = cache.stats()
+        self.assertEqual(1, stats["count"])
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(2, stats["misses"])
+        self.assertGreater(stats["size"], 0)
+    
+    
+    def test_materialise_merge(self):
+        expected = self.read(self.extract(ENV1, ENV2))
+        self.extract(ENV1, ENV2)
+        self.assertEqual(2, cache.stats()["count"])
+        
+        self.assertEqual(expected, self.read(self.extract(ENV1, ENV2)))
+        self.assertEqual(b"both1\n", expected["dir/file3.txt"])
+    
+    
+    def test_materialise_copy(self):
+        self.extract(ENV1)
+        self.extract(ENV1)
+        with open(os.path.join(self.extract(ENV1), "file1.txt"), "a") as f:
+            f.write("modified")
+        self.assertEqual(b"env1\n", self.read(self.extract(ENV1))["file1.txt"])
+    
+    
+    def test_materialise_chmod(self):
+        self.extract(ENV1)
+        self.extract(ENV1)
+        path = os.path.join(self.extract(ENV1), "file1.txt")
+        mode = os.stat(path).st_mode
+        self.assertEqual(1, os.stat(path).st_nlink)
+        
+        os.chmod(path, 0o200)
+        with open(path, "w") as f:
+            f.write("modified")
+        
+        path = os.path.join(self.extract(ENV1), "file1.txt")
+        self.assertEqual(mode, os.stat(path).st_mode)
+        self.assertEqual(b"env1\n", self.read(os.path.dirname(path))["file1.txt"])
+    
+    
+    def test_materialise_invalid(self):
+        path = os.path.join(TEST_ENVIRONMENT_ROOT, "invalid.tgz")
+        with open(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz"), "rb") as f:
+            content = f.read()
+        with open(path, "wb") as f:
+            f.write(content[:len(content) // 2])
+        
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                ExecutedEnv([path]).extract(tempfile.mkdtemp(dir=self.basedir))
+        self.assertEqual(0, cache.stats()["count"])
+        self.assertEqual([], os.listdir(cache.cache_dir()))
+    
+    
+    def test_cache_dir(self):
+        root = os.path.join(BASEDIR, cache.CACHE_DIRNAME)
+        shutil.rmtree(root, ignore_errors=True)  # Created again along with the one of this process
+        dead, alive = os.path.join(root, "dead"), os.path.join(root, "alive")
+        os.makedirs(os.path.join(dead, "entry"))
+        os.makedirs(alive)
+        fd = os.open(alive, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            path = cache.cache_dir()
+            self.assertEqual(path, cache.cache_dir())
+        finally:
+            os.close(fd)
+        
+        self.assertEqual(root, os.path.dirname(path))
+        self.assertEqual(sorted(["alive", os.path.basename(path)]), sorted(os.listdir(root)))
+        # The directory of this process is locked as well
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            with self.assertRaises(BlockingIOError):
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.close(fd)
+        shutil.rmtree(alive)
+    
+    
+    @override_settings(ENVIRONMENT_CACHE_SIZE=1)
+    def test_materialise_too_large(self):
+        self.extract(ENV1)
+        self.assertEqual(b"env1\n", self.read(self.extract(ENV1))["file1.txt"])
+        self.assertEqual(0, cache.stats()["count"])
+    
+    
+    @override_settings(ENVIRONMENT_CACHE_COUNT=1)
+    def test_evict(self):
+        for env in (ENV1, ENV1, ENV2, ENV2):
+            self.extract(env)
+        stats = cache.stats()
+        self.assertEqual(1, stats["count"])
+        self.assertEqual(1, stats["evictions"])
+        self.assertEqual(b"env1\n", self.read(self.extract(ENV1))["file1.txt"])
+    
+    
+    def test_remove_expired(self):
+        self.extract(ENV1)
+        self.extract(ENV1)
+        cache.remove_expired()
+        self.assertEqual(1, cache.stats()["count"])
+        
+        os.remove(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz"))
+        cache.remove_expired()
+        self.assertEqual(0, cache.stats()["count"])
+        self.assertEqual(1, cache.stats()["invalidations"])
+    
+    
+    def test_replaced(self):
+        self.extract(ENV1)
+        self.extract(ENV1)
+        
+        path = os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz")
+        shutil.copyfile(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV2}.tgz"), path + ".new")
+        os.replace(path + ".new", path)
+        self.assertNotIn("file1.txt", self.read(self.extract(ENV1)))
+        
+        cache.remove_expired()
+        self.assertEqual(1, cache.stats()["invalidations"])
@@ -0,0 +1,123 @@
+# test_cgroups.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from .. import cgroups
+
+
+class CgroupsTestCase(SimpleTestCase):
+    
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        patcher = mock.patch.object(cgroups, "CGROUP_ROOT", self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+    
+    
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super().tearDown()
+    
+    
+    def write(self, path: str, content: str):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    
+    
+    def test_v1(self):
+        self.write("pids/docker/abc/pids.current", "3\n")
+        self.assertFalse(cgroups.is_v2())
+        self.assertEqual(3, cgroups.pids_current("abc"))
+    
+    
+    def test_v2_systemd(self):
+        self.write("cgroup.controllers", "cpu memory pids\n")
+        self.write("system.slice/docker-abc.scope/pids.current", "1\n")
+        self.assertTrue(cgroups.is_v2())
+        self.assertEqual(1, cgroups.pids_current("abc"))
+    
+    
+    def test_not_found(self):
+        self.assertIsNone(cgroups.container_cgroup("abc", "pids"))
+        self.assertIsNone(cgroups.pids_current("abc"))
+    
+    
+    def test_read_int_invalid(self):
+        self.write("pids/docker/abc/pids.max", "max\n")
+        self.assertIsNone(cgroups.read_int("abc", "pids", "pids.max"))
+    
+    
+    def test_cpu_io_v1(self):
+        self.write("cpuacct/docker/abc/cpuacct.stat", "user 200\nsystem 100\n")
+        self.write(
+            "blkio/docker/abc/blkio.throttle.io_service_bytes",
+            "8:0 Read 4096\n8:0 Write 512\n8:0 Total 4608\n8:16 Read 1\nTotal 4609\n"
+        )
+        ticks = os.sysconf("SC_CLK_TCK")
+        self.assertEqual((200 / ticks, 100 / ticks), cgroups.cpu_times("abc"))
+        self.assertEqual((4097, 512), cgroups.io_bytes("abc"))
+    
+    
+    def test_cpu_io_v2(self):
+        self.write("cgroup.controllers", "cpu io memory pids\n")
+        self.write(
+            "docker/abc/cpu.stat", "usage_usec 3000000\nuser_usec 2000000\nsystem_usec 1000000\n"
+        )
+        self.write(
+            "docker/abc/io.stat",
+            "8:0 rbytes=4096 wbytes=512 rios=1 wios=1\n8:16 rbytes=1 wbytes=0 rios=1 wios=0\n"
+        )
+        self.assertEqual((2.0, 1.0), cgroups.cpu_times("abc"))
+        self.assertEqual((4097, 512), cgroups.io_bytes("abc"))
+    
+    
+    def test_meter(self):
+        self.write("cgroup.controllers", "cpu io memory pids\n")
+        self.write("docker/abc/cpu.stat", "user_usec 2000000\nsystem_usec 1000000\n")
+        self.write("docker/abc/io.stat", "8:0 rbytes=4096 wbytes=512\n")
+        self.write("docker/abc/memory.peak", "")
+        
+        meter = cgroups.meter("abc")
+        self.write("docker/abc/cpu.stat", "user_usec 2500000\nsystem_usec 1000001\n")
+        self.write("docker/abc/io.stat", "8:0 rbytes=8192 wbytes=1024\n")
+        with open(os.path.join(self.root, "docker/abc/memory.peak"), "r+") as f:
+            self.assertEqual("reset\n", f.read())
+            f.seek(0)
+            f.write("1048576\n")
+        
+        self.assertEqual({
+            "cpu_user":    0.5,
+            "cpu_system":  0.000001,
+            "memory_peak": 1048576,
+            "pids_peak":   None,  # No pids.peak
+            "io_read":     4096,
+            "io_write":    512,
+        }, meter.stop())
+    
+    
+    def test_meter_not_found(self):
+        self.assertIsNone(cgroups.meter("abc"))
+    
+    
+    def test_combine(self):
+        usages = [
+            {"cpu_user": 1, "memory_peak": 10, "io_read": None},
+            {"cpu_user": 2, "memory_peak": 5, "io_read": 3},
+        ]
+        self.assertEqual(
+            {"cpu_user": 3, "memory_peak": 10, "io_read": None}, cgroups.combine(usages)
+        )
+        self.assertIsNone(cgroups.combine([usages[0], None]))
+        self.assertIsNone(cgroups.combine([]))
@@ -5,16 +5,24 @@
 
 
 import os
+import shutil
 import tarfile
+import tempfile
 import time
+from collections import deque
 from threading import Timer
+from unittest import mock
 
 from django.conf import settings
-from django.test import override_settings
+from django.test import SimpleTestCase, override_settings
 from django_http_exceptions import HTTPExceptions
+from docker.errors import APIError
 
-from .utils import SandboxTestCase, raises_docker_exception
-from ..containers import Sandbox
+from .utils import SandboxTestCase, raises_docker_exception, wait_recycled
+from .. import containers
+from ..containers import (Sandbox, autoscale_target, estimated_wait, initialise_containers,
+                          pool_status, resize_pool, rollout)
+from ..scheduler import Scheduler
 
 
 class SandboxWrapperTestCase(SandboxTestCase):
@@ -24,6 +32,55 @@ class SandboxWrapperTestCase(SandboxTestCase):
         self.assertEquals(settings.DOCKER_COUNT, Sandbox.available())
     
     
+    @override_settings(DOCKER_STARTUP_WORKERS=1)
+    def test_initialise_container_sequential(self):
+        initialise_containers()
+        self.assertEquals(settings.DOCKER_COUNT, Sandbox.available())
+        self.assertEqual(
+            list(range(settings.DOCKER_COUNT + settings.DOCKER_SPARE_COUNT)),
+            sorted(s.index for s in containers.CONTAINERS.queue)
+        )
+    
+    
+    def test_initialise_container_reconcile_adopt(self):
+        ids = {s.container.id for s in containers.CONTAINERS.queue}
+        initialise_containers(reconcile=True)
+        self.assertEquals(settings.DOCKER_COUNT, Sandbox.available())
+        self.assertSetEqual(ids, {s.container.id for s in containers.CONTAINERS.queue})
+    
+    
+    def test_initialise_container_reconcile_stale(self):
+        ids = {s.container.id for s in containers.CONTAINERS.queue}
+        parameters = {**settings.DOCKER_PARAMETERS, "mem_limit": "150m"}
+        with override_settings(DOCKER_PARAMETERS=parameters):
+            initialise_containers(reconcile=True)
+        self.assertEquals(settings.DOCKER_COUNT, Sandbox.available())
+        self.assertTrue(ids.isdisjoint({s.container.id for s in containers.CONTAINERS.queue}))
+    
+    
+    def test_initialise_container_reconcile_busy(self):
+        s = Sandbox.acquire()
+        s.container.exec_run(["sleep", "30"], detach=True)
+        time.sleep(0.2)
+        initialise_containers(reconcile=True)
+        self.assertEquals(settings.DOCKER_COUNT, Sandbox.available())
+        self.assertNotIn(s.container.id, {s.container.id for s in containers.CONTAINERS.queue})
+    
+    
+    def test_initialise_container_reconcile_dirty(self):
+        sandboxes = sorted(containers.CONTAINERS.queue, key=lambda s: s.index)
+        scratch, layer = sandboxes[0].container, sandboxes[1].container
+        scratch.exec_run(["sh", "-c", "echo leak > /tmp/leak"])
+        layer.exec_run(["touch", "/contaminated"], user="root")
+        initialise_containers(reconcile=True)
+        
+        self.assertEquals(settings.DOCKER_COUNT, Sandbox.available())
+        ids = {s.container.id for s in containers.CONTAINERS.queue}
+        self.assertIn(scratch.id, ids)
+        self.assertNotEqual(0, scratch.exec_run(["test", "-e", "/tmp/leak"]).exit_code)
+        self.assertNotIn(layer.id, ids)
+    
+    
     def test_acquire(self):
         Sandbox.acquire()
         self.assertEquals(settings.DOCKER_COUNT - 1, Sandbox.available())
@@ -52,14 +109,25 @@ class SandboxWrapperTestCase(SandboxTestCase):
         
         index = r.index
         r.release()
-        r = Sandbox.acquire()
-        self.assertEqual(index, r.index)
+        wait_recycled()
+        r = next(s for s in containers.CONTAINERS.queue if s.index == index)
         
         # Checking the container does work
         o = r.container.exec_run("true")
         self.assertEqual(0, o.exit_code)
     
     
+    def test_release_spare(self):
+        r = [Sandbox.acquire() for _ in range(settings.DOCKER_COUNT)].pop()
+        r.release()
+        
+        # A spare container must be available while 'r' is being recycled
+        start = time.time()
+        Sandbox.acquire()
+        self.assertLess(time.time() - start, 0.5)
+    
+    
+    @override_settings(DOCKER_FAST_RESET=False)
     def test_reset(self):
         r = [Sandbox.acquire() for _ in range(settings.DOCKER_COUNT)].pop()
         
@@ -68,13 +136,124 @@ class SandboxWrapperTestCase(SandboxTestCase):
         
         index = r.index
         r.release()
-        r = Sandbox.acquire()
-        self.assertEqual(index, r.index)
+        wait_recycled()
+        r = next(s for s in containers.CONTAINERS.queue if s.index == index)
         
         o = r.container.exec_run("true")
         self.assertEqual(0, o.exit_code)
     
     
+    def test_release_fast_reset(self):
+        s = Sandbox.acquire()
+        container_id = s.container.id
+        s.container.exec_run(["bash", "-c", "echo test > file.txt"])
+        s.release()
+        wait_recycled()
+        
+        self.assertEqual(1, pool_status()["resets"]["fast"])
+        self.assertEqual(1.0, pool_status()["resets"]["fast_rate"])
+        self.assertEqual([], os.listdir(s.envpath))
+        s = next(s for s in containers.CONTAINERS.queue if s.container.id == container_id)
+        self.assertEqual(0, s.container.exec_run("true").exit_code)
+    
+    
+    def test_release_fast_reset_leftover_process(self):
+        s = Sandbox.acquire()
+        s.container.exec_run(["sleep", "100"], detach=True)
+        s.release()
+        wait_recycled()
+        
+        self.assertEqual(1, pool_status()["resets"]["fast"])
+        self.assertEqual(1, len(s.container.top()["Processes"]))
+    
+    
+    def test_release_fast_reset_scratch(self):
+        s = Sandbox.acquire()
+        container_id = s.container.id
+        s.container.exec_run(["mkdir", "/tmp/hsperfdata_student"])
+        s.container.exec_run(["touch", "/tmp/hsperfdata_student/1", "/dev/shm/leftover"])
+        s.release()
+        wait_recycled()
+        
+        self.assertEqual(1, pool_status()["resets"]["fast"])
+        s = next(s for s in containers.CONTAINERS.queue if s.container.id == container_id)
+        left = s.container.exec_run(["find", "/tmp", "/dev/shm", "-mindepth", "1"])
+        self.assertEqual(b"", left.output)
+    
+    
+    def test_release_fast_reset_layer_changed(self):
+        s = Sandbox.acquire()
+        container_id = s.container.id
+        s.container.exec_run(["touch", "/contaminated"], user="root")
+        s.release()
+        wait_recycled()
+        
+        self.assertEqual(1, pool_status()["resets"]["recreate"])
+        self.assertEqual(0.0, pool_status()["resets"]["fast_rate"])
+        self.assertNotIn(container_id, {s.container.id for s in containers.CONTAINERS.queue})
+    
+    
+    def test_release_fast_reset_agent_tampered(self):
+        s = Sandbox.acquire()
+        container_id = s.container.id
+        s.container.exec_run(["touch", "/run/agent/leftover"])
+        s.release()
+        wait_recycled()
+        
+        self.assertEqual(1, pool_status()["resets"]["recreate"])
+        self.assertNotIn(container_id, {s.container.id for s in containers.CONTAINERS.queue})
+    
+    
+    def test_agent_ignores_sigterm(self):
+        s = Sandbox.acquire()
+        s.container.exec_run(["kill", "-TERM", "1"])
+        s.container.exec_run(["kill", "-INT", "1"])
+        time.sleep(0.2)
+        s.container.reload()
+        self.assertEqual("running", s.container.status)
+    
+    
+    def test_limit(self):
+        s = Sandbox.acquire()
+        host = s.container.attrs["HostConfig"]
+        s.limit(64 * 1024 * 1024, 16)
+        s.container.reload()
+        self.assertEqual(64 * 1024 * 1024, s.container.attrs["HostConfig"]["Memory"])
+        self.assertEqual(64 * 1024 * 1024, s.container.attrs["HostConfig"]["MemorySwap"])
+        self.assertEqual(16, s.container.attrs["HostConfig"]["PidsLimit"])
+        
+        s.release()
+        wait_recycled()
+        s.container.reload()
+        self.assertEqual(host["Memory"], s.container.attrs["HostConfig"]["Memory"])
+        self.assertEqual(host["MemorySwap"], s.container.attrs["HostConfig"]["MemorySwap"])
+        self.assertIn(s.container.attrs["HostConfig"]["PidsLimit"], (None, 0, -1))
+        self.assertIsNone(s.limits)
+    
+    
+    def test_pool_status(self):
+        r = Sandbox.acquire()
+        status = pool_status()
+        self.assertEqual(1, status["running"])
+        self.assertEqual(settings.DOCKER_COUNT + settings.DOCKER_SPARE_COUNT - 1, status["ready"])
+        
+        r.release()
+        wait_recycled()
+        status = pool_status()
+        self.assertEqual(0, status["running"])
+        self.assertEqual(0, status["recycling"])
+        self.assertEqual(0, status["broken"])
+        self.assertEqual(settings.DOCKER_COUNT + settings.DOCKER_SPARE_COUNT, status["ready"])
+    
+    
+    def test_pool_status_priorities(self):
+        Sandbox.acquire("batch", "teacher").release()
+        priorities = pool_status()["priorities"]
+        self.assertEqual(set(settings.SCHEDULER_PRIORITIES), set(priorities))
+        self.assertEqual(0, priorities["batch"]["waiting"])
+        self.assertGreater(priorities["batch"]["wait_avg"], 0)
+    
+    
     def test_extract_env(self):
         s = Sandbox.acquire()
         s.container.exec_run(["bash", "-c", 'echo "Hello World !" > world.txt'])
@@ -85,3 +264,202 @@ class SandboxWrapperTestCase(SandboxTestCase):
         
         with tarfile.open(path, "r:gz") as tar:
             self.assertEqual(b"Hello World !\n", tar.extractfile("world.txt").read())
+    
+    
+    def test_resize_pool_grow(self):
+        resize_pool(settings.DOCKER_COUNT + 2)
+        wait_recycled()
+        self.assertEqual(settings.DOCKER_COUNT + 2, pool_status()["size"])
+        self.assertEqual(settings.DOCKER_COUNT + 2, Sandbox.available())
+        
+        sandboxes = [Sandbox.acquire() for _ in range(settings.DOCKER_COUNT + 2)]
+        self.assertEqual(0, sandboxes[-1].container.exec_run("true").exit_code)
+    
+    
+    def test_resize_pool_shrink(self):
+        s = Sandbox.acquire()
+        resize_pool(2)
+        self.assertEqual(1, Sandbox.available())
+        
+        s.release()
+        wait_recycled()
+        self.assertEqual(2, Sandbox.available())
+        self.assertEqual(2 + settings.DOCKER_SPARE_COUNT, pool_status()["ready"])
+        with self.assertRaises(HTTPExceptions.SERVICE_UNAVAILABLE):
+            for _ in range(3):
+                Sandbox.acquire()
+    
+    
+    
+    @override_settings(DOCKER_PARAMETERS=dict(settings.DOCKER_PARAMETERS))
+    def test_rollout(self):
+        busy = Sandbox.acquire()
+        generation = containers.GENERATION
+        rollout(parameters={**settings.DOCKER_PARAMETERS, "mem_limit": "150m"})
+        
+        # Running executions are not interrupted, idle containers have been replaced
+        self.assertEqual(0, busy.container.exec_run("true").exit_code)
+        self.assertEqual(settings.DOCKER_COUNT - 1, Sandbox.available())
+        self.assertTrue(all(s.generation > generation for s in containers.CONTAINERS.queue))
+        self.assertEqual(
+            150 * 1024 ** 2, Sandbox.acquire().container.attrs["HostConfig"]["Memory"]
+        )
+        
+        # Outdated containers are removed once released
+        busy.release()
+        wait_recycled()
+        self.assertEqual(1, pool_status()["running"])
+        self.assertNotIn(busy.container.id, {
+            c.id for c in busy.container.client.containers.list(all=True)
+        })
+    
+    
+    def test_rollout_resize(self):
+        rollout(size=2)
+        self.assertEqual(2, pool_status()["size"])
+        self.assertEqual(2 + settings.DOCKER_SPARE_COUNT, pool_status()["ready"])
+        self.assertEqual(2, Sandbox.available())
+
+
+class ReconcileTestCase(SimpleTestCase):
+    
+    def test_reconcile_listed_twice(self):
+        c = mock.Mock(id="id", short_id="id", labels={
+            containers.LABEL_INDEX: "0", containers.LABEL_FINGERPRINT: "fingerprint",
+        })
+        client = mock.Mock()
+        client.containers.list.return_value = [c]  # Matches both the image and the label
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(DOCKER_VOLUME_HOST_BASEDIR=basedir), \
+                mock.patch("docker.from_env", return_value=client), \
+                mock.patch.object(containers, "FINGERPRINT", "fingerprint"), \
+                mock.patch.object(containers, "PLACEMENT", None), \
+                mock.patch.object(containers, "_is_idle", side_effect=[False, True]) as is_idle, \
+                mock.patch.object(containers, "_remove_container") as remove, \
+                mock.patch.object(containers, "Sandbox") as sandbox:
+            self.assertEqual([], containers._reconcile(1, 1))
+        
+        self.assertEqual(2, client.containers.list.call_count)
+        is_idle.assert_called_once_with(c)
+        remove.assert_called_once_with(c)
+        sandbox.assert_not_called()
+
+
+class UpdateLimitsTestCase(SimpleTestCase):
+    
+    def test_update_limits_pids(self):
+        container = mock.Mock(id="abc")
+        api = container.client.api
+        api.base_url, api.api_version = "http+docker://localhost", "1.41"
+        url = "http+docker://localhost/v1.41/containers/abc/update"
+        
+        api.post.return_value = mock.Mock(status_code=200)
+        containers.update_limits(container, PidsLimit=16)
+        api.post.assert_called_once_with(url, json={"PidsLimit": 16})
+        container.update.assert_not_called()
+        
+        api.post.return_value = mock.Mock(status_code=400, text="invalid")
+        with self.assertRaises(APIError):
+            containers.update_limits(container, PidsLimit=-1)
+        api.post.assert_called_with(url, json={"PidsLimit": -1})
+
+
+@override_settings(
+    DOCKER_MIN_COUNT=4, DOCKER_MAX_COUNT=10, DOCKER_AUTOSCALE_STEP=2,
+    DOCKER_AUTOSCALE_WAIT_THRESHOLD=0.5, DOCKER_AUTOSCALE_COOLDOWN=60,
+    DOCKER_AUTOSCALE_MAX_MEMORY=85, DOCKER_AUTOSCALE_MAX_CPU=90,
+)
+class AutoscaleTestCase(SimpleTestCase):
+    
+    def target(self, size=6, running=0, waiting=0, waits=(), memory=50, cpu=50, now=1000):
+        status = {"size": size, "running": running, "waiting": waiting}
+        with mock.patch.object(containers, "pool_status", return_value=status), \
+                mock.patch.object(containers, "acquire_waits", return_value=list(waits)), \
+                mock.patch("psutil.virtual_memory", return_value=mock.Mock(percent=memory)), \
+                mock.patch("psutil.cpu_percent", return_value=cpu):
+            return autoscale_target(now)
+    
+    
+    def setUp(self):
+        containers._LAST_BUSY = containers._LAST_GROWTH = 0
+        super().setUp()
+    
+    
+    def test_grow_waiting(self):
+        self.assertEqual(8, self.target(waiting=1))
+    
+    
+    def test_grow_rejected(self):
+        self.assertEqual(8, self.target(waits=[(2.0, True)]))
+    
+    
+    def test_grow_slow_acquire(self):
+        self.assertEqual(8, self.target(waits=[(0.1, False)] * 5 + [(1.0, False)] * 5))
+        self.assertEqual(6, self.target(waits=[(0.1, False)] * 10, now=10))
+    
+    
+    def test_grow_bounded(self):
+        self.assertEqual(10, self.target(size=9, waiting=1))
+        self.assertEqual(10, self.target(size=12))
+    
+    
+    def test_grow_host_overloaded(self):
+        self.assertEqual(6, self.target(waiting=1, memory=90))
+        self.assertEqual(6, self.target(waiting=1, cpu=95))
+    
+    
+    def test_shrink_after_cooldown(self):
+        self.assertEqual(6, self.target(running=5, now=100))
+        self.assertEqual(6, self.target(running=1, now=150))
+        self.assertEqual(4, self.target(running=1, now=160))
+    
+    
+    def test_shrink_bounded(self):
+        self.assertEqual(4, self.target(size=4))
+        self.assertEqual(4, self.target(size=2))
+
+
+class AdmissionTestCase(SimpleTestCase):
+    
+    def leases(self, limit=4, used=4, waiting=0):
+        leases = Scheduler(limit)
+        leases.used = used
+        leases.tickets = [mock.Mock(priority="interactive") for _ in range(waiting)]
+        return mock.patch.object(containers, "LEASES", leases)
+    
+    
+    def holds(self, *holds):
+        return mock.patch.object(containers, "_HOLDS", deque(holds))
+    
+    
+    def test_estimated_wait_free(self):
+        with self.leases(used=2, waiting=1), self.holds(2.0):
+            self.assertEqual(0, estimated_wait())
+    
+    
+    def test_estimated_wait_busy(self):
+        with self.leases(waiting=3), self.holds(1.0, 3.0):
+            self.assertEqual(4 * 2.0 / 4, estimated_wait())
+            self.assertEqual(2.0 / 4, estimated_wait(ahead=0))
+    
+    
+    @override_settings(MAX_WAITING_REQUESTS=2)
+    def test_reject_queue_full(self):
+        with self.leases(waiting=2), self.holds(4.0):
+            start = time.time()
+            with self.assertRaises(HTTPExceptions.SERVICE_UNAVAILABLE) as cm:
+                Sandbox.acquire()
+            self.assertLess(time.time() - start, 0.5)
+        retry = int(cm.exception.response["Retry-After"])
+        self.assertTrue(3 <= retry <= 5)
+    
+    
+    @override_settings(MAX_WAITING_REQUESTS=0)
+    def test_reject_estimated_wait_too_long(self):
+        with self.leases(waiting=10), self.holds(1.0):
+            start = time.time()
+            with self.assertRaises(HTTPExceptions.SERVICE_UNAVAILABLE) as cm:
+                Sandbox.acquire(max_wait=1)
+            self.assertLess(time.time() - start, 0.5)
+        self.assertIn("Retry-After", cm.exception.response)
@@ -0,0 +1,57 @@
+# test_coordinator.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import os
+import time
+
+from django.conf import settings
+from django.test import SimpleTestCase
+from django_http_exceptions import HTTPExceptions
+
+from .utils import SandboxTestCase, wait_recycled
+from .. import coordinator
+from ..containers import pool_status
+
+
+class CoordinatorTestCase(SimpleTestCase):
+
+    def test_is_coordinator(self):
+        # The test process is elected by settings.py
+        self.assertTrue(coordinator.is_coordinator())
+        self.assertFalse(coordinator.elect())
+        self.assertTrue(os.path.exists(settings.DOCKER_POOL_SOCKET))
+
+
+    def test_call(self):
+        self.assertEqual(pool_status()["size"], coordinator.call("pool_status")["size"])
+
+
+    def test_call_not_coordinated(self):
+        with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+            coordinator.call("initialise_containers")
+
+
+class LeaseTestCase(SandboxTestCase):
+
+    def test_acquire(self):
+        sandbox = coordinator.acquire()
+        self.assertEqual(1, pool_status()["running"])
+        self.assertEqual(0, sandbox.container.exec_run("true").exit_code)
+
+        sandbox.release()
+        time.sleep(0.1)
+        wait_recycled()
+        self.assertEqual(0, pool_status()["running"])
+
+
+    def test_acquire_released_on_disconnect(self):
+        sandbox = coordinator.acquire()
+        self.assertEqual(1, pool_status()["running"])
+
+        sandbox.sock.close()
+        time.sleep(0.1)
+        wait_recycled()
+        self.assertEqual(0, pool_status()["running"])
@@ -13,10 +13,17 @@ from django.test import override_settings
 from django_http_exceptions import HTTPExceptions
 
 from .utils import ENV1, RESOURCES_LIB_ROOT
+from .. import containers, executor
 from ..containers import Sandbox
 from ..enums import SandboxErrCode
 from ..executor import Command, Executor
 from ..tests.utils import SandboxTestCase
+from ..utils import ExecutedEnv
+
+
+def executed_env(env: str) -> ExecutedEnv:
+    """Return the environment of an execution extracting the environment <env>."""
+    return ExecutedEnv([os.path.join(settings.ENVIRONMENT_ROOT, f"{env}.tgz")])
 
 
 class CommandTestCase(SandboxTestCase):
@@ -86,6 +93,50 @@ class CommandTestCase(SandboxTestCase):
             Command.from_config({"commands": []})
     
     
+    def test_cases_from_config_ok(self):
+        config = {
+            "setup":   ["gcc main.c"],
+            "environ": {"A": "1", "B": "2"},
+            "run":     "./a.out",
+            "cases":   [
+                {"stdin": "10\n", "args": ["-n", "a b"], "environ": {"B": "3"}, "timeout": 1},
+                {},
+            ],
+        }
+        self.assertEqual(["gcc main.c"], [c.command for c in Command.from_config(config)])
+        self.assertIsNone(Command.cases_from_config({"commands": ["true"]}))
+        
+        cases = Command.cases_from_config(config, 2)
+        self.assertEqual("./a.out -n 'a b'", cases[0].command)
+        self.assertEqual("10\n", cases[0].stdin)
+        self.assertEqual({"A": "1", "B": "3"}, cases[0].environ)
+        self.assertEqual(1, cases[0].timeout)
+        self.assertEqual(2, cases[0].cpu_time)
+        self.assertEqual("./a.out", cases[1].command)
+        self.assertIsNone(cases[1].stdin)
+        self.assertEqual(settings.EXECUTE_SAFETY_TIMEOUT, cases[1].timeout)
+        
+        self.assertEqual([], Command.from_config({"run": "true", "cases": [{}]}))
+    
+    
+    def test_cases_from_config_invalid(self):
+        for config in (
+                {"cases": [{}]},
+                {"run": "true", "cases": []},
+                {"run": "true", "cases": [{}] * (settings.EXECUTE_MAX_CASES + 1)},
+                {"run": "true", "cases": ["1"]},
+                {"run": "true", "cases": [{"args": "1"}]},
+                {"run": "true", "cases": [{"args": [1]}]},
+                {"run": "true", "cases": [{"stdin": 1}]},
+                {"run": "true", "cases": [{"environ": []}]},
+        ):
+            with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+                Command.cases_from_config(config)
+        
+        with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+            Command.from_config({"commands": ["true"], "run": "true", "cases": [{}]})
+    
+    
     def test_execute_ok(self):
         s = Sandbox.acquire()
         
@@ -130,6 +181,48 @@ class CommandTestCase(SandboxTestCase):
         self.assertEqual(f"Command timed out after 0.2 seconds\n", result["stderr"])
         self.assertIsInstance(result["time"], float)
         self.assertLessEqual(result["time"], 0.25)
+    
+    
+    def test_execute_timeout_kill_processes(self):
+        s = Sandbox.acquire()
+        status, result = Command("sleep 5 & sleep 5", timeout=0.2).execute(s.container)
+        self.assertFalse(status)
+        self.assertEqual(SandboxErrCode.TIMEOUT, result["exit_code"])
+        
+        status, result = Command("pgrep sleep").execute(s.container)
+        self.assertFalse(status)
+        self.assertEqual("", result["stdout"])
+    
+    
+    def test_execute_timeout_exhausted(self):
+        s = Sandbox.acquire()
+        status, result = Command("true", timeout=0).execute(s.container)
+        self.assertFalse(status)
+        self.assertEqual(SandboxErrCode.TIMEOUT, result["exit_code"])
+        self.assertEqual(0, result["time"])
+    
+    
+    @override_settings(EXECUTE_OUTPUT_LIMIT=100)
+    def test_execute_output_limit(self):
+        s = Sandbox.acquire()
+        command = Command("yes | head -c 10000", timeout=1)
+        for use_agent in (True, False):
+            status, result = command.execute(s.container, use_agent)
+            self.assertTrue(status)
+            self.assertEqual(100, len(result["stdout"]) + 1)  # Trailing newline is stripped
+            self.assertEqual({"stdout": 10000, "stderr": 0}, result["bytes"])
+            self.assertEqual({"stdout": True, "stderr": False}, result["truncated"])
+    
+    
+    
+    def test_execute_resources(self):
+        s = Sandbox.acquire()
+        command = Command("python3 -c 'sum(range(10**6))'", timeout=5)
+        for use_agent in (True, False):
+            status, result = command.execute(s.container, use_agent)
+            self.assertTrue(status)
+            self.assertGreater(result["resources"]["cpu_user"], 0)
+            self.assertEqual(0, result["resources"]["io_write"])
 
 
 class ExecutorTestCase(SandboxTestCase):
@@ -141,7 +234,7 @@ class ExecutorTestCase(SandboxTestCase):
             Command("-false"),
         ]
         s = Sandbox.acquire()
-        e = Executor(commands, s, self.uuid4)
+        e = Executor(commands, s, executed_env(self.uuid4))
         
         result = e.execute()
         s.release()
@@ -157,7 +250,7 @@ class ExecutorTestCase(SandboxTestCase):
             Command('echo "Hello World !" > result.txt')
         ]
         s = Sandbox.acquire()
-        e = Executor(commands, s, ENV1, result="result.txt", save=True)
+        e = Executor(commands, s, executed_env(ENV1), result="result.txt", save=True)
         
         result = e.execute()
         s.release()
@@ -194,7 +287,7 @@ class ExecutorTestCase(SandboxTestCase):
             Command('echo "Hello World !" > result.txt')
         ]
         s = Sandbox.acquire()
-        e = Executor(commands, s, ENV1, result="result.txt")
+        e = Executor(commands, s, executed_env(ENV1), result="result.txt")
         
         result = e.execute()
         s.release()
@@ -209,7 +302,9 @@ class ExecutorTestCase(SandboxTestCase):
     
     def test_execute_ok_environ(self):
         s = Sandbox.acquire()
-        e = Executor([Command('echo $VAR1', environ={"VAR1": "My var"})], s, self.uuid4)
+        e = Executor(
+            [Command('echo $VAR1', environ={"VAR1": "My var"})], s, executed_env(self.uuid4)
+        )
         
         result = e.execute()
         s.release()
@@ -218,9 +313,38 @@ class ExecutorTestCase(SandboxTestCase):
         self.assertEqual("My var", result["execution"][0]["stdout"])
     
     
+    def test_execute_cases(self):
+        config = {
+            "setup": ["printf 'read n; echo $((n * 2)) $1 $VAR' > double.sh"],
+            "run":   "bash double.sh",
+            "cases": [
+                {"stdin": "2\n", "args": ["a"], "environ": {"VAR": "v"}},
+                {"stdin": "1 +", "args": ["b"], "timeout": 0.5},
+                {"args": ["c"]},
+            ],
+        }
+        s = Sandbox.acquire()
+        e = Executor(
+            Command.from_config(config), s, executed_env(self.uuid4),
+            cases=Command.cases_from_config(config)
+        )
+        
+        result = e.execute()
+        s.release()
+        self.assertEqual(0, result["status"])
+        self.assertEqual(1, len(result["execution"]))
+        self.assertEqual(3, len(result["cases"]))
+        self.assertEqual(0, result["cases"][0]["status"])
+        self.assertEqual("4 a v", result["cases"][0]["stdout"])
+        self.assertEqual(1, result["cases"][1]["status"])
+        self.assertEqual(1, result["cases"][2]["status"])
+        self.assertEqual([], os.listdir(containers.stdin_directory(s.name)))
+        self.assertFalse(os.path.exists(os.path.join(s.envpath, executor.STDIN_FILENAME)))
+    
+    
     def test_execute_timeout_command(self):
         s = Sandbox.acquire()
-        e = Executor([Command('sleep 1', timeout=0.25)], s, self.uuid4)
+        e = Executor([Command('sleep 1', timeout=0.25)], s, executed_env(self.uuid4))
         
         result = e.execute()
         s.release()
@@ -239,7 +363,7 @@ class ExecutorTestCase(SandboxTestCase):
                 Command('sleep 0.1', timeout=0.5),
                 Command('sleep 0.1', timeout=0.5),
                 Command('sleep 0.1', timeout=0.5)
-            ], s, self.uuid4
+            ], s, executed_env(self.uuid4)
         )
         
         result = e.execute()
@@ -251,7 +375,7 @@ class ExecutorTestCase(SandboxTestCase):
     
     def test_execute_failing(self):
         s = Sandbox.acquire()
-        e = Executor([Command("false")], s, self.uuid4)
+        e = Executor([Command("false")], s, executed_env(self.uuid4))
         
         result = e.execute()
         self.assertEqual(1, result["status"])
@@ -262,7 +386,7 @@ class ExecutorTestCase(SandboxTestCase):
     
     def test_execute_result_not_found(self):
         s = Sandbox.acquire()
-        e = Executor([Command("true")], s, self.uuid4, result="unknown.txt")
+        e = Executor([Command("true")], s, executed_env(self.uuid4), result="unknown.txt")
         
         result = e.execute()
         s.release()
@@ -273,7 +397,7 @@ class ExecutorTestCase(SandboxTestCase):
     def test_execute_result_not_utf8(self):
         s = Sandbox.acquire()
         cmd = "dd if=/dev/urandom of=binary bs=1M count=10"
-        e = Executor([Command(cmd)], s, self.uuid4, result="binary")
+        e = Executor([Command(cmd)], s, executed_env(self.uuid4), result="binary")
         
         result = e.execute()
         s.release()
@@ -285,7 +409,7 @@ class ExecutorTestCase(SandboxTestCase):
     def test_execute_external_lib_in_path(self):
         s = Sandbox.acquire()
         cmd = 'echo $PATH > result.txt'
-        e = Executor([Command(cmd)], s, self.uuid4, result="result.txt")
+        e = Executor([Command(cmd)], s, executed_env(self.uuid4), result="result.txt")
         
         result = e.execute()
         s.release()
@@ -298,7 +422,7 @@ class ExecutorTestCase(SandboxTestCase):
     def test_execute_external_lib_in_pythonpath(self):
         s = Sandbox.acquire()
         cmd = 'echo $PYTHONPATH > result.txt'
-        e = Executor([Command(cmd)], s, self.uuid4, result="result.txt")
+        e = Executor([Command(cmd)], s, executed_env(self.uuid4), result="result.txt")
         
         result = e.execute()
         s.release()
@@ -313,7 +437,7 @@ class ExecutorTestCase(SandboxTestCase):
         s = Sandbox.acquire()
         
         cmd = 'python3 -c "from dummy_lib.dummy import dummy_func;dummy_func()" > result.txt'
-        e = Executor([Command(cmd)], s, self.uuid4, result="result.txt")
+        e = Executor([Command(cmd)], s, executed_env(self.uuid4), result="result.txt")
         
         result = e.execute()
         s.release()
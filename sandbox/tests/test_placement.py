@@ -0,0 +1,116 @@
+# test_placement.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from .. import placement
+from ..placement import CpuPlacement, compute_slots, format_cpuset, parse_cpuset
+
+
+class CpusetTestCase(SimpleTestCase):
+    
+    def test_parse_cpuset(self):
+        self.assertEqual([0], parse_cpuset("0"))
+        self.assertEqual([0, 1, 2, 3, 8], parse_cpuset("0-3,8"))
+        self.assertEqual([1, 4, 7, 10], parse_cpuset("1,4,7,10"))
+        self.assertEqual([], parse_cpuset(""))
+    
+    
+    def test_format_cpuset(self):
+        self.assertEqual("0", format_cpuset([0]))
+        self.assertEqual("0-3,8", format_cpuset([8, 0, 1, 2, 3]))
+        self.assertEqual("1,4", format_cpuset([1, 4]))
+
+
+
+class ComputeSlotsTestCase(SimpleTestCase):
+    """Use a fake host with 2 NUMA nodes of 2 cores each, with 2 hardware threads per core:
+    
+        node0: core0 -> (0, 4), core1 -> (1, 5)
+        node1: core0 -> (2, 6), core1 -> (3, 7)"""
+    
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        cpu_root = os.path.join(self.root, "cpu")
+        node_root = os.path.join(self.root, "node")
+        for cpu in range(8):
+            topology = os.path.join(cpu_root, f"cpu{cpu}", "topology")
+            os.makedirs(topology)
+            with open(os.path.join(topology, "core_id"), "w") as f:
+                f.write(str(cpu % 2))
+            with open(os.path.join(topology, "physical_package_id"), "w") as f:
+                f.write(str(cpu % 4 // 2))
+        for node, cpulist in ((0, "0-1,4-5"), (1, "2-3,6-7")):
+            os.makedirs(os.path.join(node_root, f"node{node}"))
+            with open(os.path.join(node_root, f"node{node}", "cpulist"), "w") as f:
+                f.write(cpulist)
+        
+        for name, path in (("SYSFS_CPU_ROOT", cpu_root), ("SYSFS_NODE_ROOT", node_root)):
+            patcher = mock.patch.object(placement, name, path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        super().setUp()
+    
+    
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super().tearDown()
+    
+    
+    def test_one_cpu_per_container(self):
+        self.assertEqual(
+            [[0], [1], [2], [3], [4], [5], [6], [7]],
+            compute_slots("0-7", 1)
+        )
+    
+    
+    def test_one_cpu_per_container_no_smt(self):
+        self.assertEqual([[0], [1], [2], [3]], compute_slots("0-7", 1, smt=False))
+    
+    
+    def test_two_cpus_per_container_siblings(self):
+        self.assertEqual([[0, 4], [1, 5], [2, 6], [3, 7]], compute_slots("0-7", 2))
+    
+    
+    def test_four_cpus_per_container_numa(self):
+        self.assertEqual([[0, 4, 1, 5], [2, 6, 3, 7]], compute_slots("0-7", 4))
+        self.assertEqual([[0, 4, 1, 5]], compute_slots("0-5", 4))
+        self.assertEqual([[0, 4, 1, 5, 2]], compute_slots("0-5", 5, numa=False))
+    
+    
+    def test_not_enough_cpus(self):
+        self.assertEqual([[0, 1]], compute_slots("0-1", 4))
+
+
+
+class CpuPlacementTestCase(SimpleTestCase):
+    
+    def test_assign_spread(self):
+        p = CpuPlacement([[0], [1], [2]])
+        self.assertEqual(["0", "1", "2", "0"], [p.assign(i) for i in range(4)])
+        self.assertEqual({0: "0", 1: "1", 2: "2", 3: "0"}, p.assignments())
+    
+    
+    def test_assign_rebalance(self):
+        p = CpuPlacement([[0], [1]])
+        for i in range(3):
+            p.assign(i)
+        p.release(1)
+        # Recreating container 0 must move it to the now idle slot '1'
+        self.assertEqual("1", p.assign(0))
+        self.assertEqual([1, 1], p.loads)
+    
+    
+    def test_claim(self):
+        p = CpuPlacement([[0, 1], [2, 3]])
+        self.assertTrue(p.claim(0, "2,3"))
+        self.assertFalse(p.claim(1, "0"))
+        self.assertEqual("0-1", p.assign(1))
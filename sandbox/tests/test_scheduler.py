@@ -0,0 +1,104 @@
+# test_scheduler.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import threading
+import time
+
+from django.test import SimpleTestCase, override_settings
+
+from ..scheduler import Scheduler
+
+
+@override_settings(
+    SCHEDULER_PRIORITIES={"interactive": 0, "batch": 1}, SCHEDULER_DEFAULT_PRIORITY="interactive",
+    SCHEDULER_AGING=0, SCHEDULER_WEIGHTS={},
+)
+class SchedulerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler(1)
+        self.assertTrue(self.scheduler.acquire(1))
+        self.served = list()
+        self.threads = list()
+        super().setUp()
+
+
+    def wait(self, name: str, priority: str = None, client: str = ""):
+        """Start a thread waiting for a lease, which records <name> and releases it when
+        served."""
+
+        def target():
+            if self.scheduler.acquire(5, priority, client):
+                self.served.append(name)
+                self.scheduler.release()
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        self.threads.append(thread)
+        while self.scheduler.waiting < len(self.threads):
+            time.sleep(0.01)
+
+
+    def serve(self):
+        """Release the lease acquired in 'setUp()' and wait for every waiting thread to be
+        served."""
+        self.scheduler.release()
+        for thread in self.threads:
+            thread.join()
+
+
+    def test_limit(self):
+        self.assertFalse(self.scheduler.acquire(0.1))
+        self.scheduler.resize(2)
+        self.assertTrue(self.scheduler.acquire(0.1))
+
+
+    def test_priority(self):
+        self.wait("batch", "batch")
+        self.wait("interactive", "interactive")
+        self.serve()
+        self.assertEqual(["interactive", "batch"], self.served)
+
+
+    def test_fifo_same_client(self):
+        for i in range(3):
+            self.wait(str(i))
+        self.serve()
+        self.assertEqual(["0", "1", "2"], self.served)
+
+
+    def test_fair_share(self):
+        for i in range(3):
+            self.wait(f"a{i}", client="a")
+        self.wait("b0", client="b")
+        self.serve()
+        self.assertEqual(["a0", "b0", "a1", "a2"], self.served)
+
+
+    @override_settings(SCHEDULER_WEIGHTS={"a": 2})
+    def test_weighted_share(self):
+        for i in range(4):
+            self.wait(f"a{i}", client="a")
+        for i in range(2):
+            self.wait(f"b{i}", client="b")
+        self.serve()
+        self.assertEqual(["a0", "b0", "a1", "a2", "b1", "a3"], self.served)
+
+
+    @override_settings(SCHEDULER_AGING=0.1)
+    def test_aging(self):
+        self.wait("batch", "batch")
+        time.sleep(0.3)
+        self.wait("interactive", "interactive")
+        self.serve()
+        self.assertEqual(["batch", "interactive"], self.served)
+
+
+    def test_waiting_by_priority(self):
+        self.wait("batch", "batch")
+        self.assertEqual({"interactive": 0, "batch": 1}, self.scheduler.waiting_by_priority())
+        self.serve()
+        self.assertEqual({"interactive": 0, "batch": 0}, self.scheduler.waiting_by_priority())
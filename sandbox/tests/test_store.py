@@ -0,0 +1,48 @@
+# test_store.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import hashlib
+import io
+import os
+import time
+
+from django.test import override_settings
+
+from .utils import EnvTestCase
+from .. import store
+
+
+class StoreTestCase(EnvTestCase):
+    
+    def test_put_get(self):
+        sha256 = store.put(io.BytesIO(b"environment"))
+        self.assertEqual(hashlib.sha256(b"environment").hexdigest(), sha256)
+        self.assertEqual(store.path(sha256), store.get(sha256))
+        with open(store.get(sha256), "rb") as f:
+            self.assertEqual(b"environment", f.read())
+        
+        self.assertEqual(sha256, store.put(io.BytesIO(b"environment")))
+        self.assertEqual([f"{sha256}.blob"], os.listdir(store.store_dir()))
+    
+    
+    def test_get_missing(self):
+        self.assertIsNone(store.get("0" * 64))
+        self.assertIsNone(store.get("../../etc/passwd"))
+    
+    
+    @override_settings(ENVIRONMENT_EXPIRATION=1)
+    def test_remove_expired(self):
+        unused = store.put(io.BytesIO(b"unused"))
+        opened = store.put(io.BytesIO(b"opened"))
+        time.sleep(1)
+        used = store.put(io.BytesIO(b"used"))
+        
+        with open(store.path(opened), "rb") as f:
+            store.remove_expired()
+            self.assertEqual(b"opened", f.read())
+        self.assertIsNone(store.get(unused))
+        self.assertIsNone(store.get(opened))
+        self.assertIsNotNone(store.get(used))
@@ -0,0 +1,122 @@
+# test_trash.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+import contextlib
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from django.test import SimpleTestCase, override_settings
+
+from .. import trash
+
+
+# Unprivileged user and group under which the permissions of the trash are checked
+NOBODY = 65534
+
+
+class TrashTestCase(SimpleTestCase):
+    
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.override = override_settings(DOCKER_VOLUME_HOST_BASEDIR=self.basedir)
+        self.override.enable()
+        
+        self.path = os.path.join(self.basedir, "c0")
+        os.makedirs(os.path.join(self.path, "dir", "subdir"))
+        for p in ("file.txt", "dir/file.txt", "dir/subdir/file.txt"):
+            with open(os.path.join(self.path, p), "w") as f:
+                f.write("content")
+        super().setUp()
+    
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.basedir)
+        super().tearDown()
+    
+    
+    def test_discard(self):
+        trash.discard(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(1, len(os.listdir(trash.trash_dir())))
+        
+        trash.reap()
+        self.assertEqual([], os.listdir(trash.trash_dir()))
+    
+    
+    def test_empty(self):
+        inode = os.stat(self.path).st_ino
+        trash.empty(self.path)
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+        self.assertEqual([], os.listdir(self.path))
+        self.assertEqual(1, len(os.listdir(trash.trash_dir())))
+        
+        trash.reap()
+        self.assertEqual([], os.listdir(trash.trash_dir()))
+    
+    
+    def test_empty_missing(self):
+        path = os.path.join(self.basedir, "c1")
+        trash.empty(path)
+        self.assertTrue(os.path.isdir(path))
+    
+    
+    def test_reap_read_only_directory(self):
+        os.chmod(os.path.join(self.path, "dir"), stat.S_IRUSR | stat.S_IXUSR)
+        trash.discard(self.path)
+        trash.reap()
+        self.assertEqual([], os.listdir(trash.trash_dir()))
+    
+    
+    @contextlib.contextmanager
+    def unprivileged(self):
+        """Run the block as a non-root user, owning <self.basedir>, if the tests run as root, which
+        bypasses the permissions."""
+        if os.geteuid() != 0:
+            yield
+            return
+        
+        for root, dirs, files in os.walk(self.basedir):
+            for name in [root, *(os.path.join(root, n) for n in dirs + files)]:
+                os.lchown(name, NOBODY, NOBODY)
+        os.setegid(NOBODY)
+        os.seteuid(NOBODY)
+        try:
+            yield
+        finally:
+            os.seteuid(0)
+            os.setegid(0)
+    
+    
+    def test_reap_unsearchable_directories(self):
+        os.chmod(os.path.join(self.path, "dir", "subdir"), 0)
+        os.chmod(os.path.join(self.path, "dir"), 0)
+        trash.discard(self.path)
+        with self.unprivileged():
+            trash.reap()
+            self.assertEqual([], os.listdir(trash.trash_dir()))
+    
+    
+    @override_settings(DOCKER_TRASH_REAP_RATE=20)
+    def test_reap_rate(self):
+        # 3 files and 3 directories at 20 removals per second
+        trash.discard(self.path)
+        start = time.time()
+        trash.reap()
+        self.assertLessEqual(0.25, time.time() - start)
+    
+    
+    def test_reaper(self):
+        trash.start_reaper()
+        trash.discard(self.path)
+        
+        start = time.time()
+        while os.listdir(trash.trash_dir()) and time.time() - start < 5:
+            time.sleep(0.05)
+        self.assertEqual([], os.listdir(trash.trash_dir()))
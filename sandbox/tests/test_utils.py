@@ -4,6 +4,7 @@
 #   - Coumes Quentin <coumes.quentin@gmail.com>
 
 
+import gzip
 import io
 import os
 import tarfile
@@ -18,82 +19,6 @@ from .. import utils
 
 
 
-class MergeTarGZTestCase(EnvTestCase):
-    
-    def test_merge_tar_gz_both_none(self):
-        self.assertEqual(None, utils.merge_tar_gz(None, None))
-    
-    
-    def test_merge_tar_gz_one_none(self):
-        b = io.BytesIO(b"test")
-        self.assertEqual(b"test", utils.merge_tar_gz(b, None).read())
-        b.seek(0)
-        self.assertEqual(b"test", utils.merge_tar_gz(None, b).read())
-    
-    
-    def test_merge_tar_gz(self):
-        """
-        ENV1
-        ├── dir
-        │   ├── file1.txt # Contains 'env1'
-        │   └── file3.txt # Contains 'both1'
-        ├── file1.txt # Contains 'env1'
-        └── file3.txt # Contains 'both1'
-        
-        ENV2
-        ├── dir
-        │   ├── file2.txt # Contains 'env2'
-        │   └── file3.txt # Contains 'both2'
-        ├── dir2
-        │   └── file2.txt # Contains 'env2'
-        ├── file2.txt # Contains 'env2'
-        └── file3.txt # Contains 'both2'
-        
-        Result should be :
-        ├── dir
-        │   ├── file1.txt # Contains 'env1'
-        │   ├── file2.txt # Contains 'env2'
-        │   └── file3.txt # Contains 'both1'
-        ├── dir2
-        │   └── file2.txt # Contains 'env2'
-        ├── file1.txt # Contains 'env1'
-        ├── file2.txt # Contains 'env2'
-        └── file3.txt # Contains 'both1'
-        """
-        env1 = open(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz"), "rb")
-        env2 = open(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV2}.tgz"), "rb")
-        result = utils.merge_tar_gz(env1, env2)
-        tar = tarfile.open(fileobj=result, mode="r:gz")
-        
-        env1.close()
-        env2.close()
-        
-        expected = {
-            "",
-            "dir",
-            "dir/file1.txt",
-            "dir/file2.txt",
-            "dir/file3.txt",
-            "dir2",
-            "dir2/file2.txt",
-            "file1.txt",
-            "file2.txt",
-            "file3.txt",
-        }
-        
-        self.assertSetEqual(expected, {t.name for t in tar.getmembers()})
-        self.assertEqual(b"env1\n", tar.extractfile("dir/file1.txt").read())
-        self.assertEqual(b"env2\n", tar.extractfile("dir/file2.txt").read())
-        self.assertEqual(b"both1\n", tar.extractfile("dir/file3.txt").read())
-        self.assertEqual(b"env2\n", tar.extractfile("dir2/file2.txt").read())
-        self.assertEqual(b"env1\n", tar.extractfile("file1.txt").read())
-        self.assertEqual(b"env2\n", tar.extractfile("file2.txt").read())
-        self.assertEqual(b"both1\n", tar.extractfile("file3.txt").read())
-        
-        tar.close()
-
-
-
 class GetEnvTestCase(SandboxTestCase):
     
     def test_get_env_ok(self):
@@ -125,11 +50,24 @@ class ExtractTestCase(SandboxTestCase):
 
 
 
-class ExecutedEnvTestCase(SandboxTestCase):
+class ExecutedEnvTestCase(EnvTestCase):
     
     def setUp(self):
         super().setUp()
         self.factory = RequestFactory()
+        self.envpath = os.path.join(TEST_ENVIRONMENT_ROOT, "envpath")
+        os.mkdir(self.envpath)
+    
+    
+    def extracted(self) -> dict:
+        """Return the content of the files extracted in <self.envpath>, by path."""
+        files = dict()
+        for root, _, names in os.walk(self.envpath):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    files[os.path.relpath(path, self.envpath)] = f.read()
+        return files
     
     
     def test_executed_env_not_found(self):
@@ -138,14 +76,26 @@ class ExecutedEnvTestCase(SandboxTestCase):
             utils.executed_env(request, {"environment": "unknown"})
     
     
+    def test_executed_env_none(self):
+        request = self.factory.post(reverse("sandbox:execute"))
+        env = utils.executed_env(request, {})
+        self.assertEqual([], env.archives)
+        env.extract(self.envpath)
+        self.assertEqual({}, self.extracted())
+    
+    
     def test_executed_env_only_sandbox(self):
         request = self.factory.post(reverse("sandbox:execute"))
-        env_uuid = utils.executed_env(request, {"environment": ENV1})
+        env = utils.executed_env(request, {"environment": ENV1})
+        env.extract(self.envpath)
         
-        env1_path = os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz")
-        executed_env_path = os.path.join(TEST_ENVIRONMENT_ROOT, "%s.tgz" % env_uuid)
-        with open(env1_path, "rb") as env1, open(executed_env_path, "rb") as executed_env:
-            self.assertEqual(env1.read(), executed_env.read())
+        self.assertTrue(all(archive.closed for archive in env.archives))
+        self.assertEqual({
+            "dir/file1.txt": b"env1\n",
+            "dir/file3.txt": b"both1\n",
+            "file1.txt":     b"env1\n",
+            "file3.txt":     b"both1\n",
+        }, self.extracted())
     
     
     def test_executed_env_only_body(self):
@@ -153,43 +103,75 @@ class ExecutedEnvTestCase(SandboxTestCase):
         request.FILES["environment"] = open(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV2}.tgz"),
                                             "rb")
         
-        env_uuid = utils.executed_env(request, {})
-        env2_path = os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV2}.tgz")
-        executed_env_path = os.path.join(TEST_ENVIRONMENT_ROOT, "%s.tgz" % env_uuid)
-        with open(env2_path, "rb") as env2, open(executed_env_path, "rb") as executed_env:
-            self.assertEqual(env2.read(), executed_env.read())
+        env = utils.executed_env(request, {})
+        env.extract(self.envpath)
+        self.assertEqual({
+            "dir/file2.txt":  b"env2\n",
+            "dir/file3.txt":  b"both2\n",
+            "dir2/file2.txt": b"env2\n",
+            "file2.txt":      b"env2\n",
+            "file3.txt":      b"both2\n",
+        }, self.extracted())
     
     
     def test_executed_env_sandbox_and_body(self):
-        """See 'test_merge_tar_gz()' for information about the tests done."""
+        """
+        ENV1
+        ├── dir
+        │   ├── file1.txt # Contains 'env1'
+        │   └── file3.txt # Contains 'both1'
+        ├── file1.txt # Contains 'env1'
+        └── file3.txt # Contains 'both1'
+        
+        ENV2
+        ├── dir
+        │   ├── file2.txt # Contains 'env2'
+        │   └── file3.txt # Contains 'both2'
+        ├── dir2
+        │   └── file2.txt # Contains 'env2'
+        ├── file2.txt # Contains 'env2'
+        └── file3.txt # Contains 'both2'
+        
+        Result should be :
+        ├── dir
+        │   ├── file1.txt # Contains 'env1'
+        │   ├── file2.txt # Contains 'env2'
+        │   └── file3.txt # Contains 'both1'
+        ├── dir2
+        │   └── file2.txt # Contains 'env2'
+        ├── file1.txt # Contains 'env1'
+        ├── file2.txt # Contains 'env2'
+        └── file3.txt # Contains 'both1'
+        """
         request = self.factory.post(reverse("sandbox:execute"))
         request.FILES["environment"] = open(os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz"),
                                             "rb")
         
-        env_uuid = utils.executed_env(request, {"environment": ENV2})
+        env = utils.executed_env(request, {"environment": ENV2})
+        env.extract(self.envpath)
+        self.assertEqual({
+            "dir/file1.txt":  b"env1\n",
+            "dir/file2.txt":  b"env2\n",
+            "dir/file3.txt":  b"both1\n",
+            "dir2/file2.txt": b"env2\n",
+            "file1.txt":      b"env1\n",
+            "file2.txt":      b"env2\n",
+            "file3.txt":      b"both1\n",
+        }, self.extracted())
+    
+    
+    def test_executed_env_writes_nothing(self):
+        path = os.path.join(TEST_ENVIRONMENT_ROOT, f"{ENV1}.tgz")
         
-        with tarfile.open(os.path.join(TEST_ENVIRONMENT_ROOT, "%s.tgz" % env_uuid), "r:gz") as tar:
-            expected = {
-                "",
-                "dir",
-                "dir/file1.txt",
-                "dir/file2.txt",
-                "dir/file3.txt",
-                "dir2",
-                "dir2/file2.txt",
-                "file1.txt",
-                "file2.txt",
-                "file3.txt",
-            }
-            
-            self.assertSetEqual(expected, {t.name for t in tar.getmembers()})
-            self.assertEqual(b"env1\n", tar.extractfile("dir/file1.txt").read())
-            self.assertEqual(b"env2\n", tar.extractfile("dir/file2.txt").read())
-            self.assertEqual(b"both1\n", tar.extractfile("dir/file3.txt").read())
-            self.assertEqual(b"env2\n", tar.extractfile("dir2/file2.txt").read())
-            self.assertEqual(b"env1\n", tar.extractfile("file1.txt").read())
-            self.assertEqual(b"env2\n", tar.extractfile("file2.txt").read())
-            self.assertEqual(b"both1\n", tar.extractfile("file3.txt").read())
+        def listing():
+            return {os.path.join(root, name) for root, dirs, files in os.walk(TEST_ENVIRONMENT_ROOT)
+                    for name in dirs + files}
+        
+        before = listing()
+        with open(path, "rb") as f:
+            utils.store_env(f, {"environment": ENV2}).close()
+        utils.store_env(None, {}).close()
+        self.assertEqual(before, listing())
 
 
 
@@ -269,6 +251,100 @@ class ParseSavePathTestCase(SimpleTestCase):
 
 
 
+class ParsePriorityTestCase(SimpleTestCase):
+    
+    def test_parse_priority_ok(self):
+        self.assertEqual("batch", utils.parse_priority({"priority": "batch"}))
+    
+    
+    def test_parse_priority_default(self):
+        self.assertEqual(settings.SCHEDULER_DEFAULT_PRIORITY, utils.parse_priority({}))
+    
+    
+    def test_parse_priority_unknown(self):
+        with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+            utils.parse_priority({"priority": "urgent"})
+
+
+
+class ParseMaxWaitTestCase(SimpleTestCase):
+    
+    def test_parse_max_wait_ok(self):
+        self.assertEqual(0.5, utils.parse_max_wait({"max_wait": 0.5}))
+    
+    
+    def test_parse_max_wait_default(self):
+        self.assertEqual(settings.WAIT_FOR_CONTAINER_DURATION, utils.parse_max_wait({}))
+    
+    
+    def test_parse_max_wait_invalid(self):
+        for max_wait in ("1", -1, settings.MAX_WAIT_FOR_CONTAINER_DURATION + 1, True):
+            with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+                utils.parse_max_wait({"max_wait": max_wait})
+
+
+
+class ParseLimitsTestCase(SimpleTestCase):
+    
+    def test_parse_limits_ok(self):
+        self.assertEqual(
+            {"cpu_time": 2, "memory": 1024, "pids": None},
+            utils.parse_limits({"limits": {"cpu_time": 2, "memory": 1024}})
+        )
+    
+    
+    def test_parse_limits_default(self):
+        self.assertEqual(
+            {"cpu_time": None, "memory": None, "pids": None}, utils.parse_limits({})
+        )
+    
+    
+    def test_parse_limits_invalid(self):
+        for limits in (
+                [], {"cpu_time": 0}, {"cpu_time": 1.5}, {"pids": True}, {"wall": 1},
+                {"memory": settings.EXECUTE_MAX_MEMORY + 1},
+        ):
+            with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+                utils.parse_limits({"limits": limits})
+    
+    
+    def test_parse_limits_container(self):
+        parameters = {**settings.DOCKER_PARAMETERS, "mem_limit": "64m", "pids_limit": 16}
+        with override_settings(DOCKER_PARAMETERS=parameters):
+            self.assertEqual(
+                {"cpu_time": None, "memory": 64000000, "pids": 16},
+                utils.parse_limits({"limits": {"memory": 64000000, "pids": 16}})
+            )
+            for limits in ({"memory": 64000001}, {"pids": 17}):
+                with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+                    utils.parse_limits({"limits": limits})
+        
+        parameters = {**settings.DOCKER_PARAMETERS, "mem_limit": -1}
+        with override_settings(DOCKER_PARAMETERS=parameters):
+            memory = settings.EXECUTE_MAX_MEMORY
+            self.assertEqual(memory, utils.parse_limits({"limits": {"memory": memory}})["memory"])
+
+
+
+class ParseClientTestCase(SimpleTestCase):
+    
+    def test_parse_client_ok(self):
+        request = RequestFactory().post("/")
+        self.assertEqual("teacher", utils.parse_client(request, {"client": "teacher"}))
+    
+    
+    def test_parse_client_default(self):
+        request = RequestFactory().post("/", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual("10.0.0.1", utils.parse_client(request, {}))
+    
+    
+    def test_parse_client_not_str(self):
+        with self.assertRaises(HTTPExceptions.BAD_REQUEST):
+            utils.parse_client(RequestFactory().post("/"), {"client": 1})
+
+
+
+@override_settings(DOCKER_CPU_PINNING=False)
 class ContainerCpuTestCase(SimpleTestCase):
     
     @override_settings(DOCKER_PARAMETERS={
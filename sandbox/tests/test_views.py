@@ -4,6 +4,8 @@
 #   - Coumes Quentin <coumes.quentin@gmail.com>
 
 
+import hashlib
+import io
 import json
 import os
 import tarfile
@@ -15,6 +17,7 @@ from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 
 from .utils import ENV1, ENV2
+from .. import containers, store, utils
 from ..containers import Sandbox
 from ..enums import SandboxErrCode
 from ..tests.utils import EnvTestCase, SandboxTestCase
@@ -45,6 +48,27 @@ class EnvViewTestCase(EnvTestCase):
             self.assertEqual(f.read(), response.content)
     
     
+    def test_get_codec(self):
+        url = reverse("sandbox:environment", args=(ENV1,)) + "?codec=tar"
+        response = self.client.get(url)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/x-tar")
+        self.assertEqual(response['Content-Disposition'], f"attachment; filename={ENV1}.tar")
+        with tarfile.open(fileobj=io.BytesIO(response.content), mode="r:") as tar:
+            self.assertEqual(b"env1\n", tar.extractfile("file1.txt").read())
+        
+        response = self.client.head(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Content-Length", response)
+    
+    
+    def test_get_codec_unknown(self):
+        url = reverse("sandbox:environment", args=(ENV1,)) + "?codec=rar"
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.head(url).status_code, 400)
+    
+    
     def test_head_404(self):
         response = self.client.head(reverse("sandbox:environment", args=(uuid.uuid4(),)))
         self.assertEqual(response.status_code, 404)
@@ -104,6 +128,80 @@ class FileViewTestCase(EnvTestCase):
         self.assertEqual(404, response.status_code)
 
 
+class UploadViewTestCase(EnvTestCase):
+    
+    def post(self, sha256: str, data: dict, token: str = None):
+        headers = {} if token is None else {"HTTP_AUTHORIZATION": f"Token {token}"}
+        return self.client.post(reverse("sandbox:upload", args=(sha256,)), data, **headers)
+    
+    
+    def test_upload(self):
+        path = os.path.join(settings.ENVIRONMENT_ROOT, f"{ENV1}.tgz")
+        with open(path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        url = reverse("sandbox:upload", args=(sha256,))
+        self.assertEqual(404, self.client.head(url).status_code)
+        
+        with open(path, "rb") as f:
+            response = self.post(sha256, {"environment": f})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(200, self.client.head(url).status_code)
+        
+        env = utils.store_env(None, {"sha256": sha256})
+        self.assertEqual([store.path(sha256)], [archive.name for archive in env.archives])
+        self.assertEqual(sha256, hashlib.sha256(env.archives[0].read()).hexdigest())
+        env.close()
+    
+    
+    def test_upload_mismatch(self):
+        with open(os.path.join(settings.ENVIRONMENT_ROOT, f"{ENV1}.tgz"), "rb") as f:
+            response = self.post("0" * 64, {"environment": f})
+        self.assertEqual(400, response.status_code)
+    
+    
+    def test_upload_missing_file(self):
+        response = self.post("0" * 64, {})
+        self.assertEqual(400, response.status_code)
+    
+    
+    @override_settings(UPLOAD_TOKEN="secret")
+    def test_upload_token(self):
+        path = os.path.join(settings.ENVIRONMENT_ROOT, f"{ENV1}.tgz")
+        with open(path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        
+        for token in (None, "wrong"):
+            with open(path, "rb") as f:
+                response = self.post(sha256, {"environment": f}, token)
+            self.assertEqual(403, response.status_code)
+        self.assertEqual([], os.listdir(store.store_dir()))
+        
+        with open(path, "rb") as f:
+            response = self.post(sha256, {"environment": f}, "secret")
+        self.assertEqual(201, response.status_code)
+    
+    
+    def test_upload_invalid(self):
+        content = b"not an archive"
+        sha256 = hashlib.sha256(content).hexdigest()
+        env = io.BytesIO(content)
+        env.name = "env.tgz"
+        response = self.post(sha256, {"environment": env})
+        self.assertEqual(400, response.status_code)
+        self.assertIsNone(store.get(sha256))
+    
+    
+    @override_settings(UPLOAD_MAX_SIZE=16)
+    def test_upload_too_large(self):
+        path = os.path.join(settings.ENVIRONMENT_ROOT, f"{ENV1}.tgz")
+        with open(path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        with open(path, "rb") as f:
+            response = self.post(sha256, {"environment": f})
+        self.assertEqual(413, response.status_code)
+        self.assertIsNone(store.get(sha256))
+
+
 class SpecificationsTestCase(SandboxTestCase):
     
     @override_settings(
@@ -113,7 +211,8 @@ class SpecificationsTestCase(SandboxTestCase):
                 "storage_opt": {},
             },
         },
-        DOCKER_COUNT=2
+        DOCKER_COUNT=2,
+        DOCKER_CPU_PINNING=False,
     )
     def test_specifications_ok(self):
         response = self.client.get(reverse("sandbox:specs"))
@@ -139,6 +238,18 @@ class SpecificationsTestCase(SandboxTestCase):
         self.assertEqual(300000000, specs["container"]["memory"]["storage"])
     
     
+    def test_specifications_cpu_pinning(self):
+        response = self.client.get(reverse("sandbox:specs"))
+        self.assertEqual(response.status_code, 200)
+        
+        specs = json.loads(response.content.decode())
+        self.assertEqual(settings.DOCKER_CPUS_PER_CONTAINER, specs["container"]["cpu"]["count"])
+        self.assertEqual(
+            {s.name for s in containers.CONTAINERS.queue},
+            set(specs["container"]["cpu"]["assignments"])
+        )
+    
+    
     def test_specifications_405(self):
         response = self.client.post(reverse("sandbox:specs"))
         self.assertEqual(response.status_code, 405)
@@ -163,6 +274,64 @@ class UsageTestCase(SandboxTestCase):
         self.assertEqual(response.status_code, 405)
 
 
+class PoolTestCase(SandboxTestCase):
+    
+    def test_pool_disabled(self):
+        response = self.client.get(reverse("sandbox:pool"), HTTP_AUTHORIZATION="Token None")
+        self.assertEqual(response.status_code, 403)
+    
+    
+    @override_settings(ADMIN_TOKEN="secret")
+    def test_pool_invalid_token(self):
+        response = self.client.get(reverse("sandbox:pool"), HTTP_AUTHORIZATION="Token wrong")
+        self.assertEqual(response.status_code, 403)
+    
+    
+    @override_settings(ADMIN_TOKEN="secret")
+    def test_pool_get(self):
+        response = self.client.get(reverse("sandbox:pool"), HTTP_AUTHORIZATION="Token secret")
+        self.assertEqual(response.status_code, 200)
+        
+        pool = json.loads(response.content.decode())
+        self.assertFalse(pool["rolling_out"])
+        self.assertEqual(settings.DOCKER_PARAMETERS["image"], pool["parameters"]["image"])
+        self.assertEqual(settings.DOCKER_COUNT, pool["status"]["size"])
+    
+    
+    @override_settings(ADMIN_TOKEN="secret")
+    def test_pool_post_size(self):
+        response = self.client.post(
+            reverse("sandbox:pool"), {"size": 2}, content_type="application/json",
+            HTTP_AUTHORIZATION="Token secret"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(2, json.loads(response.content.decode())["status"]["size"])
+    
+    
+    @override_settings(ADMIN_TOKEN="secret", DOCKER_PARAMETERS=dict(settings.DOCKER_PARAMETERS))
+    def test_pool_post_parameters(self):
+        response = self.client.post(
+            reverse("sandbox:pool"), {"parameters": {"mem_limit": "150m"}},
+            content_type="application/json", HTTP_AUTHORIZATION="Token secret"
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(json.loads(response.content.decode())["rolling_out"])
+        
+        while containers.rolling_out():
+            time.sleep(0.1)
+        self.assertEqual("150m", settings.DOCKER_PARAMETERS["mem_limit"])
+    
+    
+    @override_settings(ADMIN_TOKEN="secret")
+    def test_pool_post_invalid(self):
+        for body in ({"size": 0}, {"size": "2"}, {"parameters": []}, {"image": "unknown:nope"}):
+            response = self.client.post(
+                reverse("sandbox:pool"), body, content_type="application/json",
+                HTTP_AUTHORIZATION="Token secret"
+            )
+            self.assertEqual(response.status_code, 400)
+
+
 class LibrariesTestCase(SimpleTestCase):
     
     def test_libraries_ok(self):
@@ -465,3 +634,109 @@ class ExecuteTestCase(SandboxTestCase):
         }
         response = self.client.post(reverse("sandbox:execute"), data=data)
         self.assertEqual(response.status_code, 400)
+
+
+
+class ExecuteStreamTestCase(SandboxTestCase):
+    
+    @staticmethod
+    def events(response) -> list:
+        """Return the list of (event, data) of a stream of server-sent events."""
+        events = list()
+        for event in b"".join(response.streaming_content).decode().split("\n\n")[:-1]:
+            name, data = event.split("\n")
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+        return events
+    
+    
+    def test_execute_stream(self):
+        data = {
+            "config": json.dumps({
+                "commands": [
+                    "echo $((1+1))",
+                    "-false",
+                    "echo error >&2; false",
+                    "true",
+                ]
+            })
+        }
+        response = self.client.post(reverse("sandbox:execute-stream"), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual("text/event-stream", response["Content-Type"])
+        
+        events = self.events(response)
+        self.assertEqual(
+            ["start", "stdout", "exit", "start", "exit", "start", "stderr", "exit", "result"],
+            [name for name, _ in events]
+        )
+        self.assertEqual({"index": 0, "data": "2\n"}, events[1][1])
+        self.assertEqual(1, events[4][1]["exit_code"])
+        self.assertEqual({"index": 2, "data": "error\n"}, events[6][1])
+        
+        result = events[-1][1]
+        self.assertEqual(1, result["status"])
+        self.assertEqual(3, len(result["execution"]))
+        self.assertNotIn("stdout", result["execution"][0])
+        self.assertEqual(0, containers.pool_status()["running"])
+    
+    
+    def test_execute_stream_missing_config(self):
+        response = self.client.post(reverse("sandbox:execute-stream"))
+        self.assertEqual(response.status_code, 400)
+
+
+
+class ExecuteBatchTestCase(SandboxTestCase):
+    
+    def test_execute_batch(self):
+        with open(os.path.join(settings.ENVIRONMENT_ROOT, f"{ENV1}.tgz"), "rb") as env:
+            data = {
+                "config": json.dumps({
+                    "configs":     [
+                        {"commands": ["echo $((1+1))"]},
+                        {"commands": ["cat file1.txt"], "upload": "shared"},
+                        {"commands": ["false"]},
+                        {"commands": ["true"], "environment": str(uuid.uuid4())},
+                        {"commands": ["ls file1.txt"], "upload": "shared"},
+                    ],
+                    "concurrency": 2,
+                }),
+                "shared": env,
+            }
+            response = self.client.post(reverse("sandbox:execute-batch"), data)
+        self.assertEqual(response.status_code, 200)
+        
+        results = json.loads(response.content.decode())["results"]
+        self.assertEqual(5, len(results))
+        self.assertEqual("2", results[0]["execution"][0]["stdout"])
+        self.assertEqual(0, results[1]["status"])
+        self.assertEqual(1, results[2]["status"])
+        self.assertEqual(404, results[3]["error"]["status"])
+        self.assertEqual("file1.txt", results[4]["execution"][0]["stdout"])
+        self.assertEqual(0, containers.pool_status()["running"])
+    
+    
+    def test_execute_batch_stream(self):
+        data = {
+            "config": json.dumps({
+                "configs": [{"commands": [f"echo {i}"]} for i in range(4)],
+            })
+        }
+        response = self.client.post(reverse("sandbox:execute-batch-stream"), data)
+        self.assertEqual(response.status_code, 200)
+        
+        events = ExecuteStreamTestCase.events(response)
+        self.assertEqual(["result"] * 4 + ["end"], [name for name, _ in events])
+        self.assertEqual([0, 1, 2, 3], [data["index"] for _, data in events[:-1]])
+        self.assertEqual(
+            ["0", "1", "2", "3"], [data["execution"][0]["stdout"] for _, data in events[:-1]]
+        )
+    
+    
+    def test_execute_batch_invalid(self):
+        data = {
+            "config": json.dumps({"configs": [{"commands": ["true"]}, {"commands": []}]})
+        }
+        response = self.client.post(reverse("sandbox:execute-batch"), data)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.content.decode().startswith("configs[1]: "))
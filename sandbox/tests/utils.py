@@ -2,12 +2,13 @@ import inspect
 import os
 import shutil
 import tarfile
+import time
 import uuid
 
 from django.test import Client, SimpleTestCase, override_settings
 from docker.errors import DockerException
 
-from ..containers import initialise_containers, purging_containers
+from ..containers import initialise_containers, pool_status, purging_containers
 
 
 RESOURCES_ROOT = os.path.join(os.path.dirname(__file__), "resources")
@@ -23,10 +24,17 @@ ENV2 = "e77f958e-4757-4e8f-89eb-21a0153d53d4"
 DUMMY_GIT_URL = "https://github.com/github/practice"
 
 
-def raises_docker_exception():
+def raises_docker_exception(*_, **__):
     raise DockerException
 
 
+def wait_recycled(timeout: float = 10):
+    """Wait for every released container to be recycled."""
+    start = time.time()
+    while pool_status()["recycling"] and time.time() - start < timeout:
+        time.sleep(0.05)
+
+
 class EnvTestCase(SimpleTestCase):
     """Base class for tests using ENVIRONMENT_ROOT.
     
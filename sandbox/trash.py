@@ -0,0 +1,179 @@
+# trash.py
+#
+# Authors:
+#   - Coumes Quentin <coumes.quentin@gmail.com>
+
+
+"""Fast removal of the containers' working directories.
+
+Instead of being deleted synchronously, directories are atomically renamed into
+[DOCKER_VOLUME_HOST_BASEDIR]/.trash/, which is emptied by a low priority reaper thread removing at
+most DOCKER_TRASH_REAP_RATE entries per second, so that it does not compete with running jobs."""
+
+import logging
+import os
+import stat
+import threading
+import time
+import uuid
+
+import psutil
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+TRASH_DIRNAME = ".trash"
+
+_WAKEUP = threading.Event()
+_REAPER_LOCK = threading.Lock()
+_REAPER: threading.Thread = None
+
+
+
+def trash_dir() -> str:
+    """Return the path of the trash directory, creating it if needed."""
+    path = os.path.join(settings.DOCKER_VOLUME_HOST_BASEDIR, TRASH_DIRNAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+
+def discard(path: str):
+    """Atomically move <path> to the trash, it will be deleted later by the reaper."""
+    os.rename(path, os.path.join(trash_dir(), uuid.uuid4().hex))
+    _WAKEUP.set()
+
+
+
+def empty(path: str):
+    """Move every entry of the directory <path> to the trash, creating <path> if it does not
+    exist.
+    
+    Unlike 'discard()', <path> itself is kept, so that the inode mounted by a running container
+    stays valid."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        return
+    
+    entries = list(os.scandir(path))
+    if not entries:
+        return
+    
+    # Entries are gathered in a hidden directory, ignored by the reaper until it is complete.
+    name = uuid.uuid4().hex
+    staging = os.path.join(trash_dir(), f".{name}")
+    os.mkdir(staging)
+    for entry in entries:
+        os.rename(entry.path, os.path.join(staging, entry.name))
+    os.rename(staging, os.path.join(trash_dir(), name))
+    _WAKEUP.set()
+
+
+
+class _Throttle:
+    """Allow at most <rate> operations per second, <rate> being 0 means no limit."""
+    
+    
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.count = 0
+    
+    
+    def tick(self):
+        """Count an operation, sleeping if needed to respect the rate."""
+        if not self.rate:
+            return
+        
+        self.count += 1
+        delay = self.count / self.rate - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+
+def _remove(path: str, throttle: _Throttle):
+    """Remove <path> and its content, calling <throttle.tick()> after each removal."""
+    
+    def unlink(function, p):
+        try:
+            function(p)
+        except PermissionError:
+            # The student may have removed the write permission of the parent directory.
+            parent = os.path.dirname(p)
+            os.chmod(parent, os.stat(parent).st_mode | stat.S_IRWXU)
+            function(p)
+        except FileNotFoundError:  # pragma: no cover
+            pass
+        throttle.tick()
+    
+    if not os.path.isdir(path) or os.path.islink(path):
+        unlink(os.remove, path)
+        return
+    
+    # The student may have made directories unreadable or unsearchable, which 'os.walk()' would
+    # silently skip: they are all made accessible before descending into them.
+    os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+    for root, dirs, _ in os.walk(path):
+        for name in dirs:
+            p = os.path.join(root, name)
+            if not os.path.islink(p):
+                os.chmod(p, os.lstat(p).st_mode | stat.S_IRWXU)
+    
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            unlink(os.remove, os.path.join(root, name))
+        for name in dirs:
+            p = os.path.join(root, name)
+            unlink(os.remove if os.path.islink(p) else os.rmdir, p)
+    unlink(os.rmdir, path)
+
+
+
+def reap():
+    """Delete every entry currently in the trash."""
+    throttle = _Throttle(settings.DOCKER_TRASH_REAP_RATE)
+    for entry in os.scandir(trash_dir()):
+        if entry.name.startswith("."):
+            continue
+        try:
+            _remove(entry.path, throttle)
+        except OSError:
+            logger.exception(f"Could not remove '{entry.path}' from the trash")
+
+
+
+def _lower_priority():
+    """Lower the CPU and I/O priorities of the calling thread."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        psutil.Process(threading.get_native_id()).ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (OSError, AttributeError, psutil.Error):  # pragma: no cover
+        logger.info("Could not lower the priority of the trash reaper")
+
+
+
+def _reaper():
+    """Empty the trash each time something is put in it."""
+    _lower_priority()
+    while True:
+        _WAKEUP.wait(60)
+        _WAKEUP.clear()
+        try:
+            reap()
+        except Exception:  # pragma: no cover
+            logger.exception("Error while emptying the trash")
+
+
+
+def start_reaper():
+    """Start the reaper thread if it is not already running, emptying any trash left by a
+    previous process."""
+    global _REAPER
+    
+    with _REAPER_LOCK:
+        if _REAPER is None or not _REAPER.is_alive():
+            _REAPER = threading.Thread(target=_reaper, name="sandbox-trash-reaper", daemon=True)
+            _REAPER.start()
+    _WAKEUP.set()
@@ -14,8 +14,14 @@ app_name = "sandbox"
 urlpatterns = [
     path(r'environments/<uuid:env>/', views.EnvView.as_view(), name="environment"),
     path(r'files/<uuid:env>/<path:path>/', views.FileView.as_view(), name="file"),
+    path(r'uploads/<str:sha256>/', views.UploadView.as_view(), name="upload"),
     path(r'specifications/', views.SpecificationsView.as_view(), name="specs"),
     path(r'usages/', views.UsageView.as_view(), name="usage"),
+    path(r'pool/', views.PoolView.as_view(), name="pool"),
     path(r'libraries/', views.LibrariesView.as_view(), name="libraries"),
     path(r'execute/', views.ExecuteView.as_view(), name="execute"),
+    path(r'execute/stream/', views.ExecuteStreamView.as_view(), name="execute-stream"),
+    path(r'execute/batch/', views.ExecuteBatchView.as_view(), name="execute-batch"),
+    path(r'execute/batch/stream/', views.ExecuteBatchStreamView.as_view(),
+         name="execute-batch-stream"),
 ]
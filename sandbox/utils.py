@@ -4,76 +4,51 @@
 #   - Coumes Quentin <coumes.quentin@gmail.com>
 
 
+import hmac
 import io
+import json
 import logging
 import os
 import subprocess
 import tarfile
 import time
 import uuid
-from typing import BinaryIO, Optional, Tuple
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
 
+import docker
 import humanfriendly
 import psutil
 from django.conf import settings
 from django.http import HttpRequest
 from django_http_exceptions import HTTPExceptions
+from docker.errors import DockerException
+from docker.types import Ulimit
 
-from sandbox.containers import Sandbox
+from sandbox import archives, cache, containers, store
+from sandbox.placement import compute_slots, parse_cpuset
 
 
 logger = logging.getLogger(__name__)
 
 
-def merge_tar_gz(a: Optional[BinaryIO], b: Optional[BinaryIO]) -> Optional[BinaryIO]:
-    """Merge <a> and <b>, returning a new tarfile.TarFile object.
-
-    If two files in <a> and <b> have the same name, the one in <a> prevails.
-    
-    Both a and b can be safely closed after this function.
-    
-    Returns
-        None       - If both arguments are None.
-        a          - If <b> is None.
-        b          - If <a> is None.
-        io.BytesIO - A BytesIO, cursor set at the start, corresponding to the
-                     merging of <a> into <b> (overwriting file with the same
-                     name)."""
-    if a is None:
-        return None if b is None else io.BytesIO(b.read())
-    if b is None:
-        return io.BytesIO(a.read())
-    
-    destio = io.BytesIO()
-    
-    with tarfile.open(fileobj=a, mode="r:gz") as t1, \
-            tarfile.open(fileobj=b, mode="r:gz") as t2, \
-            tarfile.open(fileobj=destio, mode="w:gz") as dest:
-        
-        t1_members = [m for m in t1.getmembers()]
-        t1_names = t1.getnames()
-        t2_members = [m for m in t2.getmembers() if m.name not in t1_names]
-        
-        for member in t1_members:
-            if member.isdir():
-                dest.addfile(member)
-            else:
-                dest.addfile(member, t1.extractfile(member))
-        
-        for member in t2_members:
-            if member.isdir():
-                dest.addfile(member)
-            else:
-                dest.addfile(member, t2.extractfile(member))
-    
-    destio.seek(0)
-    return destio
+def _members(tar: tarfile.TarFile, skipped: Set[str],
+             names: Set[str]) -> Iterator[tarfile.TarInfo]:
+    """Yield the members of <tar>, opened in stream mode, whose name is not in <skipped>, adding
+    their names to <names>."""
+    for member in tar:
+        if member.name not in skipped:
+            names.add(member.name)
+            yield member
 
 
 def get_env(env: str) -> Optional[str]:
-    """Returns the path of the environment <env>, None if it does not exists."""
-    path = os.path.join(settings.ENVIRONMENT_ROOT, f"{env}.tgz")
-    return path if os.path.isfile(path) else None
+    """Returns the path of the environment <env>, whatever its codec, None if it does not
+    exists."""
+    for codec in archives.CODECS.values():
+        path = os.path.join(settings.ENVIRONMENT_ROOT, f"{env}{codec.extension}")
+        if os.path.isfile(path):
+            return path
+    return None
 
 
 def extract(env: str, path: str) -> Optional[BinaryIO]:
@@ -83,29 +58,130 @@ def extract(env: str, path: str) -> Optional[BinaryIO]:
     if env_path is None:
         raise HTTPExceptions.NOT_FOUND.with_content(f"No environment with UUID '{env}' found")
     
-    try:
-        with tarfile.open(env_path, mode="r:gz") as tar:
-            buffer = tar.extractfile(tar.getmember(path))
-            file = io.BytesIO(buffer.read())
-    except KeyError:
+    file = None
+    with open(env_path, "rb") as f, archives.open_tar(f, "r") as tar:
+        for member in tar:  # The last member with this name prevails, as when extracted
+            if member.name == path.rstrip("/") and member.isreg():
+                file = io.BytesIO(tar.extractfile(member).read())
+    
+    if file is None:
         raise HTTPExceptions.NOT_FOUND.with_content(
             f"The file '{path}' could not be found in environment '{env}'"
         )
-    
     return file
 
 
-def executed_env(request: HttpRequest, config: dict) -> str:
-    """Returns the UUID4 corresponding to the environment that will be used in the execution.
+def parse_config(request: HttpRequest) -> dict:
+    """Return the JSON object sent in the field 'config' of <request>."""
+    config = request.POST.get("config")
+    if config is None:
+        raise HTTPExceptions.BAD_REQUEST.with_content("Missing argument 'config'")
+    
+    try:
+        config = json.loads(config)
+    except json.JSONDecodeError as e:
+        raise HTTPExceptions.BAD_REQUEST.with_content(f"'config' json is invalid - {e}")
+    if not isinstance(config, dict):
+        raise HTTPExceptions.BAD_REQUEST.with_content(
+            f'config must be an object, not {type(config)}'
+        )
+    return config
+
+
+class ExecutedEnv:
+    """Environment of an execution: the archives extracted into the sandbox before executing the
+    commands, a file of an archive prevailing over the ones with the same name in the next
+    archives. If the environment is saved, it will be available as <uuid>.
+    
+    Archives are opened when the environment is created, so that they cannot expire before being
+    extracted, and closed once extracted. Archives used by many executions are not decompressed
+    each time, but materialised from the cache of extracted environments (see cache.py).
+    
+    <body> is an archive sent with the request, prevailing over the ones of <paths>. It is
+    extracted directly from the request, without being written anywhere else, and closed along
+    with the other archives."""
+    
+    
+    def __init__(self, paths: List[str], uuid_env: Optional[str] = None,
+                 body: Optional[BinaryIO] = None):
+        self.uuid = uuid_env if uuid_env is not None else str(uuid.uuid4())
+        # Path of each archive, None for <body> which is not cached.
+        self.paths: List[Optional[str]] = list()
+        self.archives: List[BinaryIO] = list()
+        try:
+            if body is not None:
+                self.paths.append(None)
+                self.archives.append(body)
+            for path in paths:
+                self.archives.append(open(path, "rb"))
+                self.paths.append(path)
+        except BaseException:
+            self.close()
+            raise
+    
+    
+    def extract(self, path: str):
+        """Extract the archives into <path> in a single pass over each one, without writing any
+        intermediate archive, and close them."""
+        try:
+            extracted = set()
+            for source, archive in zip(self.paths, self.archives):
+                names = None
+                if source is not None:
+                    names = cache.materialise(source, archive, path, extracted)
+                if names is None:
+                    names = set()
+                    with archives.open_tar(archive, "r") as tar:
+                        tar.extractall(path, _members(tar, extracted, names))
+                extracted |= names
+        finally:
+            self.close()
+    
+    
+    def close(self):
+        """Close the archives, the environment cannot be extracted anymore."""
+        for archive in self.archives:
+            archive.close()
+
+
+def executed_env(request: HttpRequest, config: dict) -> ExecutedEnv:
+    """Returns the environment that will be used in the execution.
     
-    If an environment is provided both in the body and the config, this function will do the merge
-    through 'merge_tar_gz()'.
+    If an environment is provided both in the body and the config, both are extracted, the files
+    of the body prevailing (see 'ExecutedEnv').
     
     raises:
         - django_http_exceptions.HTTPExceptions.NOT_FOUND if the environment asked in request's
           config cannot be found.
     """
     body_env = request.FILES.get("environment")
+    try:
+        return store_env(body_env, config)
+    except BaseException:
+        if body_env is not None:
+            body_env.close()
+        raise
+
+
+def store_env(body_env: Optional[BinaryIO], config: dict) -> ExecutedEnv:
+    """Return the environment that will be used in the execution, <body_env> prevailing over the
+    environment asked in <config> if both are given (see 'executed_env()').
+    
+    The field 'sha256' of <config> can refer to an environment of the store (see store.py)
+    instead of <body_env>. Nothing is written to the disk: the archives are extracted directly
+    into the sandbox.
+    
+    <body_env> is closed along with the returned environment."""
+    sha256 = config.get("sha256")
+    if sha256 is not None:
+        if body_env is not None:
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                "An environment cannot be both uploaded and referred to by 'sha256'"
+            )
+        if store.get(sha256) is None:
+            raise HTTPExceptions.NOT_FOUND.with_content(
+                f"No uploaded environment with SHA-256 {sha256!r} found"
+            )
     
     sandbox_env = None
     sandbox_env_uuid = config.get("environment")
@@ -115,24 +191,35 @@ def executed_env(request: HttpRequest, config: dict) -> str:
             raise HTTPExceptions.NOT_FOUND.with_content(
                 f"No environment with UUID '{sandbox_env_uuid}' found"
             )
-        sandbox_env = open(sandbox_env, "rb")
     
-    env = merge_tar_gz(body_env, sandbox_env)
-    
-    if body_env is not None:
-        body_env.close()
+    paths = [store.path(sha256)] if sha256 is not None else []
     if sandbox_env is not None:
-        sandbox_env.close()
-    
-    uuid_env = str(uuid.uuid4())
-    path = os.path.join(settings.ENVIRONMENT_ROOT, f"{uuid_env}.tgz")
-    if env is not None:
-        with open(path, "w+b") as f:
-            f.write(env.read())
-    else:
-        tarfile.open(path, "x:gz").close()
+        paths.append(sandbox_env)
+    try:
+        return ExecutedEnv(paths, body=body_env)
+    except FileNotFoundError:  # pragma: no cover
+        raise HTTPExceptions.NOT_FOUND.with_content("The environment expired while being used")
+
+
+def check_upload(request: HttpRequest, name: str, file: BinaryIO) -> None:
+    """Check that <file>, sent as <name> by <request>, can be added to the store (see store.py).
     
-    return uuid_env
+    Raises:
+        - django_http_exceptions.HTTPExceptions.FORBIDDEN if settings.UPLOAD_TOKEN is set and not
+            given in the 'Authorization' header of <request>.
+        - django_http_exceptions.HTTPExceptions.REQUEST_ENTITY_TOO_LARGE if <file> exceeds
+            settings.UPLOAD_MAX_SIZE bytes.
+        - django_http_exceptions.HTTPExceptions.BAD_REQUEST if <file> is not a valid archive."""
+    if settings.UPLOAD_TOKEN is not None:
+        expected = f"Token {settings.UPLOAD_TOKEN}"
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+            raise HTTPExceptions.FORBIDDEN.with_content("Missing or invalid token")
+    if file.size > settings.UPLOAD_MAX_SIZE:
+        raise HTTPExceptions.REQUEST_ENTITY_TOO_LARGE.with_content(
+            f"The file '{name}' exceeds {settings.UPLOAD_MAX_SIZE} bytes"
+        )
+    if not archives.is_archive(file):
+        raise HTTPExceptions.BAD_REQUEST.with_content(f"The file '{name}' is not a valid archive")
 
 
 def parse_environ(config: dict) -> dict:
@@ -168,17 +255,147 @@ def parse_save(config: dict) -> bool:
     return False
 
 
+def parse_priority(config: dict) -> str:
+    """Check the validity of 'priority' in the request and return it, returns
+    settings.SCHEDULER_DEFAULT_PRIORITY if it is not present."""
+    if "priority" in config:
+        if config["priority"] not in settings.SCHEDULER_PRIORITIES:
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f'priority must be one of {list(settings.SCHEDULER_PRIORITIES)}, '
+                f'not {config["priority"]!r}')
+        return config["priority"]
+    return settings.SCHEDULER_DEFAULT_PRIORITY
+
+
+def parse_client(request: HttpRequest, config: dict) -> str:
+    """Check the validity of 'client' in the request and return it, returns the IP address of
+    the request if it is not present."""
+    if "client" in config:
+        if not isinstance(config["client"], str):
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f'client must be a string, not {type(config["client"])}')
+        return config["client"]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def parse_max_wait(config: dict) -> float:
+    """Check the validity of 'max_wait' in the request and return it, returns
+    settings.WAIT_FOR_CONTAINER_DURATION if it is not present."""
+    if "max_wait" in config:
+        max_wait = config["max_wait"]
+        if (
+            not isinstance(max_wait, (int, float)) or isinstance(max_wait, bool)
+            or not 0 <= max_wait <= settings.MAX_WAIT_FOR_CONTAINER_DURATION
+        ):
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f'max_wait must be a number between 0 and '
+                f'{settings.MAX_WAIT_FOR_CONTAINER_DURATION}, not {max_wait!r}')
+        return max_wait
+    return settings.WAIT_FOR_CONTAINER_DURATION
+
+
+def parse_limits(config: dict) -> Dict[str, Optional[int]]:
+    """Check the validity of 'limits' in the request and return them as a dict with the keys
+    'cpu_time', 'memory' and 'pids', None meaning that the corresponding resource is not limited.
+    
+    Each limit must be a positive integer lower than its maximum (see EXECUTE_MAX_CPU_TIME,
+    EXECUTE_MAX_MEMORY and EXECUTE_MAX_PIDS). Limits can only lower those of the containers:
+    'memory' and 'pids' are also bounded by the 'mem_limit' and 'pids_limit' of
+    DOCKER_PARAMETERS."""
+    limits = config.get("limits", {})
+    if not isinstance(limits, dict):
+        raise HTTPExceptions.BAD_REQUEST.with_content(
+            f'limits must be an object, not {limits!r}')
+    
+    maximums = {
+        "cpu_time": settings.EXECUTE_MAX_CPU_TIME,
+        "memory":   settings.EXECUTE_MAX_MEMORY,
+        "pids":     settings.EXECUTE_MAX_PIDS,
+    }
+    container_limits = {
+        "memory": container_ram_swap()[0],
+        "pids":   settings.DOCKER_PARAMETERS.get("pids_limit") or -1,
+    }
+    for name, limit in container_limits.items():
+        if limit > 0:
+            maximums[name] = min(maximums[name], limit)
+    unknown = set(limits) - set(maximums)
+    if unknown:
+        raise HTTPExceptions.BAD_REQUEST.with_content(
+            f'Unknown limits {sorted(unknown)}, expected some of {list(maximums)}')
+    
+    for name, maximum in maximums.items():
+        value = limits.get(name)
+        if value is not None and (
+            not isinstance(value, int) or isinstance(value, bool) or not 0 < value <= maximum
+        ):
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f'limits.{name} must be an integer between 1 and {maximum}, not {value!r}')
+    return {name: limits.get(name) for name in maximums}
+
+
+def parse_pool_config(config: dict) -> Tuple[Optional[int], Optional[dict]]:
+    """Check the validity of a request to '/pool/', returns the new size of the pool and the new
+    DOCKER_PARAMETERS (None for each one if it is not changed).
+    
+    'parameters' are merged into the current DOCKER_PARAMETERS, 'image' being a shortcut for
+    'parameters["image"]'."""
+    size = config.get("size")
+    if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 1):
+        raise HTTPExceptions.BAD_REQUEST.with_content(
+            f'size must be a positive integer, not {size!r}')
+    
+    if "image" not in config and "parameters" not in config:
+        return size, None
+    
+    parameters = config.get("parameters", {})
+    if not isinstance(parameters, dict):
+        raise HTTPExceptions.BAD_REQUEST.with_content(
+            f'parameters must be an object, not {type(parameters)}')
+    parameters = {**containers.pool_configuration()["parameters"], **parameters}
+    if "image" in config:
+        parameters["image"] = config["image"]
+    
+    if not isinstance(parameters["image"], str):
+        raise HTTPExceptions.BAD_REQUEST.with_content(
+            f'image must be a string, not {type(parameters["image"])}')
+    try:
+        docker.from_env().images.get(parameters["image"])
+    except DockerException as e:
+        raise HTTPExceptions.BAD_REQUEST.with_content(
+            f"Image '{parameters['image']}' is not available - {e}")
+    
+    if "ulimits" in parameters:
+        ulimits = parameters["ulimits"]
+        if not isinstance(ulimits, list) or not all(isinstance(u, dict) for u in ulimits):
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f'ulimits must be a list of objects, not {ulimits!r}')
+        parameters["ulimits"] = [Ulimit(**u) for u in parameters["ulimits"]]
+    
+    return size, parameters
+
+
 def container_cpu_count() -> int:
     """Return the number of cpu that a container can use."""
-    cpu_count = settings.DOCKER_PARAMETERS["cpuset_cpus"]
+    if not settings.DOCKER_CPU_PINNING:
+        return len(parse_cpuset(settings.DOCKER_PARAMETERS["cpuset_cpus"]))
     
-    if "-" in cpu_count:
-        lower, upper = cpu_count.split("-")
-        cpu_count = int(upper) - int(lower) + 1
-    else:
-        cpu_count = len(cpu_count.split(","))
+    slots = containers.cpu_slots()
+    if slots is not None:
+        return len(parse_cpuset(slots[0]))
     
-    return cpu_count
+    return len(compute_slots(
+        settings.DOCKER_PARAMETERS["cpuset_cpus"], settings.DOCKER_CPUS_PER_CONTAINER,
+        settings.DOCKER_CPU_SMT, settings.DOCKER_CPU_NUMA
+    )[0])
+
+
+def container_cpu_assignments() -> dict:
+    """Return the CPUs assigned to each container, by container name, an empty dictionary if
+    DOCKER_CPU_PINNING is False."""
+    if not settings.DOCKER_CPU_PINNING:
+        return {}
+    return containers.cpu_assignments()
 
 
 def container_ram_swap() -> Tuple[int, int]:
@@ -190,13 +407,13 @@ def container_ram_swap() -> Tuple[int, int]:
     ram = settings.DOCKER_PARAMETERS.get("mem_limit", -1)
     if ram == "-1":
         ram = -1
-    if ram != -1:
+    if isinstance(ram, str):
         ram = humanfriendly.parse_size(ram)
     
     swap = settings.DOCKER_PARAMETERS.get("memswap_limit", 0)
     if swap == "-1":
         swap = -1
-    if swap != -1:
+    if isinstance(swap, str):
         swap = humanfriendly.parse_size(swap)
     
     if ram == -1 and swap == -1:
@@ -262,10 +479,11 @@ def specifications() -> dict:
         "container": {
             "count":              settings.DOCKER_COUNT,
             "cpu":                {
-                "count":  container_cpu_count(),
-                "period": settings.DOCKER_PARAMETERS.get("cpu_period", -1),
-                "shares": settings.DOCKER_PARAMETERS.get("cpu_shares", -1),
-                "quota":  settings.DOCKER_PARAMETERS.get("cpu_quota", -1)
+                "count":       container_cpu_count(),
+                "assignments": container_cpu_assignments(),
+                "period":      settings.DOCKER_PARAMETERS.get("cpu_period", -1),
+                "shares":      settings.DOCKER_PARAMETERS.get("cpu_shares", -1),
+                "quota":       settings.DOCKER_PARAMETERS.get("cpu_quota", -1)
             },
             "memory":             {
                 "ram":     ram,
@@ -324,10 +542,19 @@ def usage_io_network() -> Tuple[dict, dict]:
     return io_usage, network_usage
 
 
+def pool():
+    """Return the dictionary corresponding to the /pool/ API endpoints."""
+    return {
+        **containers.pool_configuration(),
+        "status": containers.pool_status(),
+    }
+
+
 def usage():
     """Return the dictionary corresponding to the /usage/ API endpoints."""
     
     io_usage, network_usage = usage_io_network()
+    status = containers.pool_status()
     
     return {
         "cpu":       {
@@ -345,5 +572,7 @@ def usage():
         "io":        io_usage,
         "network":   network_usage,
         "process":   len(psutil.pids()),
-        "container": settings.DOCKER_COUNT - Sandbox.available(),
+        "container": status["running"],
+        "pool":      status,
+        "env_cache": cache.stats(),
     }
@@ -4,20 +4,24 @@
 #   - Coumes Quentin <coumes.quentin@gmail.com>
 
 
+import hmac
 import json
 import logging
 import os
-import threading
 import time
 from io import SEEK_END
+from typing import Iterator, Optional, Tuple
 
 import docker
 from django.conf import settings
-from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed,
-                         HttpResponseNotFound, JsonResponse)
+from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+                         HttpResponseNotAllowed, HttpResponseNotFound, JsonResponse,
+                         StreamingHttpResponse)
 from django.views.generic import View
+from django_http_exceptions import HTTPExceptions
 
-from . import utils
+from . import archives, containers, store, utils
+from .batch import Batch
 from .containers import Sandbox
 from .executor import Command, Executor
 
@@ -26,35 +30,59 @@ logger = logging.getLogger(__name__)
 
 
 class EnvView(View):
-    """Handle environment download."""
+    """Handle environment download.
     
+    Environments are sent as '.tgz', or with the codec asked in the parameter 'codec' of the query
+    string (see archives.py), being converted if they are stored with another codec."""
     
-    def head(self, _, env):
-        """Returns a response with status 200 if the environment <env> exists, 404 otherwise."""
+    
+    @staticmethod
+    def _codec(request) -> archives.Codec:
+        """Return the codec asked by <request>, 'gzip' by default."""
+        name = request.GET.get("codec", "gzip")
+        if name not in archives.CODECS:
+            raise HTTPExceptions.BAD_REQUEST.with_content(
+                f"codec must be one of {', '.join(map(repr, archives.CODECS))}, not {name!r}"
+            )
+        return archives.CODECS[name]
+    
+    
+    @staticmethod
+    def _headers(response: HttpResponse, env: str, codec: archives.Codec) -> HttpResponse:
+        """Set the headers of <response>, sending <env> with <codec>."""
+        response['Content-Type'] = codec.content_type
+        response['Content-Disposition'] = f"attachment; filename={env}{codec.extension}"
+        return response
+    
+    
+    def head(self, request, env):
+        """Returns a response with status 200 if the environment <env> exists, 404 otherwise.
+        
+        Content-Length is only given if the environment does not need to be converted."""
+        codec = self._codec(request)
         path = utils.get_env(env)
         if path is None:
             return HttpResponseNotFound(f"No environment with UUID '{env}' found")
         
         response = HttpResponse()
-        response["Content-Length"] = os.stat(path).st_size
-        response['Content-Type'] = "application/gzip"
-        response['Content-Disposition'] = f"attachment; filename={env}.tgz"
-        return response
+        with open(path, "rb") as f:
+            if archives.detect(f) is codec:
+                response["Content-Length"] = os.fstat(f.fileno()).st_size
+        return self._headers(response, env, codec)
     
     
-    def get(self, _, env):
+    def get(self, request, env):
         """Return the environment with the UUID <env>, 404 if it does not exists."""
+        codec = self._codec(request)
         path = utils.get_env(env)
         if path is None:
             return HttpResponseNotFound(f"No environment with UUID '{env}' found")
         
-        with open(path, "rb") as f:
-            response = HttpResponse(f.read())
+        with open(path, "rb") as f, archives.convert(f, codec) as converted:
+            response = HttpResponse(converted.read())
         
-        response["Content-Length"] = os.stat(path).st_size
-        response['Content-Type'] = "application/gzip"
-        response['Content-Disposition'] = f"attachment; filename={env}.tgz"
-        return response
+        response["Content-Length"] = len(response.content)
+        return self._headers(response, env, codec)
 
 
 class FileView(View):
@@ -83,6 +111,55 @@ class FileView(View):
         return response
 
 
+def _unauthorized(request) -> Optional[HttpResponse]:
+    """Return a response with status 403 unless <request> contains settings.ADMIN_TOKEN in its
+    'Authorization' header, None otherwise."""
+    if settings.ADMIN_TOKEN is None:
+        return HttpResponseForbidden("Administration is disabled")
+    
+    expected = f"Token {settings.ADMIN_TOKEN}"
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+        return HttpResponseForbidden("Missing or invalid token")
+    
+    return None
+
+
+class UploadView(View):
+    """Handle the environments uploaded to the store, see store.py."""
+    
+    
+    def head(self, _, sha256):
+        """Returns a response with status 200 if the environment whose SHA-256 is <sha256> is
+        stored, 404 otherwise."""
+        if store.get(sha256) is None:
+            return HttpResponseNotFound(f"No uploaded environment with SHA-256 '{sha256}' found")
+        return HttpResponse()
+    
+    
+    def post(self, request, sha256):
+        """Store the environment sent in the field 'environment' of the body, returns a response
+        with status 201 if its SHA-256 is <sha256>, 400 otherwise.
+        
+        The environment is checked by 'utils.check_upload()': the request must contain
+        settings.UPLOAD_TOKEN if it is set (403 otherwise), and the environment must be an archive
+        (see archives.py) of at most settings.UPLOAD_MAX_SIZE bytes (413 otherwise)."""
+        env = request.FILES.get("environment")
+        if env is None:
+            return HttpResponseBadRequest("Missing file 'environment'")
+        
+        try:
+            utils.check_upload(request, "environment", env)
+            stored = store.put(env)
+        finally:
+            env.close()
+        
+        if stored != sha256:
+            return HttpResponseBadRequest(
+                f"The SHA-256 of the environment is '{stored}', not '{sha256}'"
+            )
+        return HttpResponse(status=201)
+
+
 class SpecificationsView(View):
     
     def get(self, _):
@@ -97,6 +174,49 @@ class UsageView(View):
         return JsonResponse(utils.usage())
 
 
+class PoolView(View):
+    
+    def dispatch(self, request, *args, **kwargs):
+        """Only allow requests containing settings.ADMIN_TOKEN in their 'Authorization' header."""
+        unauthorized = _unauthorized(request)
+        if unauthorized is not None:
+            return unauthorized
+        
+        return super().dispatch(request, *args, **kwargs)
+    
+    
+    def get(self, _):
+        """Returns the current generation and configuration of the pool."""
+        return JsonResponse(utils.pool())
+    
+    
+    def post(self, request):
+        """Change the size of the pool, the image or the parameters of the containers.
+        
+        Changing the size only adds or retires containers. Changing the image or the parameters
+        rolls out a new generation of containers in the background, see
+        'containers.rollout()'."""
+        try:
+            config = json.loads(request.body)
+            if not isinstance(config, dict):
+                return HttpResponseBadRequest(f'body must be an object, not {type(config)}')
+        except json.JSONDecodeError as e:
+            return HttpResponseBadRequest(f"body json is invalid - {e}")
+        
+        if settings.INITIALISING_THREAD.is_alive() or containers.rolling_out():
+            return HttpResponse("The pool is being initialised or rolled out", status=409)
+        
+        size, parameters = utils.parse_pool_config(config)
+        if parameters is None:
+            if size is not None:
+                containers.resize_pool(size)
+            return JsonResponse(utils.pool())
+        
+        if not containers.rollout_in_background(size, parameters):
+            return HttpResponse("The pool is being initialised or rolled out", status=409)
+        return JsonResponse(utils.pool(), status=202)
+
+
 class LibrariesView(View):
     
     def get(self, _):
@@ -109,32 +229,107 @@ class LibrariesView(View):
 
 class ExecuteView(View):
     
-    def post(self, request):
-        """Allows to execute bash commands within an optional environment."""
+    @staticmethod
+    def _executor(request) -> Executor:
+        """Parse the config of <request> and acquire a sandbox, returning the executor of the
+        request."""
         start = time.time()
         
-        config = request.POST.get("config")
-        if config is None:
-            return HttpResponseBadRequest("Missing argument 'config'")
-        
-        try:
-            config = json.loads(config)
-            if not isinstance(config, dict):
-                return HttpResponseBadRequest(f'config must be an object, not {type(config)}')
-        except json.JSONDecodeError as e:
-            return HttpResponseBadRequest(f"'config' json is invalid - {e}")
-        
-        env = utils.executed_env(request, config)
-        commands = Command.from_config(config)
+        config = utils.parse_config(request)
+        limits = utils.parse_limits(config)
+        commands = Command.from_config(config, limits["cpu_time"])
+        cases = Command.cases_from_config(config, limits["cpu_time"])
         result_path = utils.parse_result_path(config)
         save = utils.parse_save(config)
+        priority = utils.parse_priority(config)
+        client = utils.parse_client(request, config)
+        max_wait = utils.parse_max_wait(config)
+        env = utils.executed_env(request, config)
         
         logger.debug(f"Parsing config request took : {time.time() - start} seconds")
         
-        sandbox = Sandbox.acquire()
         try:
-            response = Executor(commands, sandbox, env, result_path, save).execute()
+            sandbox = Sandbox.acquire(priority, client, max_wait)
+        except BaseException:
+            env.close()
+            raise
+        return Executor(commands, sandbox, env, result_path, save, limits, cases)
+    
+    
+    def post(self, request):
+        """Allows to execute bash commands within an optional environment."""
+        start = time.time()
+        executor = self._executor(request)
+        try:
+            response = executor.execute()
             logger.debug(f"Total execute request took : {time.time() - start} seconds")
             return JsonResponse(response)
         finally:
-            threading.Thread(target=sandbox.release).start()
+            executor.sandbox.release()
+
+
+class _EventStream:
+    """Iterate over the server-sent events of an execution, releasing its <sandbox> (if any) once
+    closed (even if the iteration never started)."""
+    
+    
+    def __init__(self, events: Iterator[Tuple[str, dict]], sandbox: Sandbox = None):
+        self.events = self._events(events)
+        self.sandbox = sandbox
+    
+    
+    @staticmethod
+    def _events(events: Iterator[Tuple[str, dict]]) -> Iterator[bytes]:
+        """Yield each of <events>, formatted as a server-sent event."""
+        for name, data in events:
+            yield f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+    
+    
+    def __iter__(self):
+        return self
+    
+    
+    def __next__(self) -> bytes:
+        return next(self.events)
+    
+    
+    def close(self):
+        self.events.close()
+        if self.sandbox is not None:
+            sandbox, self.sandbox = self.sandbox, None
+            sandbox.release()
+
+
+class ExecuteStreamView(ExecuteView):
+    
+    def post(self, request):
+        """Same as 'ExecuteView.post()', but the response is a stream of server-sent events
+        sent as the commands are executed, see 'Executor.stream()'."""
+        executor = self._executor(request)
+        return _event_stream_response(_EventStream(executor.stream(), executor.sandbox))
+
+
+def _event_stream_response(stream: _EventStream) -> StreamingHttpResponse:
+    """Return a response sending the server-sent events of <stream>."""
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Disable buffering of reverse proxies
+    return response
+
+
+class ExecuteBatchView(View):
+    
+    def post(self, request):
+        """Execute many configs of '/execute/' concurrently across the pool, see batch.py."""
+        batch = Batch.from_request(request, utils.parse_config(request))
+        return JsonResponse(batch.execute())
+
+
+class ExecuteBatchStreamView(View):
+    
+    def post(self, request):
+        """Same as 'ExecuteBatchView.post()', but the result of each config is sent as a
+        server-sent event as soon as it and the previous ones are available, see
+        'Batch.stream()'."""
+        batch = Batch.from_request(request, utils.parse_config(request))
+        return _event_stream_response(_EventStream(batch.stream()))
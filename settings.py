@@ -10,9 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
+import hashlib
 import logging
 import os
 import sys
+import tempfile
 import threading
 import platform
 
@@ -32,6 +34,10 @@ DEBUG = False
 # Set to true when 'python3 manage.py test' is used
 TESTING = sys.argv[1:2] == ['test']
 
+# Set to true when 'python3 manage.py pool' is used, this command only sends requests to a running
+# sandbox, which must not initialise the containers itself.
+POOL_COMMAND = sys.argv[1:2] == ['pool']
+
 ALLOWED_HOSTS = ['127.0.0.1']
 
 # Application definition
@@ -177,14 +183,101 @@ EXTERNAL_LIBRARIES_CRON_TRIGGER = CronTrigger(
     second="0",
 )
 
-SANDBOX_VERSION = "3.0.3"
+SANDBOX_VERSION = "3.1.0"
 
-# Time before returning a '503: Service Unavailable' when waiting for a container.
+# Time before returning a '503: Service Unavailable' when waiting for a container, can be changed
+# for each request with the field 'max_wait' of its config, up to MAX_WAIT_FOR_CONTAINER_DURATION.
 WAIT_FOR_CONTAINER_DURATION = 2
+MAX_WAIT_FOR_CONTAINER_DURATION = 60
+
+# Maximum number of requests waiting for a container, further requests are immediately rejected
+# with a '503: Service Unavailable' (0 means no limit). Requests are also rejected immediately if
+# the estimated time before a container is available exceeds their 'max_wait'. Rejected responses
+# contain a 'Retry-After' header computed from this estimation.
+MAX_WAITING_REQUESTS = 100
 
 # Total time for an '/execute/' request before timeout
 EXECUTE_TIMEOUT = 10.0
 
+# Whether the commands of an '/execute/' request should be executed at once by the agent of the
+# container (see DOCKER_AGENT), or by a single 'docker exec' of its script if it cannot be reached,
+# instead of one 'docker exec' per command. The result of each command is the same. Commands are
+# always executed one by one if DOCKER_AGENT is False, the script of the agent not being mounted.
+EXECUTE_BATCH = True
+
+# Maximum number of bytes kept of the stdout and of the stderr of each command
+# (EXECUTE_OUTPUT_LIMIT), and of the output of all the commands of a request
+# (EXECUTE_TOTAL_OUTPUT_LIMIT), 0 means no limit. Output beyond these limits is discarded as it is
+# read, the result of each command containing the number of bytes written on each stream ('bytes')
+# and whether they have been truncated ('truncated'). If EXECUTE_OUTPUT_KILL is True, a command is
+# killed as soon as its output exceeds the limits, its exit code being then -5.
+EXECUTE_OUTPUT_LIMIT = 1024 * 1024
+EXECUTE_TOTAL_OUTPUT_LIMIT = 8 * 1024 * 1024
+EXECUTE_OUTPUT_KILL = False
+
+# Whether the resources used by each command, and by all the commands of a request, should be
+# measured from the files of the cgroup of the container (by its agent, or from the host when
+# commands are executed through 'docker exec'), see sandbox/cgroups.py. The result of each command
+# and the response then contain a 'resources' field.
+EXECUTE_RESOURCES = True
+
+# Limits a request can declare in the field 'limits' of its config, each being optional and capped
+# by the maximums below:
+# EXECUTE_MAX_CPU_TIME (int) – Maximum of 'cpu_time', the CPU time (in seconds) of each process of
+#       the commands (RLIMIT_CPU). A command killed for exceeding it has an exit code of -6.
+# EXECUTE_MAX_MEMORY (int) – Maximum of 'memory', the memory (in bytes, swap included) of the
+#       container, further capped by the 'mem_limit' of DOCKER_PARAMETERS.
+# EXECUTE_MAX_PIDS (int) – Maximum of 'pids', the number of processes of the container, further
+#       capped by the 'pids_limit' of DOCKER_PARAMETERS.
+# Requests can thus only lower the limits of the containers. Memory and processes are limited by
+# updating the container through Docker, its limits being restored when it is released. When a
+# request declares a CPU time, the wall-clock time of its commands is only a safety net against
+# commands that are not using the CPU: they share EXECUTE_SAFETY_TIMEOUT seconds instead of
+# EXECUTE_TIMEOUT, which is also the default timeout of each of them.
+EXECUTE_MAX_CPU_TIME = 30
+EXECUTE_MAX_MEMORY = 200 * 1024 * 1024
+EXECUTE_MAX_PIDS = 1024
+EXECUTE_SAFETY_TIMEOUT = 60.0
+
+# Maximum number of 'cases' of a parameterized execution, see README.md.
+EXECUTE_MAX_CASES = 100
+
+# Maximum number of configs of a request to '/execute/batch/' (BATCH_MAX_CONFIGS), and number of
+# them executed concurrently (BATCH_MAX_CONCURRENCY), a request being able to ask for less through
+# its field 'concurrency'.
+BATCH_MAX_CONFIGS = 1000
+BATCH_MAX_CONCURRENCY = 8
+
+# Order in which requests waiting for a container are served, see sandbox/scheduler.py.
+# SCHEDULER_PRIORITIES (dict) – Priority of each class of request, the lowest being served first.
+#       The class of a request is given by the field 'priority' of its config.
+# SCHEDULER_DEFAULT_PRIORITY (str) – Class of the requests that do not specify one.
+# SCHEDULER_AGING (float) – Time (in seconds) a request must wait to gain one level of priority,
+#       so that lower classes are never starved (0 disables aging).
+# SCHEDULER_WEIGHTS (dict) – Share of the containers of each client (1 by default) when several
+#       clients are waiting. The client of a request is given by the field 'client' of its config,
+#       defaulting to the IP address of the request.
+SCHEDULER_PRIORITIES = {
+    "interactive": 0,
+    "batch":       1,
+}
+SCHEDULER_DEFAULT_PRIORITY = "interactive"
+SCHEDULER_AGING = 30
+SCHEDULER_WEIGHTS = {}
+
+# Token that must be given in the 'Authorization: Token <ADMIN_TOKEN>' header of requests to
+# '/pool/', used to resize the pool or change the containers' configuration at runtime. This
+# endpoint is disabled if None.
+ADMIN_TOKEN = None
+
+# UPLOAD_TOKEN (str) – Token that must be given in the 'Authorization: Token <UPLOAD_TOKEN>'
+#       header of the requests adding environments to the store: POST to '/uploads/<sha256>/', and
+#       requests to '/execute/batch/' sending files. Anyone can upload environments if None.
+# UPLOAD_MAX_SIZE (int) – Maximum size (in bytes) of an environment added to the store. Uploaded
+#       environments must also be valid archives, whether UPLOAD_TOKEN is set or not.
+UPLOAD_TOKEN = None
+UPLOAD_MAX_SIZE = 64 * 1024 * 1024
+
 # Directory where environments are stored
 ENVIRONMENT_ROOT = os.path.join(BASE_DIR, 'environments')
 if not os.path.isdir(ENVIRONMENT_ROOT):
@@ -195,18 +288,127 @@ HOUR = 3600
 DAY = HOUR * 24
 ENVIRONMENT_EXPIRATION = DAY
 
+# Size (in bytes) above which an environment being converted to another codec is written to a
+# temporary file instead of being kept in memory (see sandbox/archives.py).
+ENVIRONMENT_SPOOL_SIZE = 8 * 1024 * 1024
+
+# ENVIRONMENT_CODEC (str) – Codec of the environments saved by the executions: 'gzip' (.tgz),
+#       'zstd' (.tar.zst, requires the package 'zstandard') or 'tar' (.tar, not compressed, for fast
+#       disks). Environments are read whatever their codec, and sent as .tgz unless the client asks
+#       for another codec, see sandbox/archives.py.
+# ENVIRONMENT_CODEC_LEVEL (int) – Compression level of ENVIRONMENT_CODEC, None meaning its default
+#       (9 for 'gzip', 3 for 'zstd').
+ENVIRONMENT_CODEC = "gzip"
+ENVIRONMENT_CODEC_LEVEL = None
+
+# Environments used by many executions are extracted once into a cache and then materialised into
+# the working directory of each container by cloning (copy-on-write) or copying their files, see
+# sandbox/cache.py.
+# ENVIRONMENT_CACHE_SIZE (int) – Maximum size (in bytes) of the files of the cached environments,
+#       0 disables the cache.
+# ENVIRONMENT_CACHE_COUNT (int) – Maximum number of cached environments.
+ENVIRONMENT_CACHE_SIZE = 1024 * 1024 * 1024
+ENVIRONMENT_CACHE_COUNT = 256
+
 #
 # DOCKER_COUNT (int) – Max number of containers running simultaneously.
+# DOCKER_SPARE_COUNT (int) – Number of extra pre-warmed containers. Used containers are cleaned in
+#       the background, spares allow to acquire a container immediately while this is done.
+# DOCKER_RECYCLING_WORKERS (int) – Max number of containers being cleaned or recreated at the
+#       same time.
+# DOCKER_RECYCLING_RETRY_DELAY (float) – Time (in seconds) before trying again to recreate a
+#       container that could not be recreated.
+# DOCKER_STARTUP_WORKERS (int) – Max number of containers being created or removed at the same
+#       time when the pool is (re)initialised.
+# DOCKER_RECONCILE (bool) – Whether idle containers left by a previous process should be adopted
+#       at startup when their configuration (image, DOCKER_PARAMETERS, mounts) did not change,
+#       instead of purging and recreating every container. Adopted containers are cleaned and
+#       restarted, and recreated if their writable layer changed since their creation.
+# DOCKER_FAST_RESET (bool) – Whether released containers should be reused without being restarted
+#       when the last execution did not contaminate them (no process left that could not be
+#       killed, no change in the container's writable layer).
+# DOCKER_FAST_RESET_KILL_DELAY (float) – Time (in seconds) given to leftover processes to die
+#       before restarting the container.
+# DOCKER_FAST_RESET_SCRATCH (list) – Directories whose content is deleted when a container is
+#       reused without being restarted. Files written there (e.g. by gcc in /tmp, or the JVM in
+#       /tmp/hsperfdata_*) do not force the container to be recreated, and tmpfs mounts cleared by a
+#       restart (/dev/shm, /dev/mqueue) are emptied so that the next execution cannot read them.
+# DOCKER_TRASH_REAP_RATE (int) – Used working directories are moved to
+#       DOCKER_VOLUME_HOST_BASEDIR/.trash/ and deleted in the background by a low priority thread,
+#       removing at most this number of files per second (0 means no limit).
 # DOCKER_VOLUME_MEM_LIMIT (int) – Limit of memory usage for volumes (in MB).
 # DOCKER_VOLUME_HOST_BASEDIR (str) – Path to the root directory containing each directory shared
 #       with the containers. For each container, a directory named after the container's name is
 #       created inside DOCKER_VOLUME_HOST_BASEDIR.
+# DOCKER_AGENT (bool) – Whether the main process of the containers should be an agent executing the
+#       commands (see docker/agent.py), avoiding the round-trips of 'docker exec' to the Docker
+#       daemon. Its socket is created in DOCKER_VOLUME_HOST_BASEDIR/.agents/<container's name>/.
+#       Commands are executed through 'docker exec' if the agent cannot be reached, e.g. if the
+#       image does not provide python3 or if DOCKER_PARAMETERS contains a 'command'.
+#
+# DOCKER_POOL_COORDINATOR (bool) – Whether the pool of containers is shared by every process of the
+#       server (e.g. mod_wsgi or gunicorn workers). The first process to lock
+#       DOCKER_POOL_SOCKET + ".lock" manages the containers and leases them to the other processes
+#       through the unix socket DOCKER_POOL_SOCKET, another process takes over if it dies. If False,
+#       each process manages its own containers and the server must run a single process.
+# DOCKER_POOL_SOCKET (str) – Path to the unix socket of the coordinator, in the temporary directory
+#       by default and named after BASE_DIR, so that several servers of a host do not share it.
+# DOCKER_POOL_TIMEOUT (float) – Time (in seconds) before giving up on a request to the coordinator,
+#       in addition to WAIT_FOR_CONTAINER_DURATION when acquiring a container.
+#
+# DOCKER_AUTOSCALE (bool) – Whether the number of containers that can be used simultaneously
+#       (initially DOCKER_COUNT) should grow or shrink according to the load, between
+#       DOCKER_MIN_COUNT and DOCKER_MAX_COUNT, every DOCKER_AUTOSCALE_INTERVAL seconds.
+# DOCKER_AUTOSCALE_STEP (int) – Number of containers added or removed at once.
+# DOCKER_AUTOSCALE_WAIT_THRESHOLD (float) – The pool grows when the 90th percentile of the time
+#       (in seconds) spent waiting for a container exceeds this value, or when a request is
+#       waiting or has been rejected.
+# DOCKER_AUTOSCALE_COOLDOWN (float) – Time (in seconds) during which at least
+#       DOCKER_AUTOSCALE_STEP containers must have been idle before shrinking the pool.
+# DOCKER_AUTOSCALE_MAX_MEMORY / DOCKER_AUTOSCALE_MAX_CPU (float) – The pool does not grow if the
+#       host's memory or CPU usage (in percent) is above these values.
+# DOCKER_CPU_PINNING (bool) – Whether each container should be restricted to its own CPUs. If
+#       True, the CPUs of DOCKER_PARAMETERS["cpuset_cpus"] are split between the containers,
+#       otherwise every container can use all of them.
+# DOCKER_CPUS_PER_CONTAINER (int) – Number of CPUs assigned to each container when
+#       DOCKER_CPU_PINNING is True. Containers share the same CPUs if there is not enough CPUs.
+# DOCKER_CPU_SMT (bool) – Whether SMT siblings (hyper-threads) can be assigned to containers. If
+#       False, only the first hardware thread of each physical core is used.
+# DOCKER_CPU_NUMA (bool) – Whether CPUs assigned to a container must belong to the same NUMA node.
 #
 # DOCKER_PARAMETERS (dict) - kwargs given to the Containers constructor. See
 # https://docker-py.readthedocs.io/en/stable/containers.html and
 # https://docs.docker.com/config/containers/resource_constraints/ for more information about
 # every argument
 DOCKER_COUNT = 20
+DOCKER_SPARE_COUNT = 2
+DOCKER_RECYCLING_WORKERS = 4
+DOCKER_RECYCLING_RETRY_DELAY = 30
+DOCKER_STARTUP_WORKERS = 8
+DOCKER_RECONCILE = True
+DOCKER_FAST_RESET = True
+DOCKER_FAST_RESET_KILL_DELAY = 0.5
+DOCKER_FAST_RESET_SCRATCH = ["/tmp", "/var/tmp", "/dev/shm", "/dev/mqueue"]
+DOCKER_TRASH_REAP_RATE = 5000
+DOCKER_AGENT = True
+DOCKER_POOL_COORDINATOR = True
+DOCKER_POOL_SOCKET = os.path.join(
+    tempfile.gettempdir(), f"sandbox-{hashlib.sha1(BASE_DIR.encode()).hexdigest()[:12]}.sock"
+)
+DOCKER_POOL_TIMEOUT = 5
+DOCKER_AUTOSCALE = False
+DOCKER_MIN_COUNT = 5
+DOCKER_MAX_COUNT = 40
+DOCKER_AUTOSCALE_INTERVAL = 5
+DOCKER_AUTOSCALE_STEP = 2
+DOCKER_AUTOSCALE_WAIT_THRESHOLD = 0.5
+DOCKER_AUTOSCALE_COOLDOWN = 300
+DOCKER_AUTOSCALE_MAX_MEMORY = 85
+DOCKER_AUTOSCALE_MAX_CPU = 90
+DOCKER_CPU_PINNING = True
+DOCKER_CPUS_PER_CONTAINER = 1
+DOCKER_CPU_SMT = True
+DOCKER_CPU_NUMA = True
 DOCKER_VOLUME_HOST_BASEDIR = os.path.join(BASE_DIR, 'containers_env')
 DOCKER_PARAMETERS = {
     "image":            "pl:latest",
@@ -214,7 +416,9 @@ DOCKER_PARAMETERS = {
     "cpu_period":       1000,
     "cpu_shares":       1024,
     "cpu_quota":        0,
-    "cpuset_cpus":      "0",
+    "cpuset_cpus":      ",".join(str(cpu) for cpu in sorted(
+        os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count())
+    )),
     "detach":           True,
     "environment":      {},
     "mem_limit":        "100m",
@@ -240,9 +444,11 @@ del logger
 # Override some settings from testing purpose
 if TESTING:
     DOCKER_COUNT = 5
+    DOCKER_POOL_SOCKET = f"/tmp/sandbox-test-{os.getpid()}.sock"
 
-from sandbox.containers import initialise_containers  # noqa
+from sandbox import coordinator  # noqa
 
 
-INITIALISING_THREAD = threading.Thread(target=initialise_containers)
-INITIALISING_THREAD.start()
+INITIALISING_THREAD = threading.Thread(target=coordinator.start)
+if not POOL_COMMAND:
+    INITIALISING_THREAD.start()